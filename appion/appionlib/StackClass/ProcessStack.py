@@ -1,8 +1,13 @@
 #!/usr/bin/env python
 
 import os
+import sys
 import math
 import time
+import Queue
+import threading
+import collections
+import multiprocessing
 from pyami import mem
 from appionlib import apDisplay
 from appionlib.StackClass import mrcClass
@@ -43,6 +48,22 @@ def createStackClass(filename, msg=False):
 		raise NotImplementedError
 	raise NotImplementedError("extension does not map to existing stack type %s"%(extension))
 
+#===============
+def readChunk(stackfile, first, last, partlist=None):
+	stackClass = createStackClass(stackfile)
+	if partlist is not None:
+		return stackClass.readParticlesFromFile(partlist)
+	return stackClass.readParticlesFromFile(first=first, last=last)
+
+#===============
+def runChunk(task):
+	"""
+	read one chunk and apply the chunk function, in a worker process
+	"""
+	chunkFunction, stackfile, first, last, partlist = task
+	stackarray = readChunk(stackfile, first, last, partlist)
+	return chunkFunction(stackarray)
+
 ########################################
 ########################################
 ########################################
@@ -50,11 +71,28 @@ class ProcessStack(object):
 	"""
 	This is class to help process particles in a stack
 	that are bigger than the amount of memory on the machine
+
+	The next chunk is read in a thread while the current one is processed,
+	and writes handed to queueWrite() run in another thread.
+
+	A subclass that sets chunkFunction, a module level function that takes
+	a chunk (numpy array of particles) and returns a result, has the chunks
+	read and processed in nproc worker processes instead.  reduceChunk()
+	then gets the results in stack order.
 	"""
+	### e.g., chunkFunction = staticmethod(chunkStatistics)
+	chunkFunction = None
+	### chunks that are read ahead of the one being processed
+	readahead = 1
+	### chunks per worker process that are queued or being processed
+	chunksperproc = 2
+
 	#===============
-	def __init__(self, msg=True):
+	def __init__(self, msg=True, nproc=None):
 		self.msg = msg
 		self.numpart = None
+		self.nproc = nproc
+		self.writer = None
 		self.initFunctions()
 
 	#===============
@@ -85,8 +123,9 @@ class ProcessStack(object):
 		### maximum number particles that fit into memory
 		self.maxpartinmem = self.freememory/self.memperpart
 		self.message("Max particles in memory: %d"%(self.maxpartinmem))
-		### number particles to fit into memory
-		self.partallowed = int(self.maxpartinmem/20.0)
+		### number particles to fit into memory, shared by the worker processes
+		self.numproc = self.getNumProcesses()
+		self.partallowed = int(self.maxpartinmem/20.0/self.numproc)
 		### FIXME: this severly affect performance and it is probably network dependent
 		### at SEMC it is better to have smaller fragments, but this may be different
 		if self.partallowed > 1000:
@@ -108,6 +147,111 @@ class ProcessStack(object):
 		self.message("Particle loop num chunks: %d"%(numchucks))
 		self.message("Particle loop step size: %d"%(self.stepsize))
 
+	#===============
+	def getNumProcesses(self):
+		"""
+		worker processes used for a chunkFunction, 1 to use this process
+		"""
+		if self.chunkFunction is None:
+			return 1
+		### daemon processes, such as pool workers, cannot start their own
+		if multiprocessing.current_process().daemon:
+			return 1
+		if self.nproc is not None:
+			return max(1, self.nproc)
+		try:
+			return multiprocessing.cpu_count()
+		except NotImplementedError:
+			return 1
+
+	#===============
+	def getChunkRanges(self):
+		"""
+		list of (first, last) particle numbers of each chunk, starting at 1
+		"""
+		ranges = []
+		first = 1
+		last = self.stepsize
+		while first <= self.numpart:
+			ranges.append((first, last))
+			first = last+1
+			last += self.stepsize
+			if last > self.numpart:
+				last = self.numpart
+		return ranges
+
+	#===============
+	def getChunkPartList(self, first, last):
+		if self.partlist is None:
+			return None
+		return self.partlist[first-1:last]
+
+	#===============
+	def readChunks(self, ranges):
+		"""
+		yield (first, last, stackarray) in order, reading ahead in a thread
+		"""
+		queue = Queue.Queue(self.readahead)
+		stop = threading.Event()
+		def reader():
+			try:
+				for first, last in ranges:
+					if stop.isSet():
+						return
+					stackarray = readChunk(self.stackfile, first, last, self.getChunkPartList(first, last))
+					queue.put((first, last, stackarray))
+			except:
+				queue.put(sys.exc_info())
+				return
+			queue.put(None)
+		thread = threading.Thread(target=reader, name='ProcessStack reader')
+		thread.setDaemon(True)
+		thread.start()
+		try:
+			while True:
+				item = queue.get()
+				if item is None:
+					break
+				if len(item) == 3 and isinstance(item[1], BaseException):
+					raise item[0], item[1], item[2]
+				yield item
+		finally:
+			### unblock the reader if the loop ended early
+			stop.set()
+			while thread.isAlive():
+				try:
+					queue.get(timeout=0.1)
+				except Queue.Empty:
+					pass
+
+	#===============
+	def mapChunks(self, ranges):
+		"""
+		yield (first, last, result) in order, where each chunk is read and
+		passed to chunkFunction in a worker process
+		"""
+		pool = multiprocessing.Pool(self.numproc)
+		maxpending = self.chunksperproc*self.numproc
+		pending = collections.deque()
+		finished = False
+		try:
+			for first, last in ranges:
+				task = (self.chunkFunction, self.stackfile, first, last, self.getChunkPartList(first, last))
+				pending.append((first, last, pool.apply_async(runChunk, (task,))))
+				if len(pending) >= maxpending:
+					first, last, result = pending.popleft()
+					yield first, last, result.get()
+			while pending:
+				first, last, result = pending.popleft()
+				yield first, last, result.get()
+			finished = True
+		finally:
+			if finished:
+				pool.close()
+			else:
+				pool.terminate()
+			pool.join()
+
 	#===============
 	def start(self, stackfile, partlist=None):
 		self.stackfile = stackfile
@@ -117,21 +261,25 @@ class ProcessStack(object):
 			numrequest = len(partlist)
 		else:
 			numrequest = None
+		self.partlist = partlist
 		self.initValues(stackfile, numrequest)
 
 		### custom pre-loop command
 		self.preLoop()
 
-		first = 1
-		last = self.stepsize
 		self.index = 0
 		t0 = time.time()
 
-		while self.index < self.numpart and first <= self.numpart:
+		ranges = self.getChunkRanges()
+		if self.chunkFunction is not None and self.numproc > 1:
+			self.message("Processing chunks in %d processes"%(self.numproc))
+			chunks = self.mapChunks(ranges)
+		else:
+			chunks = self.readChunks(ranges)
+
+		for first, last, chunk in chunks:
 			### print message
 			if self.index > 10:
-				#self.message("partnum through %d of %d, %s time so far"
-				#	%(last, self.numpart, apDisplay.timeString((time.time()-t0))))
 				esttime = (time.time()-t0)/float(first)*float(self.numpart-first)
 				self.message("partnum %d to %d of %d, %s remain"
 					%(first, last, self.numpart, apDisplay.timeString(esttime)))
@@ -139,27 +287,23 @@ class ProcessStack(object):
 				self.message("partnum %d to %d of %d"
 					%(first, last, self.numpart))
 
-			### read images
-			if partlist is not None:
-				stackarray = self.stackClass.readParticlesFromFile(partlist)
-			else:
-				#self.message("actual partnum %d to %d"%(first-1, last))
-				stackarray = self.stackClass.readParticlesFromFile(first=first, last=last)
-
 			### process images
-			self.processStack(stackarray)
+			if self.chunkFunction is None:
+				self.processStack(chunk)
+			else:
+				if self.numproc == 1:
+					chunk = self.chunkFunction(chunk)
+				self.reduceChunk(chunk)
+				self.index += last - first + 1
 
 			### check for proper implementation
 			if self.index == 0:
 				apDisplay.printError("No particles were processed in stack loop")
-
-			### setup for next iteration
-			first = last+1
-			last += self.stepsize
-			if last > self.numpart:
-				last = self.numpart
 			### END LOOP
 
+		### wait for queued writes
+		self.flushWrites()
+
 		### check for off-one reading errors
 		if self.index < self.numpart-1:
 			print "INDEX %d -- NUMPART %d"%(self.index, self.numpart)
@@ -172,6 +316,49 @@ class ProcessStack(object):
 			+apDisplay.timeString(time.time()-self.starttime))
 		return
 
+	#===============
+	def queueWrite(self, func, *args):
+		"""
+		call func(*args) in the writer thread, in the order queued,
+		so that writing one chunk overlaps processing the next
+		"""
+		if self.writer is None:
+			self.writequeue = Queue.Queue(self.readahead+1)
+			self.writeerror = None
+			self.writer = threading.Thread(target=self.writeLoop, name='ProcessStack writer')
+			self.writer.setDaemon(True)
+			self.writer.start()
+		self.writequeue.put((func, args))
+
+	#===============
+	def writeLoop(self):
+		while True:
+			item = self.writequeue.get()
+			if item is None:
+				break
+			### once a write failed, the later ones are dropped
+			if self.writeerror is not None:
+				continue
+			func, args = item
+			try:
+				func(*args)
+			except:
+				self.writeerror = sys.exc_info()
+
+	#===============
+	def flushWrites(self):
+		"""
+		wait for the queued writes, raises the error of a failed one
+		"""
+		if self.writer is None:
+			return
+		self.writequeue.put(None)
+		self.writer.join()
+		self.writer = None
+		if self.writeerror is not None:
+			error, self.writeerror = self.writeerror, None
+			raise error[0], error[1], error[2]
+
 	########################################
 	# CUSTOMIZED FUNCTIONS
 	########################################
@@ -195,6 +382,13 @@ class ProcessStack(object):
 	def processParticle(self, partarray):
 		raise NotImplementedError
 
+	#===============
+	def reduceChunk(self, result):
+		"""
+		combine the chunkFunction result of one chunk, in stack order
+		"""
+		raise NotImplementedError
+
 	#===============
 	def postLoop(self):
 		return
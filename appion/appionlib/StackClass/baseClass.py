@@ -10,6 +10,36 @@ from appionlib import apDisplay
 # Please keep it this way
 ####
 
+def particleRuns(particleNumbers, maxgap=0, maxrun=None):
+	"""
+	sort particle numbers into runs of consecutive particles, so
+	each run can be read from file at once
+
+	runs include gaps of up to maxgap unrequested particles, which are
+	cheaper to read than to seek over, and span at most maxrun particles
+
+	returns list of (first, last, indices, numbers) for each run, where
+	numbers are the requested particles in the run and indices are
+	their positions in particleNumbers
+	"""
+	numbers = numpy.asarray(particleNumbers, dtype=numpy.int64)
+	if len(numbers) == 0:
+		return []
+	order = numpy.argsort(numbers, kind='mergesort')
+	sortednumbers = numbers[order]
+	newrun = numpy.diff(sortednumbers) > maxgap+1
+	if maxrun is not None:
+		blocks = (sortednumbers - sortednumbers[0]) // maxrun
+		newrun |= numpy.diff(blocks) > 0
+	breaks = numpy.nonzero(newrun)[0] + 1
+	starts = numpy.concatenate(([0], breaks))
+	ends = numpy.concatenate((breaks, [len(sortednumbers)]))
+	runs = []
+	for start, end in zip(starts, ends):
+		runs.append((int(sortednumbers[start]), int(sortednumbers[end-1]),
+			order[start:end], sortednumbers[start:end]))
+	return runs
+
 class StackClass(object):
 	################################################
 	# Must be implemented in new Stack subClass
@@ -37,6 +67,22 @@ class StackClass(object):
 		#apDisplay.printWarning("no readParticleChunkFromFile; using backup method for this StackClass")
 		return self._readParticleListFromFile(particleNumbers)
 
+	def _readParticleRunsFromFile(self, particleNumbers, readRun, maxgap=0, maxrun=None):
+		"""
+		read a list of particles in runs of consecutive particles, each
+		run with readRun(first, last), and return them in requested order
+		particles numbers MUST start at 1
+		"""
+		partarray = None
+		for first, last, indices, numbers in particleRuns(particleNumbers, maxgap, maxrun):
+			rundata = readRun(first, last)
+			if partarray is None:
+				partarray = numpy.empty((len(particleNumbers),)+rundata.shape[1:], rundata.dtype)
+			partarray[indices] = rundata[numbers-first]
+		if partarray is None:
+			return []
+		return partarray
+
 	def _writeParticlesToFile(self, particleDataTree):
 		"""
 		input:
@@ -156,7 +202,7 @@ class StackClass(object):
 			partdatalist = self._readParticleChunkFromFile(first, last)
 
 		#convert to numpy array of shape (numpart, box, box)
-		partdataarray = numpy.array(partdatalist)
+		partdataarray = numpy.asarray(partdatalist)
 		if self.debug is True:
 			apDisplay.printMsg("finished reading %d particles of boxsize %d x %d from file"
 				%(partdataarray.shape))
@@ -10,6 +10,11 @@ from appionlib.StackClass import baseClass
 ####
 
 class MrcClass(baseClass.StackClass):
+	### unrequested particles read to join particle runs, rather than seek
+	maxReadGap = 4
+	### bytes read at once
+	maxReadBytes = 64*1024*1024
+
 	################################################
 	# Must be implemented in new Stack subClass
 	################################################
@@ -31,12 +36,32 @@ class MrcClass(baseClass.StackClass):
 		read a list of particles into memory
 		particles numbers MUST start at 1
 		"""
-		partdatalist = []
-		for partnum in particleNumbers:
-			a = mrc.read(self.filename, zslice=(partnum-1))
-			partdatalist.append(a)
+		f = open(self.filename, 'rb')
+		try:
+			headerdict = mrc.parseHeader(f.read(1024))
+			def readRun(first, last):
+				return mrc.readSlicesFromFile(f, headerdict, first-1, last-first+1)
+			framesize = headerdict['dtype'].itemsize * headerdict['nx'] * headerdict['ny']
+			maxrun = max(1, self.maxReadBytes // framesize)
+			partdatalist = self._readParticleRunsFromFile(particleNumbers, readRun,
+				self.maxReadGap, maxrun)
+		finally:
+			f.close()
 		return partdatalist
 
+	def _readParticleChunkFromFile(self, first, last):
+		"""
+		read a fixed range of particles into memory
+		particles numbers MUST start at 1
+		"""
+		f = open(self.filename, 'rb')
+		try:
+			headerdict = mrc.parseHeader(f.read(1024))
+			partarray = mrc.readSlicesFromFile(f, headerdict, first-1, last-first+1)
+		finally:
+			f.close()
+		return partarray
+
 	def _writeParticlesToFile(self, particleDataTree):
 		"""
 		input:
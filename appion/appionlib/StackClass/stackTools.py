@@ -2,6 +2,8 @@
 
 import os
 import time
+import itertools
+import multiprocessing
 import numpy
 from pyami import mrc
 from pyami import imagefun
@@ -31,40 +33,136 @@ def getPixelSize(filename):
 ########################################
 ########################################
 ########################################
-def boxParticlesFromFile(mrcfile, stackfile, initboxsize, finalboxsize, coordinates, invert=False):
+def readMicrograph(mrcfile):
+	"""
+	memory map the micrograph, so only the rows under particles are read
+	"""
+	header = mrc.readHeaderFromFile(mrcfile)
+	if header['mode'] == 101:
+		#packed 4-bit data cannot be mapped
+		return mrc.read(mrcfile)
+	imgarray = mrc.mmap(mrcfile)
+	if imgarray.ndim == 3:
+		imgarray = imgarray[0]
+	return imgarray
+
+#===============
+def boxParticles(imgarray, initboxsize, coordinates, padedge=False):
+	"""
+	gather the boxes of all coordinates into one (numpart, box, box) array
+	coordinates are (x, y, partnum), returns the boxes and the used partnums
+
+	boxes that do not fit in the image are skipped, or with padedge=True
+	kept with the edge pixels repeated
+	"""
+	half = initboxsize/2
+	coords = numpy.asarray(coordinates, dtype=numpy.int64).reshape(-1, 3)
+	x1 = coords[:,0] - half
+	y1 = coords[:,1] - half
+	if padedge is False:
+		inside = ((x1 >= 0) & (y1 >= 0)
+			& (x1 + 2*half < imgarray.shape[1]) & (y1 + 2*half < imgarray.shape[0]))
+		coords = coords[inside]
+		x1 = x1[inside]
+		y1 = y1[inside]
+	offsets = numpy.arange(2*half)
+	rows = y1[:,numpy.newaxis] + offsets
+	cols = x1[:,numpy.newaxis] + offsets
+	if padedge is True:
+		rows = numpy.clip(rows, 0, imgarray.shape[0]-1)
+		cols = numpy.clip(cols, 0, imgarray.shape[1]-1)
+	#numpy arrays are rows,cols --> y,x not x,y
+	boxes = imgarray[rows[:,:,numpy.newaxis], cols[:,numpy.newaxis,:]]
+	return boxes, coords[:,2].tolist()
+
+#===============
+def processBoxes(stackarray, finalboxsize, invert=False, normalize=False):
+	"""
+	rescale, invert and normalize a stack of boxed particles
+	"""
+	stackarray = imagefun.fourier_scale_stack(stackarray, finalboxsize)
+	if invert is True:
+		stackarray = -1.0 * stackarray
+	if normalize is True:
+		stackarray = chunkNormalize(stackarray)
+	return stackarray
+
+#===============
+def boxParticlesFromFile(mrcfile, stackfile, initboxsize, finalboxsize, coordinates,
+		invert=False, normalize=False, padedge=False, batchsize=256):
 	"""
 	reads mrc and writes a stackfile
 	boxsize = integer
 	coordinates is 20x2 numpy array
 		e.g., coordinates[0] = [2030, 1065]
+
+	the boxes are cut, rescaled, inverted and normalized as stacks of
+	up to batchsize particles
 	"""
 	apDisplay.printMsg("Making a stack %s -> %s"%(apDisplay.short(mrcfile), stackfile))
-	imgarray = mrc.read(mrcfile)
-	boxedparticles = []
+	imgarray = readMicrograph(mrcfile)
+	stackClass = None
 	usedparticles = []
-	for x,y,partnum in coordinates:
-		x1 = x-initboxsize/2
-		x2 = x+initboxsize/2
-		y1 = y-initboxsize/2
-		y2 = y+initboxsize/2
-		if x1 < 0 or y1 < 0:
-			continue
-		if x2 >= imgarray.shape[1] or y2 >= imgarray.shape[0]:
+	for i in range(0, len(coordinates), batchsize):
+		stackarray, partnums = boxParticles(imgarray, initboxsize, coordinates[i:i+batchsize], padedge)
+		if len(partnums) == 0:
 			continue
-		initboxpart = imgarray[y1:y2,x1:x2] #numpy arrays are rows,cols --> y,x not x,y
-		finalboxpart = imagefun.fourier_scale(initboxpart, finalboxsize)
-		if invert is True:
-			finalboxpart = -1.0 * finalboxpart
-		usedparticles.append(partnum)
-		boxedparticles.append(finalboxpart)
+		stackarray = processBoxes(stackarray, finalboxsize, invert, normalize)
+		if stackClass is None:
+			stackClass = ProcessStack.createStackClass(stackfile)
+		stackClass.appendParticlesToFile(stackarray)
+		usedparticles.extend(partnums)
 	apDisplay.printMsg("Boxed %d of %d particles from %s"
-		%(len(boxedparticles), len(coordinates), apDisplay.short(mrcfile)))
-	if len(boxedparticles) == 0:
+		%(len(usedparticles), len(coordinates), apDisplay.short(mrcfile)))
+	if len(usedparticles) == 0:
 		return None
+	return usedparticles
+
+#===============
+def boxParticlesFromFiles(mrcfiles, stackfile, initboxsize, finalboxsize, coordinatelist,
+		invert=False, normalize=False, padedge=False, nproc=None):
+	"""
+	boxParticlesFromFile for a list of micrographs, each with its own
+	coordinates, boxed in nproc worker processes and appended in order
+	returns the list of used partnums of each micrograph
+	"""
+	tasks = []
+	for mrcfile, coordinates in zip(mrcfiles, coordinatelist):
+		tasks.append((mrcfile, initboxsize, finalboxsize, coordinates, invert, normalize, padedge))
+	if nproc is None:
+		nproc = multiprocessing.cpu_count()
+	if nproc > 1 and len(tasks) > 1 and not multiprocessing.current_process().daemon:
+		pool = multiprocessing.Pool(min(nproc, len(tasks)))
+		results = pool.imap(boxMicrographTask, tasks)
+	else:
+		pool = None
+		results = itertools.imap(boxMicrographTask, tasks)
 	stackClass = ProcessStack.createStackClass(stackfile)
-	stackClass.appendParticlesToFile(boxedparticles)
+	usedlist = []
+	try:
+		for mrcfile, (stackarray, usedparticles) in itertools.izip(mrcfiles, results):
+			apDisplay.printMsg("Boxed %d particles from %s"%(len(usedparticles), apDisplay.short(mrcfile)))
+			if len(usedparticles) > 0:
+				stackClass.appendParticlesToFile(stackarray)
+			usedlist.append(usedparticles)
+	finally:
+		if pool is not None:
+			pool.terminate()
+			pool.join()
+	return usedlist
 
-	return usedparticles
+#===============
+def boxMicrographTask(task):
+	"""
+	box all particles of one micrograph, in a worker process
+	"""
+	mrcfile, initboxsize, finalboxsize, coordinates, invert, normalize, padedge = task
+	imgarray = readMicrograph(mrcfile)
+	stackarray, partnums = boxParticles(imgarray, initboxsize, coordinates, padedge)
+	if len(partnums) == 0:
+		return None, partnums
+	stackarray = processBoxes(stackarray, finalboxsize, invert, normalize)
+	return numpy.asarray(stackarray, dtype=numpy.float32), partnums
 
 ########################################
 ########################################
@@ -82,8 +180,18 @@ def stackStatistics(stackfile, msg=False):
 
 	return meanlist, stdevlist
 
+#===============
+def chunkStatistics(stackarray):
+	"""
+	mean and stdev of each particle in a chunk
+	"""
+	flat = stackarray.reshape(stackarray.shape[0], -1)
+	return flat.mean(1), flat.std(1)
+
 #=======================
 class StackStatistics(ProcessStack.ProcessStack):
+	chunkFunction = staticmethod(chunkStatistics)
+
 	#===============
 	def preLoop(self):
 		#override self.partlist to get a subset
@@ -91,9 +199,10 @@ class StackStatistics(ProcessStack.ProcessStack):
 		self.stdevlist = []
 
 	#===============
-	def processParticle(self, partarray):
-		self.meanlist.append(partarray.mean())
-		self.stdevlist.append(partarray.std())
+	def reduceChunk(self, result):
+		means, stdevs = result
+		self.meanlist.extend(means)
+		self.stdevlist.extend(stdevs)
 
 ########################################
 ########################################
@@ -140,7 +249,7 @@ class MergeStack(ProcessStack.ProcessStack):
 
 	#===============
 	def processStack(self, stackarray):
-		self.mergeStackClass.appendParticlesToFile(stackarray)
+		self.queueWrite(self.mergeStackClass.appendParticlesToFile, stackarray)
 		self.index += len(stackarray) #you must have this line in your loop
 
 	#===============
@@ -188,13 +297,71 @@ class SubStack(ProcessStack.ProcessStack):
 
 	#===============
 	def processStack(self, stackarray):
-		self.outStackClass.appendParticlesToFile(stackarray)
+		self.queueWrite(self.outStackClass.appendParticlesToFile, stackarray)
 		self.index += len(stackarray) #you must have this line in your loop
 
 	#===============
 	def postLoop(self):
 		return
 
+########################################
+########################################
+########################################
+#===============
+def normalizeStack(instack="start.hdf", outstack="norm.mrcs", partlist=None, msg=False):
+	"""
+	normalize each particle to mean 0 and stdev 1
+	partlist starts at 1
+	"""
+	if msg is True:
+		apDisplay.printMsg("normalizing particles in stack")
+	instack = os.path.abspath(instack)
+	outstack = os.path.abspath(outstack)
+
+	if not os.path.isfile(instack):
+		apDisplay.printWarning("could not find input file")
+		return False
+	if os.path.isfile(outstack):
+		apDisplay.printWarning("output file already exists")
+		return False
+
+	normStack = NormalizeStack(msg)
+	normStack.outstack = outstack
+	normStack.start(instack, partlist)
+	if not os.path.isfile(outstack):
+		apDisplay.printWarning("output file creation failed")
+		return False
+	return True
+
+#===============
+def chunkNormalize(stackarray):
+	"""
+	normalize each particle of a chunk to mean 0 and stdev 1
+	"""
+	stackarray = numpy.array(stackarray, dtype=numpy.float32)
+	flat = stackarray.reshape(stackarray.shape[0], -1)
+	means = flat.mean(1)
+	stdevs = flat.std(1)
+	### leave constant particles at zero
+	stdevs[stdevs == 0] = 1.0
+	flat -= means[:,numpy.newaxis]
+	flat /= stdevs[:,numpy.newaxis]
+	return stackarray
+
+#=======================
+class NormalizeStack(ProcessStack.ProcessStack):
+	chunkFunction = staticmethod(chunkNormalize)
+
+	#===============
+	def preLoop(self):
+		if self.outstack is None:
+			apDisplay.printWarning("output file not defined")
+		self.outStackClass = self.StackClassFromFile(self.outstack)
+
+	#===============
+	def reduceChunk(self, result):
+		self.queueWrite(self.outStackClass.appendParticlesToFile, result)
+
 ########################################
 ########################################
 ########################################
@@ -246,8 +413,17 @@ def averageStackList(stacklist, outfile="average.mrc", partlist=None, msg=False)
 		mrc.write(average, outfile)
 	return average
 
+#===============
+def chunkSum(stackarray):
+	"""
+	sum of the particles in a chunk
+	"""
+	return stackarray.sum(0)
+
 #=======================
 class AverageStack(ProcessStack.ProcessStack):
+	chunkFunction = staticmethod(chunkSum)
+
 	#===============
 	def preLoop(self):
 		self.summed = numpy.zeros((self.boxsize,self.boxsize))
@@ -255,11 +431,8 @@ class AverageStack(ProcessStack.ProcessStack):
 		self.count = 0
 
 	#===============
-	def processStack(self, stackarray):
-		if isinstance(stackarray, list):
-			stackarray = numpy.array(stackarray)
-		self.index += stackarray.shape[0]
-		self.summed += stackarray.sum(0)
+	def reduceChunk(self, result):
+		self.summed += result
 
 	#===============
 	def save(self, avgfile):
@@ -159,21 +159,34 @@ def oneObjToGlobalPoints(bimage):
 	l=0
 	one_region=bimage[region_objs[l]]
 	starts=(region_objs[l][0].start,region_objs[l][1].start)
-	region_dim=numpy.shape(one_region)
-	gpoints=[]
-	for x in range(region_dim[0]):
-		for y in range(region_dim[1]):
-			if one_region[x][y]:
-				gpoints.append((x+starts[0],y+starts[1]))
-	return gpoints
+	gpoints=numpy.argwhere(one_region)+starts
+	return map(tuple,gpoints.tolist())
+
+def boundaryPoints(region):
+	'''
+	Points of a binary region that are not surrounded by the region on
+	all four sides.  Only these can be convex hull vertices, so the hull
+	of the boundary is the hull of the region.
+	'''
+	padded=numpy.zeros((region.shape[0]+2,region.shape[1]+2),numpy.bool)
+	padded[1:-1,1:-1]=region
+	interior=nd.binary_erosion(padded)[1:-1,1:-1]
+	return numpy.argwhere(region & ~interior)
 
 def findConvexHullsFromLabeledImage(regions,clabels):
 	gpolygons=[]
-	# individual region is masked to avoid problem of overlapped of region_obj slices
+	# each region is compared to its own label within its find_objects slice
+	# to avoid problem of overlapped of region_obj slices
+	region_objs=nd.find_objects(regions,max_label=clabels)
 	for l in range(1,clabels+1):
-		region=ma.masked_outside(regions,l,l)
-		mask=1-ma.getmask(region)
-		gpoints=oneObjToGlobalPoints(mask)
+		region_obj=region_objs[l-1]
+		if region_obj is None:
+			gpolygons.append([])
+			continue
+		one_region=regions[region_obj]==l
+		starts=(region_obj[0].start,region_obj[1].start)
+		gpoints=boundaryPoints(one_region)+starts
+		gpoints=map(tuple,gpoints.tolist())
 		gpolygon=findConvexHullsFromPoints(gpoints)
 		gpolygons.append(gpolygon)
 	return gpolygons
@@ -227,86 +240,33 @@ def convexHullUnion(regions,clabels,testlog):
 	return regions,clabels,gpolygons,testlog
 	
 
-def getRealLabeledMeanStdev(image,labeled_image,indices,info):
-	print "Getting real mean and stdev"
-	mean=nd.mean(image,labels=labeled_image,index=indices)
-	stdev=nd.standard_deviation(image,labels=labeled_image,index=indices)
-	ll=0
-	try:
-		len(mean)
-	except:
-		mean=[mean]
-		stdev=[stdev]
-		try:
-			len(indices)
-		except:
-			indices=[indices]
-	try:
-		info.keys()
-	except:
-		offset=1
-	else:
-		offset=0
-	for l in indices:
-		info[l-offset][1]=mean[ll]
-		info[l-offset][2]=stdev[ll]
-		ll += 1
-	return info
-	
-def getRealLabeledPerimeter(image,edge_mask,labeled_image,indices,info,testlog):
-	print "Getting real perimeter length"
+def getRealLabeledStats(image,edge_mask,labeled_image,indices,testlog):
+	'''
+	Area, mean, stdev, perimeter and center of the labeled regions with
+	bincount reductions over all pixels at once.  Returns a list of
+	[area,avg,stdev,length,center] in the order of indices.
+	'''
+	print "Getting real area, mean, stdev, perimeter and center"
 	edgeimage,testlog=findEdgeSobel(edge_mask,0,0.5,1.0,False,testlog)
-	mask=ma.getmask(edgeimage)
-	length=nd.sum(mask,labels=labeled_image,index=indices)
-		
-	ll=0
-	try:
-		len(length)
-	except:
-		length=[length]
-		try:
-			len(indices)
-		except:
-			indices=[indices]
-	try:
-		info.keys()
-	except:
-		offset=1
-	else:
-		offset=0
-	for l in indices:
-		info[l-offset][3]=length[ll]
-		ll += 1
-	return info	
-
-def getRealLabeledAreaCenter(image,labeled_image,indices,info):
-	print "Getting real area and center"
-	shape=numpy.shape(image)
-	ones=numpy.ones(shape)
-	area=nd.sum(ones,labels=labeled_image,index=indices)
-	center=nd.center_of_mass(ones,labels=labeled_image,index=indices)
-
-	ll=0
-	try:
-		len(area)
-	except:
-		area=[area]
-		center=[center]
-		try:
-			len(indices)
-		except:
-			indices=[indices]
-	try:
-		info.keys()
-	except:
-		offset=1
-	else:
-		offset=0
+	edges=ma.getmaskarray(edgeimage).ravel()
+	labels=numpy.ravel(labeled_image).astype(numpy.intp)
+	# negative labels are not regions, count them with the background
+	labels=numpy.maximum(labels,0)
+	nbins=max(labels.max(),max(indices))+1
+	values=numpy.ravel(image).astype(numpy.float64)
+	rows,cols=numpy.indices(labeled_image.shape)
+	area=numpy.bincount(labels,minlength=nbins).astype(numpy.float64)
+	n=numpy.where(area>0,area,1)
+	mean=numpy.bincount(labels,weights=values,minlength=nbins)/n
+	diff=values-mean[labels]
+	stdev=numpy.sqrt(numpy.bincount(labels,weights=diff*diff,minlength=nbins)/n)
+	length=numpy.bincount(labels[edges],minlength=nbins)
+	centerrow=numpy.bincount(labels,weights=rows.ravel(),minlength=nbins)/n
+	centercol=numpy.bincount(labels,weights=cols.ravel(),minlength=nbins)/n
+	stats=[]
 	for l in indices:
-		info[l-offset][0]=area[ll]
-		info[l-offset][4]=center[ll]
-		ll += 1
-	return info	
+		stats.append([area[l],mean[l],stdev[l],length[l],(centerrow[l],centercol[l])])
+	return stats,testlog
 
 def makeDefaultInfo(ltotal):
 	info={}
@@ -343,12 +303,24 @@ def getLabeledInfo(image,alledgemask,labeled_image,indices,fast,info,testlog):
 
 	imageshape=numpy.shape(labeled_image)
 	if not fast:
+		# info items to fill: area and center, mean and stdev, perimeter
+		need=[]
 		if (info[1-offset][3] is None):
-			info=getRealLabeledPerimeter(image,alledgemask,labeled_image,indices,info,testlog)
+			need.append((3,))
 		if (info[1-offset][1] is None):
-			info=getRealLabeledMeanStdev(image,labeled_image,indices,info)
+			need.append((1,2))
 		if (info[1-offset][0] is None):
-			info=getRealLabeledAreaCenter(image,labeled_image,indices,info)
+			need.append((0,4))
+		if need:
+			try:
+				len(indices)
+			except:
+				indices=[indices]
+			stats,testlog=getRealLabeledStats(image,alledgemask,labeled_image,indices,testlog)
+			for l,stat in zip(indices,stats):
+				for items in need:
+					for i in items:
+						info[l-offset][i]=stat[i]
 	else:
 		objs = nd.find_objects(labeled_image)
 		for l in indices:
@@ -379,6 +351,7 @@ def getPolygonInfo(polygons,info,testlog):
 		
 def pruneByLength(info,length_min,length_max,goodregions_in):
 	print "pruning by edge length"
+	goodregions_in=set(goodregions_in)
 	goodregions=[]
 	for l in range(1,len(info)+1):
 		length=info[l][3]
@@ -391,6 +364,7 @@ def pruneByLength(info,length_min,length_max,goodregions_in):
 
 def pruneByArea(info,area_min,area_max,goodregions_in):
 	print "pruning by area"
+	goodregions_in=set(goodregions_in)
 	goodregions=[]
 	for l in range(1,len(info)+1):
 		area=info[l][0]
@@ -402,6 +376,7 @@ def pruneByArea(info,area_min,area_max,goodregions_in):
 
 def pruneByStdev(info,stdev_min,goodregions_in):
 	print "pruning by stdev"
+	goodregions_in=set(goodregions_in)
 	goodregions=[]
 	for l in range(1,len(info)+1):
 		stdev=info[l][2]
@@ -426,7 +401,7 @@ def makePrunedLabels(labeled_image,ltotal,info,goodlabels):
 def makeImageFromLabels(labeled_image,ltotal,goodlabels):
 	# goodlabels starts from 0
 	imageshape=numpy.shape(labeled_image)
-	new_labeled_image=numpy.zeros(imageshape,numpy.int8)
+	new_labeled_image=numpy.zeros(imageshape,numpy.int32)
 	if len(goodlabels)==0:
 		return new_labeled_image
 	else:
@@ -436,19 +411,22 @@ def makeImageFromLabels(labeled_image,ltotal,goodlabels):
 		if len(goodlabels)>ltotal:
 			apDisplay.printWarning('There are more regions to keep than the number of regions.  Assuming want all!')
 			return labeled_image
+	# lookup table from old label to new label, applied to all pixels at once
+	lutsize=max(labeled_image.max(),ltotal)+1
 	if len(goodlabels)*2 < ltotal:
+		# int32 like nd.label, so thousands of regions keep their labels
+		lut=numpy.zeros(lutsize,numpy.int32)
 		for i,l1 in enumerate(goodlabels):
-			l=l1+1
-			region=numpy.where(labeled_image==l,1,0)
-			numpy.putmask(new_labeled_image,region,i+1)
+			lut[l1+1]=i+1
+		new_labeled_image=lut[numpy.maximum(labeled_image,0)]
 	else:
 		tmp_labeled_image=labeled_image
 		badset=set(range(ltotal))
 		badset=badset.difference(set(goodlabels))
-		for i,l1 in enumerate(badset):
-			l=l1+1
-			region=numpy.where(labeled_image==l,1,0)
-			numpy.putmask(tmp_labeled_image,region,0)
+		isbad=numpy.zeros(lutsize,numpy.bool)
+		for l1 in badset:
+			isbad[l1+1]=True
+		numpy.putmask(tmp_labeled_image,isbad[numpy.maximum(labeled_image,0)],0)
 		new_labeled_image,resultlabels = nd.label(tmp_labeled_image)
 	return new_labeled_image
 	
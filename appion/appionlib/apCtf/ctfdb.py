@@ -5,6 +5,7 @@ import os
 import re
 import sys
 import math
+import time
 import shutil
 #appion
 from appionlib import apParam
@@ -175,9 +176,10 @@ def getSortValueFromCtfQuery(ctfvalue, sortType):
 	return None
 
 #=====================
-def getBestCtfValue(imgdata, sortType='res80', method=None, msg=True):
+def queryCtfValues(imgdata):
 	"""
-	takes an image and get the best ctfvalues for that image
+	query the ctf values of an image and its sister images from frame
+	alignment, returns the list of images and the list of ctf values
 	"""
 	imglist = []
 
@@ -204,6 +206,151 @@ def getBestCtfValue(imgdata, sortType='res80', method=None, msg=True):
 		ctfq = appiondata.ApCtfData()
 		ctfq['image'] = img
 		ctfvalues.extend(ctfq.query())
+	return imglist, ctfvalues
+
+#=====================
+class SessionCtfIndex(object):
+	"""
+	All ctf values and frame alignment pairs of a session, loaded with one
+	query per ctf run and per frame alignment run, so that looking up the
+	ctf values of an image needs no query.
+
+	Other processes insert ctf values while the session is processed, so
+	images with no ctf values yet are queried again on every lookup and
+	only kept once they have values.  New values of an image that already
+	has some come from a new ctf run, so the index is loaded again when
+	the session has a newer ctf run than when it was loaded.
+	"""
+	def __init__(self, sessiondata):
+		self.sessiondata = sessiondata
+		self.load()
+
+	#=====================
+	def load(self):
+		### image dbid -> list of ctf values, newest first like query()
+		self.ctfvalues = {}
+		### aligned image dbid -> source image dbid
+		self.sources = {}
+		### source image dbid -> aligned image dbids, newest first
+		self.results = {}
+		ctfrunq = appiondata.ApAceRunData()
+		ctfrunq['session'] = self.sessiondata
+		ctfrundatas = ctfrunq.query()
+		self.lastrunid = max([ctfrundata.dbid for ctfrundata in ctfrundatas] or [None])
+		self.lastcheck = time.time()
+		for ctfrundata in ctfrundatas:
+			ctfq = appiondata.ApCtfData()
+			ctfq['acerun'] = ctfrundata
+			for ctfvalue in ctfq.query():
+				imageid = ctfvalue.special_getitem('image', dereference=False).dbid
+				self.ctfvalues.setdefault(imageid, []).append(ctfvalue)
+		for values in self.ctfvalues.values():
+			values.sort(key=lambda ctfvalue: ctfvalue.dbid, reverse=True)
+
+		ddstackrunq = appiondata.ApDDStackRunData()
+		ddstackrunq['session'] = self.sessiondata
+		pairs = []
+		for ddstackrundata in ddstackrunq.query():
+			pairq = appiondata.ApDDAlignImagePairData()
+			pairq['ddstackrun'] = ddstackrundata
+			pairs.extend(pairq.query())
+		pairs.sort(key=lambda pairdata: pairdata.dbid, reverse=True)
+		for pairdata in pairs:
+			sourceid = pairdata.special_getitem('source', dereference=False).dbid
+			resultid = pairdata.special_getitem('result', dereference=False).dbid
+			self.sources.setdefault(resultid, sourceid)
+			self.results.setdefault(sourceid, []).append(resultid)
+
+	#=====================
+	def hasNewCtfRun(self):
+		"""
+		check, at most every ctfindex_check_interval seconds, if a ctf run
+		was added to the session since the index was loaded
+		"""
+		if time.time() - self.lastcheck < ctfindex_check_interval:
+			return False
+		self.lastcheck = time.time()
+		ctfrunq = appiondata.ApAceRunData()
+		ctfrunq['session'] = self.sessiondata
+		ctfrundatas = ctfrunq.query(results=1)
+		if not ctfrundatas:
+			return False
+		return ctfrundatas[0].dbid != self.lastrunid
+
+	#=====================
+	def getImageIds(self, imgdata):
+		"""
+		dbids of the image and its sister images, as in queryCtfValues()
+		"""
+		if not imgdata['camera']['align frames']:
+			return [imgdata.dbid]
+		sourceid = self.sources.get(imgdata.dbid)
+		if sourceid is None:
+			return [imgdata.dbid]
+		return [sourceid] + self.results.get(sourceid, [])
+
+	#=====================
+	def getCtfValues(self, imgdata):
+		if self.hasNewCtfRun():
+			self.load()
+		imageids = self.getImageIds(imgdata)
+		if all(imageid in self.ctfvalues for imageid in imageids):
+			ctfvalues = []
+			for imageid in imageids:
+				ctfvalues.extend(self.ctfvalues[imageid])
+			if ctfvalues:
+				return ctfvalues
+		### not in the index or no values yet, query again
+		imglist, ctfvalues = queryCtfValues(imgdata)
+		if not ctfvalues:
+			### not kept, another process may insert them later
+			return ctfvalues
+		for img in imglist:
+			self.ctfvalues[img.dbid] = []
+		for ctfvalue in ctfvalues:
+			imageid = ctfvalue.special_getitem('image', dereference=False).dbid
+			self.ctfvalues[imageid].append(ctfvalue)
+		if len(imglist) > 1 or imglist[0].dbid != imgdata.dbid:
+			sourceid = imglist[0].dbid
+			self.sources[imgdata.dbid] = sourceid
+			self.results[sourceid] = [img.dbid for img in imglist[1:]]
+		return ctfvalues
+
+	#=====================
+	def invalidateImage(self, imgdata):
+		"""
+		forget the ctf values of an image, so they are queried again
+		"""
+		self.ctfvalues.pop(imgdata.dbid, None)
+
+### session dbid -> SessionCtfIndex
+ctfindexes = {}
+### seconds between checks of a session for new ctf runs
+ctfindex_check_interval = 60.0
+
+#=====================
+def getSessionCtfIndex(sessiondata):
+	sessionid = sessiondata.dbid
+	if sessionid not in ctfindexes:
+		ctfindexes[sessionid] = SessionCtfIndex(sessiondata)
+	return ctfindexes[sessionid]
+
+#=====================
+def invalidateCtfIndex(imgdata):
+	"""
+	call after inserting ctf values of an image
+	"""
+	sessionref = imgdata.special_getitem('session', dereference=False)
+	ctfindex = ctfindexes.get(sessionref.dbid)
+	if ctfindex is not None:
+		ctfindex.invalidateImage(imgdata)
+
+#=====================
+def getBestCtfValue(imgdata, sortType='res80', method=None, msg=True):
+	"""
+	takes an image and get the best ctfvalues for that image
+	"""
+	ctfvalues = getSessionCtfIndex(imgdata['session']).getCtfValues(imgdata)
 
 	imgname = apDisplay.short(imgdata['filename'])
 
@@ -74,6 +74,7 @@ def validateAndInsertCTFData(imgdata, ctfvalues, rundata, rundir, fftpath=None,
 			apDisplay.printMsg("SKIPPING %s :: %s"%(key, ctfvalues.get(key, '')))
 	ctfdb.printCtfData(ctfq)
 	ctfq.insert()
+	ctfdb.invalidateCtfIndex(imgdata)
 
 	return
 
@@ -3,6 +3,8 @@
 import sys
 import math
 import time
+import atexit
+import multiprocessing
 import numpy
 import scipy.optimize
 import scipy.ndimage
@@ -13,21 +15,144 @@ from appionlib import apDisplay
 import warnings
 warnings.simplefilter('ignore', numpy.RankWarning)
 
+### number of processes for the initial fits of each noise model,
+### None for one per cpu, 1 to run them in this process
+nproc = None
+### number of recent best fits of each constraint that a CtfNoise
+### tries as starting points of its next noise model
+numrecentfits = 8
+
+#============
+def getNumProcesses():
+	if nproc is not None:
+		return nproc
+	try:
+		return multiprocessing.cpu_count()
+	except NotImplementedError:
+		return 1
+
+#============
+pool = None
+def getPool():
+	"""
+	one pool of worker processes kept for all noise fits, None if
+	the fits should run in this process
+	"""
+	global pool
+	numproc = getNumProcesses()
+	### daemon processes, such as pool workers, cannot start their own
+	if numproc < 2 or multiprocessing.current_process().daemon:
+		return None
+	if pool is None:
+		pool = multiprocessing.Pool(numproc)
+	return pool
+
+#============
+def closePool():
+	"""
+	stop the worker processes of getPool, called at exit
+	"""
+	global pool
+	if pool is not None:
+		pool.close()
+		pool.join()
+		pool = None
+atexit.register(closePool)
+
+#============
+def runInitialFit(task):
+	"""
+	run one of the fits of getAllInitialParameters, in a worker process
+	"""
+	methodname, xdata, ctfdata, constraintname, kwargs, debug = task
+	ctfnoise = CtfNoise()
+	ctfnoise.debug = debug
+	method = getattr(ctfnoise, methodname)
+	return method(xdata, ctfdata, getattr(ctfnoise, constraintname), **kwargs)
+
+#============
+class LinearModelFit(object):
+	"""
+	All the noise models are linear in their parameters, so the model
+	is a matrix product with the columns of A + B*sqrt(x) + C*x + D*x^2
+	+ E*x^3 they use, computed once per fit instead of every time the
+	minimizer evaluates the model.  The model of the last parameters is
+	kept, because fmin_cobyla evaluates the fit function and then the
+	constraint of the same parameters.
+	"""
+	columns = {
+		'noiseModel': (0, 1, 2, 3, 4),
+		'noiseModelNoSquare': (0, 1, 2),
+		'noiseModelOnlyLinear': (0, 2),
+		'noiseModelOnlySqrt': (0, 1),
+		'noiseModelBFactor': (0, 3),
+	}
+
+	def __init__(self, xdata, ctfdata, modelname='noiseModel', trimdata=True):
+		self.ctfdata = ctfdata
+		self.trimdata = trimdata
+		basis = (numpy.ones(xdata.shape, xdata.dtype), numpy.sqrt(xdata), xdata,
+			numpy.power(xdata, 2.0), numpy.power(xdata, 3.0))
+		self.basis = numpy.column_stack([basis[i] for i in self.columns[modelname]])
+		self.lastparams = None
+		self.lastfitx = None
+
+	def model(self, fitparams):
+		### same precision as xdata, like the noise models, which
+		### keeps the minimizer from chasing insignificant digits
+		fitparams = numpy.asarray(fitparams, dtype=self.basis.dtype)
+		key = fitparams.tostring()
+		if key != self.lastparams:
+			self.lastfitx = numpy.dot(self.basis, fitparams)
+			self.lastparams = key
+		return self.lastfitx
+
+	def fitFun(self, fitparams):
+		"""
+		same as CtfNoise.modelFitFun
+		"""
+		fitfunc = numpy.abs(self.ctfdata - self.model(fitparams))
+		if self.trimdata is True:
+			fitfunc = numpy.minimum(fitfunc, fitfunc.mean())
+		return fitfunc.sum()
+
+	def constFunAbove(self, fitparams):
+		"""
+		same as CtfNoise.modelConstFunAbove
+		"""
+		return (self.model(fitparams) - self.ctfdata).min()
+
+	def constFunBelow(self, fitparams):
+		"""
+		same as CtfNoise.modelConstFunBelow
+		"""
+		return (self.ctfdata - self.model(fitparams)).min()
+
+	def constFun(self, contraintFunction):
+		"""
+		the constraint of this fit matching the CtfNoise constraint
+		"""
+		if contraintFunction.__name__ == 'modelConstFunAbove':
+			return self.constFunAbove
+		return self.constFunBelow
+
 class CtfNoise(object):
 
 	#============
 	def __init__(self):
 		self.debug = False
+		### best fits of the noise models of this CtfNoise by constraint,
+		### most recent last, so they do not carry over to other images
+		self.recentfits = {}
 
 	#============
 	def runMinimization(self, xdata, ctfdata, initfitparams, noiseModel, contraintFunction, maxfun=1e4):
 		"""
 		run a minimization
 		"""
-
-		refinefitparams = scipy.optimize.fmin_cobyla( self.modelFitFun, initfitparams,
-			args=(xdata, ctfdata, noiseModel), cons=[contraintFunction,],
-			consargs=(xdata, ctfdata, noiseModel), maxfun=maxfun)
+		fit = LinearModelFit(xdata, ctfdata, noiseModel.__name__)
+		refinefitparams = scipy.optimize.fmin_cobyla( fit.fitFun, initfitparams,
+			cons=[fit.constFun(contraintFunction),], maxfun=maxfun)
 
 		return refinefitparams
 
@@ -407,52 +532,49 @@ class CtfNoise(object):
 
 	#============
 	def getAllInitialParameters(self, xdata, ctfdata, contraintFunction):
+		"""
+		Fit each of the initial noise models.  The fits are independent,
+		so they run at the same time in the worker processes of getPool.
+		"""
 		namelist = [] #list of fit names
 		valuelist = [] #list of fit square error values
 		fitparamslist = [] #list of numpy array corresponding to param values
 
-		fitparams, value = self.fitNoSquare(xdata, ctfdata, contraintFunction)
-		namelist.append("no square")
-		valuelist.append(value)
-		fitparamslist.append(fitparams)
-
-		fitparams, value = self.fitLinear(xdata, ctfdata, contraintFunction)
-		namelist.append("linear")
-		valuelist.append(value)
-		fitparamslist.append(fitparams)
-
-		fitparams, value = self.fitOnlySqrt(xdata, ctfdata, contraintFunction)
-		namelist.append("only sqrt")
-		valuelist.append(value)
-		fitparamslist.append(fitparams)
+		### (name, fit method, keyword arguments, skip if the fit fails)
+		fitlist = [
+			("no square", "fitNoSquare", {}, False),
+			("linear", "fitLinear", {}, False),
+			("only sqrt", "fitOnlySqrt", {}, False),
+			("b factor", "fitBFactor", {}, False),
+		]
+		for cutoffper in numpy.arange(0.1, 0.99, 0.1):
+			fitlist.append(("two slope %d"%(cutoffper*100), "fitTwoSlopeFunction", {'cutoffper': cutoffper}, True))
+		## does a bad job
+		fitlist.append(("two slope sq 2/5", "fitTwoSlopeSquareFunction", {'cutoffper': 1/5.}, True))
+		## does a bad job
+		fitlist.append(("full function", "fitFullFunction", {}, False))
 
-		fitparams, value = self.fitBFactor(xdata, ctfdata, contraintFunction)
-		namelist.append("b factor")
-		valuelist.append(value)
-		fitparamslist.append(fitparams)
+		tasks = [(methodname, xdata, ctfdata, contraintFunction.__name__, kwargs, self.debug)
+			for name, methodname, kwargs, skipfailed in fitlist]
+		workers = getPool()
+		if workers is None:
+			results = map(runInitialFit, tasks)
+		else:
+			results = workers.map(runInitialFit, tasks)
 
-		for cutoffper in numpy.arange(0.1, 0.99, 0.1):
-			fitparams, value = self.fitTwoSlopeFunction(xdata, ctfdata,
-				contraintFunction, cutoffper=cutoffper)
-			if fitparams is None:
+		for (name, methodname, kwargs, skipfailed), (fitparams, value) in zip(fitlist, results):
+			if skipfailed and fitparams is None:
 				continue
-			namelist.append("two slope %d"%(cutoffper*100))
+			namelist.append(name)
 			valuelist.append(value)
 			fitparamslist.append(fitparams)
 
-		## does a bad job
-		fitparams, value = self.fitTwoSlopeSquareFunction(xdata, ctfdata, contraintFunction, cutoffper=1/5.)
-		if fitparams is not None:
-			namelist.append("two slope sq 2/5")
-			valuelist.append(value)
+		### warm start from the best fits of the recent noise models
+		for i, fitparams in enumerate(self.recentfits.get(contraintFunction.__name__, [])):
+			namelist.append("recent fit %d"%(i+1))
+			valuelist.append(self.modelFitFun(fitparams, xdata, ctfdata))
 			fitparamslist.append(fitparams)
 
-		## does a bad job
-		fitparams, value = self.fitFullFunction(xdata, ctfdata, contraintFunction)
-		namelist.append("full function")
-		valuelist.append(value)
-		fitparamslist.append(fitparams)
-
 		return namelist, valuelist, fitparamslist
 
 	#============
@@ -629,9 +751,10 @@ class CtfNoise(object):
 		### run the full minimization
 		rhobeg = (numpy.where(numpy.abs(midfitparams)<1e-20, 1e20, numpy.abs(midfitparams))).min()/1e7
 		if self.debug: print "RHO begin", rhobeg
-		fitparams = scipy.optimize.fmin_cobyla( self.modelFitFun, midfitparams,
-			args=(xdata, ctfdata), cons=[contraintFunction,],
-			consargs=(xdata, ctfdata), rhobeg=rhobeg, rhoend=rhobeg/1e4, maxfun=1e6)
+		fit = LinearModelFit(xdata, ctfdata)
+		fitparams = scipy.optimize.fmin_cobyla( fit.fitFun, midfitparams,
+			cons=[fit.constFun(contraintFunction),],
+			rhobeg=rhobeg, rhoend=rhobeg/1e4, maxfun=1e6)
 		if self.debug is True:
 			print ( "final parameters (%.4e, %.4e, %.4e, %.4e, %.4e)"
 				%(fitparams[0], fitparams[1], fitparams[2], fitparams[3], fitparams[4]))
@@ -649,6 +772,10 @@ class CtfNoise(object):
 				apDisplay.printColor("Final value is worse", "red")
 			bestfitparams = midfitparams
 
+		fits = self.recentfits.setdefault(contraintFunction.__name__, [])
+		fits.append(numpy.array(bestfitparams, dtype=numpy.float64))
+		del fits[:-numrecentfits]
+
 		z = numpy.polyfit(xdata, filterctfdata, 3)
 		polyfitparams = [z[3], 0.0, z[2], z[1], z[0]]
 
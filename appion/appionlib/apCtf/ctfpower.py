@@ -96,7 +96,9 @@ def powerseries(image, pixelsize, fieldsize=None, mask_radius=0.5, msg=True):
 		sys.stderr.write("Computing power spectra in %dx%d blocks"%(fieldsize,fieldsize))
 	if debug is True:
 		print ""
+	### one batched fft per row of subfields
 	for i in range(xnumstep):
+		cutouts = []
 		for j in range(ynumstep):
 			count += 1
 			x1 = int(f*i/2)
@@ -112,8 +114,10 @@ def powerseries(image, pixelsize, fieldsize=None, mask_radius=0.5, msg=True):
 			elif msg is True:
 				sys.stderr.write(".")
 			cutout = image[x1:x2, y1:y2]
-			powerspec = imagefun.power(cutout*envelop, mask_radius)
-			psdlist.append(powerspec)
+			cutouts.append(cutout*envelop)
+		if cutouts:
+			psdlist.extend(imagefun.power_stack(numpy.array(cutouts), mask_radius))
+	cutouts = []
 	if xsize%fieldsize > fieldsize*0.1:
 		for j in range(ynumstep):
 			count += 1
@@ -128,8 +132,7 @@ def powerseries(image, pixelsize, fieldsize=None, mask_radius=0.5, msg=True):
 			elif msg is True:
 				sys.stderr.write(".")
 			cutout = image[x1:x2, y1:y2]
-			powerspec = imagefun.power(cutout*envelop, mask_radius)
-			psdlist.append(powerspec)
+			cutouts.append(cutout*envelop)
 	if ysize%fieldsize > fieldsize*0.1:
 		for i in range(xnumstep):
 			count += 1
@@ -144,10 +147,11 @@ def powerseries(image, pixelsize, fieldsize=None, mask_radius=0.5, msg=True):
 			elif msg is True:
 				sys.stderr.write(".")
 			cutout = image[x1:x2, y1:y2]
-			powerspec = imagefun.power(cutout*envelop, mask_radius)
-			psdlist.append(powerspec)
+			cutouts.append(cutout*envelop)
+	if cutouts:
+		psdlist.extend(imagefun.power_stack(numpy.array(cutouts), mask_radius))
 	sys.stderr.write("\n")
-	freq = 1.0/(powerspec.shape[0]*pixelsize)
+	freq = 1.0/(psdlist[-1].shape[0]*pixelsize)
 	if msg is True:
 		apDisplay.printMsg("Compute PSD with %d subfields and fieldsize %d complete in %s"
 			%(count, fieldsize, apDisplay.timeString(time.time()-t0)))
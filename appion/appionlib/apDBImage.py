@@ -1,6 +1,9 @@
 #!/usr/bin/env python
 import os
 from leginon import leginondata
+from pyami import mrc
+import sinedon.newdict as newdict
+from sinedon import imagewriter
 #appion
 from appionlib import appiondata, apDatabase, apDisplay
 from leginon import correctorclient
@@ -91,6 +94,34 @@ def makeAlignedImageData(old_imagedata,new_camdata,new_array,alignlabel='a'):
 		imagedata['filename'] = makeUniqueImageFilename(imagedata,old_name,align_presetdata['name'])
 		return imagedata
 
+def makeAlignedImageDataFromFile(old_imagedata,new_camdata,mrcpath,alignlabel='a'):
+		'''
+		Prepare ImageData to be uploaded after alignment from the aligned
+		sum MRC file without reading it.  The header stats are updated
+		in place and the file is hard linked (or copied) into the session
+		image path when the ImageData is inserted.  mrcpath is left in place.
+		'''
+		mrcpath = os.path.abspath(mrcpath)
+		checkAlignedImageFile(mrcpath)
+		mrc.updateFileStats(mrcpath)
+		image_ref = newdict.FileReference(os.path.basename(mrcpath), imagewriter.read)
+		image_ref.setPath(os.path.dirname(mrcpath))
+		image_ref.ingest = True
+		return makeAlignedImageData(old_imagedata,new_camdata,image_ref,alignlabel)
+
+def checkAlignedImageFile(mrcpath):
+		'''
+		Check that mrcpath is a complete single image MRC file.
+		'''
+		if not os.path.isfile(mrcpath):
+			apDisplay.printError('Aligned image %s not found' % mrcpath)
+		header = mrc.readHeaderFromFile(mrcpath)
+		if header['nz'] != 1 or header['mode'] not in (0,1,2,6):
+			apDisplay.printError('Aligned image %s is not a single real image' % mrcpath)
+		expected = mrc.getHeaderBytesFromFile(mrcpath) + header['nx'] * header['ny'] * header['dtype'].itemsize
+		if os.path.getsize(mrcpath) < expected:
+			apDisplay.printError('Aligned image %s is truncated' % mrcpath)
+
 def getAlignedSiblings(fromimage):
 		'''
 		Get other aligned images from the same source as the input imagedata.
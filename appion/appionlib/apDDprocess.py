@@ -1406,16 +1406,14 @@ class DDFrameProcessing(DirectDetectorProcessing):
 		Prepare ImageData to be uploaded after alignment
 		'''
 		camdata = self.getAlignedCameraEMData()
-		new_array = mrc.read(self.aligned_sumpath)
-		return apDBImage.makeAlignedImageData(self.image,camdata,new_array,alignlabel)
+		return apDBImage.makeAlignedImageDataFromFile(self.image,camdata,self.aligned_sumpath,alignlabel)
 
 	def makeAlignedDWImageData(self,alignlabel='a-DW'):
 		'''
 		Prepare ImageData to be uploaded after alignment
 		'''
 		camdata = self.getAlignedCameraEMData()
-		new_array = mrc.read(self.aligned_dw_sumpath)
-		return apDBImage.makeAlignedImageData(self.image,camdata,new_array,alignlabel)
+		return apDBImage.makeAlignedImageDataFromFile(self.image,camdata,self.aligned_dw_sumpath,alignlabel)
 
 	def getAlignBin(self):
 		alignbin = self.getNewBinning()
@@ -12,7 +12,7 @@ from appionlib import apDisplay
 from appionlib import apFile
 from appionlib.apImage import imagenorm
 ## pyami
-from pyami import mrc, imagefun, spider
+from pyami import mrc, imagefun, spider, preview
 
 ####
 # This is a low-level file with NO database connections
@@ -191,15 +191,16 @@ def arrayToJpeg(numer, filename, normalize=True, msg=True, quality=85):
 	"""
 	takes a numpy and writes a JPEG
 	best for micrographs and photographs
+	in AppionLoop the file is encoded in the background, see pyami.preview
 	"""
 	if normalize:
-		numer = imagenorm.maxNormalizeImage(numer)
+		numer = imagenorm.maxNormalizeImage(numer, nsamples=preview.maxsamples)
 	else:
 		numer = numer*255
 	image = _arrayToImage(numer)
 	if msg is True:
 		apDisplay.printMsg("writing JPEG: "+apDisplay.short(filename))
-	image.save(filename, "JPEG", quality=quality)
+	preview.save(image, filename, "JPEG", quality=quality)
 	return
 
 #=========================
@@ -207,15 +208,16 @@ def arrayToPng(numer, filename, normalize=True, msg=True):
 	"""
 	takes a numpy and writes a PNG
 	best for masks and line art
+	in AppionLoop the file is encoded in the background, see pyami.preview
 	"""
 	if normalize:
-		numer = imagenorm.maxNormalizeImage(numer)
+		numer = imagenorm.maxNormalizeImage(numer, nsamples=preview.maxsamples)
 	else:
 		numer = numer*255
 	image = _arrayToImage(numer)
 	if msg is True:
 		apDisplay.printMsg("writing PNG: "+apDisplay.short(filename))
-	image.save(filename, "PNG")
+	preview.save(image, filename, "PNG")
 	return
 
 #=========================
@@ -244,7 +246,7 @@ def arrayMaskToPngAlpha(numer,filename, msg=True):
 	image.putalpha(alphachannel)
 	if msg is True:
 		apDisplay.printMsg("writing alpha channel PNG mask: "+apDisplay.short(filename))
-	image.save(filename, "PNG")
+	preview.save(image, filename, "PNG")
 	return
 
 #=========================
@@ -271,7 +273,7 @@ def arrayToJpegPlusPeak(numer, outfile, peak=None, normalize=True):
 	best for micrographs and photographs
 	"""
 	if normalize:
-		numer = imagenorm.maxNormalizeImage(numer)
+		numer = imagenorm.maxNormalizeImage(numer, nsamples=preview.maxsamples)
 	else:
 		numer = numer*255
 	image = _arrayToImage(numer)
@@ -288,7 +290,7 @@ def arrayToJpegPlusPeak(numer, outfile, peak=None, normalize=True):
 		drawPeak(peak2, draw, numer.shape)
 
 	print " ... writing JPEG: ",outfile
-	image.save(outfile, "JPEG", quality=85)
+	preview.save(image, outfile, "JPEG", quality=85)
 
 	return
 
@@ -334,6 +336,7 @@ def readMRC(filename):
 
 #=========================
 def readJPG(filename):
+	preview.wait(filename)
 	i = Image.open(filename)
 	i.load()
 	i = imageToArray(i)
@@ -341,6 +344,7 @@ def readJPG(filename):
 
 #=========================
 def readPNG(filename):
+	preview.wait(filename)
 	i = Image.open(filename)
 	i.load()
 	i = imageToArray(i)
@@ -10,6 +10,7 @@ from appionlib import apDisplay
 from appionlib.apSpider import filters
 ## pyami
 from pyami import imagefun, fftengine
+import pyami.fft.engine
  
 ffteng = fftengine.fftEngine()
 
@@ -35,7 +36,7 @@ def binImg(imgarray, bin=1, warn=True):
 		newshape = numpy.asarray(oldshape)/bin
 	tmpshape = (newshape[0], bin, newshape[1], bin)
 	f = bin * bin
-	binned = numpy.sum(numpy.sum(numpy.reshape(imgarray, tmpshape), 1), 2) / f
+	binned = numpy.reshape(imgarray, tmpshape).sum(axis=(1,3)) / f
 	return binned
 
 #=========================
@@ -203,40 +204,51 @@ def _center_mask(a, zero_radius,one_radius):
 	circ = _gradient(cs_shape,zero_radius)
 	center_square[:] = center_square * circ.astype(center_square.dtype)
 
+#=========================
+planeCache = {}
+def planeGrids(shape):
+	"""
+	x and y index vectors scaled to -0.5 to 0.5 and the normal matrix
+	of the plane regression, which only depend on the image shape
+	"""
+	try:
+		return planeCache[shape]
+	except KeyError:
+		pass
+	ysize, xsize = shape
+	xvec = numpy.arange(xsize, dtype=numpy.float32)/(xsize-1.0) - 0.5
+	yvec = numpy.arange(ysize, dtype=numpy.float32)/(ysize-1.0) - 0.5
+
+	### sums over the image of the x and y index arrays
+	count = float(xsize*ysize)
+	xsum = ysize*xvec.sum(dtype=numpy.float64)
+	xsumsq = ysize*(xvec**2).sum(dtype=numpy.float64)
+	ysum = xsize*yvec.sum(dtype=numpy.float64)
+	ysumsq = xsize*(yvec**2).sum(dtype=numpy.float64)
+	xysum = xvec.sum(dtype=numpy.float64)*yvec.sum(dtype=numpy.float64)
+	leftmat = numpy.array( [[xsumsq, xysum, xsum], [xysum, ysumsq, ysum], [xsum, ysum, count]], dtype=numpy.float64)
+
+	planeCache[shape] = xvec, yvec, leftmat
+	return xvec, yvec, leftmat
+
 #=========================
 def planeRegression(imgarray, msg=True):
 	"""
 	performs a two-dimensional linear regression and subtracts it from an image
 	essentially a fast high pass filter
 	z' = a*x + b*y + c
-	"""
 
-	### create index arrays, e.g., [1, 2, 3, 4, 5, ..., N]
-	def retx(y,x):
-		return x
-	def rety(y,x):
-		return y
-	xarray = numpy.fromfunction(retx, imgarray.shape, dtype=numpy.float32)
-	yarray = numpy.fromfunction(rety, imgarray.shape, dtype=numpy.float32)
-	xsize = imgarray.shape[0]
-	ysize = imgarray.shape[1]
-	xarray = xarray/(ysize-1.0) - 0.5
-	yarray = yarray/(xsize-1.0) - 0.5
+	the plane is separable, so the sums use the row and column sums of
+	the image and no full size index arrays are made
+	"""
+	xvec, yvec, leftmat = planeGrids(imgarray.shape)
 
 	### get running sums
-	count =  float(xsize*ysize)
-	xsum =   xarray.sum()
-	xsumsq = (xarray*xarray).sum()
-	ysum =   yarray.sum()
-	ysumsq = (yarray*yarray).sum()
-	xysum =  (xarray*yarray).sum()
-	xzsum =  (xarray*imgarray).sum()
-	yzsum =  (yarray*imgarray).sum()
-	zsum =   imgarray.sum()
-	#zsumsq = (imgarray*imgarray).sum()
+	xzsum = numpy.dot(imgarray.sum(axis=0, dtype=numpy.float64), xvec)
+	yzsum = numpy.dot(imgarray.sum(axis=1, dtype=numpy.float64), yvec)
+	zsum = imgarray.sum(dtype=numpy.float64)
 
 	### create linear algebra matrices
-	leftmat = numpy.array( [[xsumsq, xysum, xsum], [xysum, ysumsq, ysum], [xsum, ysum, count]], dtype=numpy.float64)
 	rightmat = numpy.array( [xzsum, yzsum, zsum], dtype=numpy.float64)
 
 	### solve eigen vectors
@@ -248,7 +260,8 @@ def planeRegression(imgarray, msg=True):
 			%(resvec[0], resvec[1], resvec[2]))
 
 	### subtract plane from array
-	newarray = imgarray - xarray*resvec[0] - yarray*resvec[1] - resvec[2]
+	newarray = imgarray - (xvec*resvec[0])[numpy.newaxis,:]
+	newarray -= (yvec*resvec[1] + resvec[2])[:,numpy.newaxis]
 	return newarray
 
 
@@ -397,13 +410,7 @@ def tanhHighPassFilter(data, radius, apix=1.0, bin=1):
 	if pixelradius < 1:
 		apDisplay.printWarning("pixel radius too small for high pass filter")
 		return data		
-	filter = tanhFilter(pixelradius, data.shape, fuzzyEdge=2)
-	fftdata = ffteng.transform(data)
-	fftdata = numpy.fft.fftshift(fftdata)
-	fftdata *= filter
-	fftdata = numpy.fft.fftshift(fftdata)
-	flipdata = numpy.real(numpy.fft.ifft2(fftdata))
-	return flipdata
+	return fourierFilter(data, highpass=radius, apix=apix, bin=bin)
 
 #=========================
 def tanhLowPassFilter(data, radius, apix=1.0, bin=1):
@@ -418,14 +425,79 @@ def tanhLowPassFilter(data, radius, apix=1.0, bin=1):
 	if pixelradius < 1:
 		apDisplay.printWarning("pixel radius too small for low pass filter")
 		return data	
-	#opposite of HP filter
-	filter = 1.0 - tanhFilter(pixelradius, data.shape, fuzzyEdge=2)
-	fftdata = ffteng.transform(data)
-	fftdata = numpy.fft.fftshift(fftdata)
-	fftdata *= filter
-	fftdata = numpy.fft.fftshift(fftdata)
-	flipdata = numpy.real(numpy.fft.ifft2(fftdata))
-	return flipdata
+	return fourierFilter(data, lowpass=radius, apix=apix, bin=bin)
+
+#=========================
+def fourierFilter(data, highpass=0.0, lowpass=0.0, apix=1.0, bin=1):
+	"""
+	tanh high pass and tanh low pass filters applied together
+	with one forward and one inverse real fft, i.e., a band pass filter
+
+	Note: radii are in real space units, 0 skips the filter
+	"""
+	hppixrad = highpass/apix/float(bin)
+	lppixrad = lowpass/apix/float(bin)
+	transfer = fourierTransfer(data.shape, hppixrad, lppixrad)
+	if transfer is None:
+		return data
+	eng = pyami.fft.engine.get_engine()
+	fftdata = eng.forward(data)
+	fftdata *= transfer
+	return eng.reverse(fftdata, data.shape)
+
+transferCache = {}
+
+#=========================
+def fourierTransfer(shape, hppixrad, lppixrad):
+	"""
+	transfer function of the filters of fourierFilter on the
+	real-to-complex half spectrum, cached by shape and filter radii
+	"""
+	shape = tuple(shape)
+	transferKey = (shape, round(hppixrad, 3), round(lppixrad, 3))
+	try:
+		return transferCache[transferKey]
+	except KeyError:
+		pass
+	transfer = None
+	if hppixrad > 0:
+		transfer = tanhTransfer(hppixrad, shape, fuzzyEdge=2)
+	if lppixrad > 0:
+		#opposite of HP filter
+		lowpass = 1.0 - tanhTransfer(lppixrad, shape, fuzzyEdge=2)
+		if transfer is None:
+			transfer = lowpass
+		else:
+			transfer *= lowpass
+	if transfer is not None:
+		transfer = transfer.astype(numpy.float32)
+	transferCache[transferKey] = transfer
+	return transfer
+
+#=========================
+def tanhTransfer(pixelradius, shape, fuzzyEdge=2):
+	"""
+	tanhFilter on the half spectrum in unshifted order
+
+	tanhFilter is centered half a pixel off the origin for even sizes,
+	so it is averaged with its mirror, which makes it Hermitian without
+	changing the real part of the filtered image
+	"""
+	rows = numpy.fft.fftfreq(shape[0], 1.0/shape[0])
+	cols = numpy.fft.fftfreq(shape[1], 1.0/shape[1])
+	halfcols = shape[1]//2 + 1
+	## half pixel offset of tanhFilter
+	rowoffset = 0.5*(1 - shape[0]%2)
+	coloffset = 0.5*(1 - shape[1]%2)
+	cut = 1.01*(max(shape))/float(pixelradius)/fuzzyEdge
+	transfer = numpy.zeros((shape[0], halfcols))
+	for sign in (1, -1):
+		## the mirror frequencies wrap around like the fft indices
+		mrows = rows[sign*numpy.arange(shape[0]) % shape[0]]
+		mcols = cols[sign*numpy.arange(halfcols) % shape[1]]
+		radial = numpy.hypot((mrows + rowoffset)[:,numpy.newaxis], (mcols + coloffset)[numpy.newaxis,:])
+		transfer += numpy.tanh(radial/fuzzyEdge - cut)/4.0 + 0.25
+	return transfer
 
 filterCache = {}
 
@@ -437,7 +509,7 @@ def tanhFilter(pixelradius, shape, fuzzyEdge=2):
 
 	fuzzyEdge makes the edge of the hyperbolic tangent more fuzzy
 	"""
-	filterKey = "%.3f-%d-%.3f"%(pixelradius, max(shape), fuzzyEdge)
+	filterKey = "%.3f-%d-%d-%.3f"%(pixelradius, shape[0], shape[1], fuzzyEdge)
 	try:
 		return filterCache[filterKey]
 	except KeyError:
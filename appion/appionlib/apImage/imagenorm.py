@@ -5,7 +5,7 @@ import math
 ## numpy
 import numpy
 import pyami.quietscipy
-from pyami import imagefun
+from pyami import imagefun, preview
 from scipy import ndimage
 ## appion
 from appionlib import apDisplay
@@ -105,12 +105,12 @@ def parabolicNorm(imgarray):
 	return edgeNorm(imgarray)
 
 #=========================
-def maxNormalizeImage(a, stdevLimit=3.0):
+def maxNormalizeImage(a, stdevLimit=3.0, nsamples=None):
 	"""
 	Normalizes numpy to fit into an image format,
 	but maximizes the contrast
 	"""
-	return normalizeImage(a, stdevLimit, minlevel= 20.0, maxlevel=240.0, trim=0.1)
+	return normalizeImage(a, stdevLimit, minlevel= 20.0, maxlevel=240.0, trim=0.1, nsamples=nsamples)
 
 #=========================
 def blackNormalizeImage(a, stdevLimit=3.0):
@@ -129,16 +129,21 @@ def whiteNormalizeImage(a, stdevLimit=3.0):
 	return normalizeImage(a,stdevLimit=stdevLimit,minlevel=55.0,maxlevel=255.0,trim=0.0)
 
 #=========================
-def normalizeImage(img, stdevLimit=3.0, minlevel=0.0, maxlevel=255.0, trim=0.0):
+def normalizeImage(img, stdevLimit=3.0, minlevel=0.0, maxlevel=255.0, trim=0.0, nsamples=None):
 	"""
 	Normalizes numpy to fit into an image format
 	that is values between 0 (minlevel) and 255 (maxlevel).
+	With nsamples, mean and stdev are estimated from about that many
+	pixels, which is plenty for display.
 	"""
 	#mid = cutEdges(img,trim)
 	imrange = maxlevel - minlevel
 	#GET IMAGE STATS
-	avg1 = img.mean()
-	stdev1 = img.std()
+	if nsamples is None:
+		avg1 = img.mean()
+		stdev1 = img.std()
+	else:
+		avg1, stdev1 = preview.sampleStats(img, nsamples)
 	min1 = img.min()
 	max1 = img.max()
 	#print avg1, stdev1, min1, max1
@@ -158,9 +163,14 @@ def normalizeImage(img, stdevLimit=3.0, minlevel=0.0, maxlevel=255.0, trim=0.0):
 		return img * 255
 	#print min1, max1
 
-	img = (img - min1)/(max1 - min1)*imrange + minlevel
-	img = numpy.where(img > maxlevel, 255.0, img)
-	img = numpy.where(img < minlevel,   0.0, img)
+	if img.dtype.kind == 'f':
+		img = img - min1
+	else:
+		img = img - float(min1)
+	img *= imrange/(max1 - min1)
+	img += minlevel
+	img[img > maxlevel] = 255.0
+	img[img < minlevel] = 0.0
 
 	return img
 
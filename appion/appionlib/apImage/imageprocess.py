@@ -64,6 +64,23 @@ class ImageFilter(object):
 			self.pixelLimitStDev = params['pixlimit']
 		return
 	
+	#=====================================
+	def fourierFilter(self, imgarray):
+		"""
+		tanh high pass and tanh low pass as one band pass filter, with the
+		same pixel radius limits as tanhHighPassFilter and tanhLowPassFilter
+		"""
+		highPass = self.highPass
+		if highPass/self.apix/float(self.bin) < 1:
+			apDisplay.printWarning("pixel radius too small for high pass filter")
+			highPass = 0.0
+		lowPass = self.lowPass
+		if lowPass/self.apix/float(self.bin) < 1:
+			apDisplay.printWarning("pixel radius too small for low pass filter")
+			lowPass = 0.0
+		return imagefilter.fourierFilter(imgarray, highpass=highPass, lowpass=lowPass,
+			apix=self.apix, bin=self.bin)
+
 	#=====================================
 	def processImage(self, imgarray):
 		"""
@@ -89,21 +106,27 @@ class ImageFilter(object):
 				apDisplay.printMsg("Applying a 2D plane regression and subtraction")
 			simgarray = imagefilter.planeRegression(simgarray, self.msg)
 				
+		### a tanh high pass and a tanh low pass are applied together
+		### as a band pass, with one forward and one inverse fft
+		tanhHighPass = self.highPass > 0 and not self.highPassType.startswith("gauss_subtract")
+		tanhLowPass = self.lowPass > 0 and self.lowPassType.startswith("tanh")
+
 		if self.highPass > 0:
 			if self.msg is True:
 				apDisplay.printMsg("Applying a high pass filter of %s A (apix %.1fA) of type %s"
 					%(self.highPass, self.apix, self.highPassType))
-			if self.highPassType.startswith("gauss_subtract"):
-				simgarray = imagefilter.subtractHighPassFilter(simgarray, self.highPass, apix=self.apix, bin=self.bin)
-			else:
-				### default: tanh
+			if not tanhHighPass:
+				simgarray = imagefilter.subtractHighPassFilter(simgarray, radius=self.highPass, apix=self.apix, bin=self.bin)
+			elif not tanhLowPass:
 				simgarray = imagefilter.tanhHighPassFilter(simgarray, self.highPass, apix=self.apix, bin=self.bin)
 
 		if self.lowPass > 0:
 			if self.msg is True:
 				apDisplay.printMsg("Applying a low pass filter of %s A (apix %.1fA) of type %s"
 					%(self.lowPass, self.apix, self.lowPassType))
-			if self.lowPassType.startswith("tanh"):
+			if tanhHighPass and tanhLowPass:
+				simgarray = self.fourierFilter(simgarray)
+			elif tanhLowPass:
 				simgarray = imagefilter.tanhLowPassFilter(simgarray, self.lowPass, apix=self.apix, bin=self.bin)
 			else:
 				### default: gauss
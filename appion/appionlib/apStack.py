@@ -394,6 +394,8 @@ def commitSubStack(params, newname=False, centered=False, oldstackparts=None, so
 		rundir
 		keepfile
 	'included' param is a list of included particles, starting at 0
+	'oldstackparts' is no longer used, the particle rows are copied
+	within the database
 	"""
 
 	t0 = time.time()
@@ -463,79 +465,17 @@ def commitSubStack(params, newname=False, centered=False, oldstackparts=None, so
 
 	apDisplay.printMsg("Completed in "+apDisplay.timeString(time.time()-t0)+"\n")
 
-	## index old stack particles by number
-	apDisplay.printMsg("Retrieving original stack information")
-	t0 = time.time()
-	part_by_number = {}
-	
-	# get stack data from original particles
-	if not oldstackparts:
-		sqlcmd = "SELECT * FROM ApStackParticleData " + \
-			"WHERE `REF|ApStackData|stack` = %i"%(params['stackid'])
-		# This result gives dictionary, not data object
-		oldstackparts = sinedon.directq.complexMysqlQuery('appiondata',sqlcmd)
-
-	for part in oldstackparts:
-		part_by_number[part['particleNumber']] = part
-
-	apDisplay.printMsg("Completed in "+apDisplay.timeString(time.time()-t0)+"\n")
-	
-	apDisplay.printMsg("Assembling database insertion command")
-	t0 = time.time()
-	count = 0
-	newpartnum = 1
-
-	partlistvals = []	 
-	for origpartnum in listfilelines:
-		count += 1
-		oldstackpartdata = part_by_number[origpartnum]
-		sqlParams = ['particleNumber','REF|ApStackData|stack']
-		vals = [newpartnum,newstackid]
-		for k,v in oldstackpartdata.iteritems():
-			# First need to convert the keys to column names
-			k = sinedon.directq.datakeyToSqlColumnName(oldstackpartdata,k)
-			if k in ['DEF_id', 
-				'DEF_timestamp', 
-				'particleNumber', 
-				'REF|ApStackData|stack']:
-				continue
-			sqlParams.append(k)
-			# oldstackpartdata can either be sinedon data object
-			# as passed through the function call
-			# or a pure dictionary from directq.complexMysqlQuery
-			# In the latter case v is just a long integer, not
-			# data reference.
-			if 'REF|' in k and hasattr(v,'dbid'):
-				# if it is a sinedon data object
-				v = v.dbid
-			vals.append(v)
-		valstr = "('"+"','".join(str(x) for x in vals)+"')"
-		# sql understand Null without string quote, not 'None'
-		valstr = valstr.replace("'None'","Null")
-		partlistvals.append(valstr)
-
-		newpartnum += 1
-
 	apDisplay.printMsg("Inserting particle information into database")
-
-	sqlstart = "INSERT INTO `ApStackParticleData` (`" + \
-		"`,`".join(sqlParams)+ "`) VALUES "
-	# break up command into groups of 100K inserts
-	# this is a workaround for the max_allowed_packet at 16MB
-	n = 100000
-	sqlinserts = [partlistvals[i:i+n] \
-		for i in range(0, len(partlistvals), n)]
-
+	t0 = time.time()
 	if params['commit'] is True:
-		for sqlinsert in sqlinserts:
-			sqlcmd=sqlstart+",".join(sqlinsert)
-			sinedon.directq.complexMysqlQuery('appiondata',sqlcmd)
+		numinserted = insertSubStackParticles(params['stackid'], newstackid, listfilelines)
+	else:
+		numinserted = len(listfilelines)
 
-	sys.stderr.write("\n")
-	if newpartnum == 0:
+	if numinserted == 0:
 		apDisplay.printError("No particles were inserted for the stack")
 
-	apDisplay.printColor("Inserted "+str(newpartnum-1)+ \
+	apDisplay.printColor("Inserted "+str(numinserted)+ \
 		" stack particles into the database in "+ \
 		apDisplay.timeString(time.time()-t0),"cyan")
 
@@ -553,6 +493,62 @@ def commitSubStack(params, newname=False, centered=False, oldstackparts=None, so
 	apDisplay.printMsg("finished")
 	return
 
+#===============
+def insertSubStackParticles(oldstackid, newstackid, partnums, batchsize=100000):
+	"""
+	copy the ApStackParticleData rows of old stack particles partnums
+	(starting at 1) to the new stack, numbered 1, 2, 3, ... in list order
+
+	The number pairs go into a temporary table, then the rows are copied
+	with INSERT ... SELECT in batches, all in one transaction.
+	Returns the number of inserted particles.
+	"""
+	db = sinedon.directq.getConnection('appiondata')
+	cursor = db.dbConnection.cursor()
+	tmptable = "tmp_substack_%d"%(newstackid)
+	refstack = "REF|ApStackData|stack"
+
+	### all columns except the ones set for the new stack
+	cursor.execute("SHOW COLUMNS FROM `ApStackParticleData`")
+	skip = ('DEF_id', 'DEF_timestamp', 'particleNumber', refstack)
+	columns = [row[0] for row in cursor.fetchall() if row[0] not in skip]
+	copycols = "".join([", p.`%s`"%(col) for col in columns])
+	insertcols = "".join([", `%s`"%(col) for col in columns])
+
+	numpart = len(partnums)
+	db.dbConnection.begin()
+	try:
+		cursor.execute("CREATE TEMPORARY TABLE `%s` ("%(tmptable)
+			+"newnum INT UNSIGNED NOT NULL PRIMARY KEY, "
+			+"oldnum INT UNSIGNED NOT NULL, KEY (oldnum))")
+		sqlcmd = "INSERT INTO `%s` (newnum, oldnum) VALUES (%%s, %%s)"%(tmptable)
+		for first in range(0, numpart, batchsize):
+			last = min(first+batchsize, numpart)
+			cursor.executemany(sqlcmd, zip(xrange(first+1, last+1), partnums[first:last]))
+
+		sqlcmd = ("INSERT INTO `ApStackParticleData` (`particleNumber`, `%s`%s) "%(refstack, insertcols)
+			+"SELECT t.newnum, %d%s FROM `%s` AS t "%(newstackid, copycols, tmptable)
+			+"JOIN `ApStackParticleData` AS p ON p.`particleNumber` = t.oldnum "
+			+"WHERE p.`%s` = %d AND t.newnum BETWEEN %%d AND %%d "%(refstack, oldstackid)
+			+"ORDER BY t.newnum")
+		numinserted = 0
+		for first in range(1, numpart+1, batchsize):
+			last = min(first+batchsize-1, numpart)
+			numinserted += cursor.execute(sqlcmd%(first, last))
+			apDisplay.printMsg("copied %d of %d particles"%(numinserted, numpart))
+		if numinserted != numpart:
+			apDisplay.printError("Only %d of %d particles were found in stack %d"
+				%(numinserted, numpart, oldstackid))
+		cursor.execute("DROP TEMPORARY TABLE `%s`"%(tmptable))
+	except:
+		db.dbConnection.rollback()
+		cursor.execute("DROP TEMPORARY TABLE IF EXISTS `%s`"%(tmptable))
+		cursor.close()
+		raise
+	db.dbConnection.commit()
+	cursor.close()
+	return numinserted
+
 def stackPartListToSQLInsertString(stackpartlist, stackid, stackrunid):
 	"""
 	Creates an insert command MySQL using stack particle values
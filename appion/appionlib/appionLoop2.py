@@ -16,6 +16,8 @@ from appionlib import apProject
 from appionlib import appionScript
 #leginon
 from pyami import mem
+from pyami import preview
+from sinedon import imagewriter
 from pyami import fileutil
 from fcntl import flock, LOCK_EX, LOCK_UN
 import subprocess
@@ -39,6 +41,11 @@ class AppionLoop(appionScript.AppionScript):
 		self.bad_images = []
 		self.sleep_minutes = 6
 		self.process_batch_count = 10
+		### write image files of inserted data in the background,
+		### flushed in finishLoopOneImage before the image is done
+		imagewriter.enabled = True
+		### and the preview images, flushed at the end of run
+		preview.enabled = True
 
 	#=====================
 	def setWaitSleepMin(self,minutes):
@@ -124,6 +131,12 @@ class AppionLoop(appionScript.AppionScript):
 			#END NOTDONE LOOP
 
 		self.postLoopFunctions()
+		### previews are written in the background, so a failed write
+		### only shows up here; it must fail the run, not just the exit handler
+		try:
+			preview.flush()
+		except IOError, e:
+			apDisplay.printError(str(e))
 		self.close()
 
 	#=====================
@@ -131,6 +144,11 @@ class AppionLoop(appionScript.AppionScript):
 		'''
 		Things to do after an image is processed whether commit or not
 		'''
+		### the committed rows of this image point to these files
+		try:
+			imagewriter.flush()
+		except IOError, e:
+			apDisplay.printError(str(e))
 		self._writeDoneDict(imgdata['filename'])
 		if self.params['parallel']:
 			self.unlockParallel(imgdata.dbid)
@@ -633,6 +633,7 @@ class gctfEstimateLoop(appionLoop2.AppionLoop):
 			ctfq['image'] = imgdata
 			ctfdb.printCtfData(ctfq)
 			ctfq.insert()
+			ctfdb.invalidateCtfIndex(imgdata)
 		else:
 			ctfinsert.validateAndInsertCTFData(imgdata, self.ctfvalues, self.ctfrun, self.params['rundir'])
 
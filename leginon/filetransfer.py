@@ -4,8 +4,11 @@ import os
 import sys
 import shutil
 import filecmp
+import hashlib
 import subprocess
+import threading
 import time
+import Queue
 import numpy
 import leginon.leginondata
 import leginon.ddinfo
@@ -29,7 +32,7 @@ class FileTransfer(pyami.scriptrun.ScriptRun):
 	def setOptions(self, parser):
 		# options
 		parser.add_option("--method", dest="method",
-			help="method to transfer, e.g. --method=mv", type="choice", choices=['mv','rsync'], default='rsync' if sys.platform != 'win32' else "mv")
+			help="method to transfer, e.g. --method=mv.  copy streams the file with an md5 checksum and removes the source", type="choice", choices=['mv','rsync','copy'], default='rsync' if sys.platform != 'win32' else "mv")
 		parser.add_option("--source_path", dest="source_path",
 			help="Mounted parent path to transfer, e.g. --source_path=/mnt/ddframes", metavar="PATH")
 		parser.add_option("--hidden_path", dest="hidden_path",
@@ -152,6 +155,42 @@ class FileTransfer(pyami.scriptrun.ScriptRun):
 		p = subprocess.Popen(cmd, shell=True)
 		p.wait()
 
+	def copyWithChecksum(self,src,dst,uid,gid,mode_str=None):
+		'''
+		Copy file or directory src to dst with checksumCopy, changing
+		ownership and mode of each copied file inline, then remove the
+		sources.  The md5 of each file is appended to md5sum.txt in the
+		destination frame directory.  Returns number of bytes copied.
+		'''
+		if os.path.isdir(src):
+			pairs = []
+			for dirpath, dirnames, filenames in os.walk(src):
+				reldir = os.path.relpath(dirpath, src)
+				dstdir = os.path.normpath(os.path.join(dst, reldir))
+				self.makeDirWithOwnershipChange(dstdir,uid,gid)
+				for filename in filenames:
+					pairs.append((os.path.join(dirpath, filename), os.path.join(dstdir, filename)))
+		else:
+			pairs = [(src, dst)]
+		framedir = os.path.dirname(os.path.normpath(dst))
+		total = 0
+		for srcfile, dstfile in pairs:
+			checksum, nbytes = checksumCopy(srcfile, dstfile, uid, gid, mode_str)
+			self.recordChecksum(framedir, os.path.relpath(dstfile, framedir), checksum)
+			os.remove(srcfile)
+			total += nbytes
+		return total
+
+	def recordChecksum(self, framedir, name, checksum):
+		'''append to md5sum.txt, in the format read by md5sum -c'''
+		checksum_lock.acquire()
+		try:
+			f = open(os.path.join(framedir, 'md5sum.txt'), 'a')
+			f.write('%s  %s\n' % (checksum, name))
+			f.close()
+		finally:
+			checksum_lock.release()
+
 	def changeDirOwnership(self,uid,gid,dirname, recursive=False):
 		# change ownership of desintation directory and contents
 		if not self.is_win32:
@@ -274,6 +313,137 @@ class FileTransfer(pyami.scriptrun.ScriptRun):
 		raise NotImplemented('Need to be defined in the subclass')
 
 
+copy_blocksize = 8 * 1024 * 1024
+checksum_lock = threading.Lock()
+
+def checksumCopy(src, dst, uid=None, gid=None, mode_str=None, blocksize=copy_blocksize):
+	'''
+	Copy src to dst in one streaming pass while computing the md5 of the
+	bytes read, so no second read is needed to verify.  The copy is
+	written to a temporary name, fsynced, given the source times,
+	ownership and mode, then renamed to dst.
+	Returns (md5 hex digest, number of bytes copied).
+	'''
+	tmp = dst + '.part'
+	md5 = hashlib.md5()
+	nbytes = 0
+	fin = open(src, 'rb')
+	try:
+		fout = open(tmp, 'wb')
+		try:
+			while True:
+				buf = fin.read(blocksize)
+				if not buf:
+					break
+				md5.update(buf)
+				fout.write(buf)
+				nbytes += len(buf)
+			fout.flush()
+			os.fsync(fout.fileno())
+		finally:
+			fout.close()
+	finally:
+		fin.close()
+	try:
+		st = os.stat(src)
+		if st.st_size != nbytes or os.path.getsize(tmp) != nbytes:
+			raise IOError('size mismatch copying %s: %d of %d bytes' % (src, nbytes, st.st_size))
+		os.utime(tmp, (st.st_atime, st.st_mtime))
+		if uid is not None and sys.platform != 'win32':
+			os.chown(tmp, int(uid), int(gid))
+		if mode_str:
+			os.chmod(tmp, pyami.fileutil.applyModeString(st.st_mode & 07777, mode_str))
+		os.rename(tmp, dst)
+	except:
+		os.remove(tmp)
+		raise
+	return md5.hexdigest(), nbytes
+
+class TransferPool(object):
+	'''
+	Worker threads that run transfer jobs.  Each job has a key, usually
+	the source path, so a scan can skip sources still being transferred.
+	Keeps byte and time totals for throughput logging.
+	'''
+	def __init__(self, nworkers=4):
+		self.queue = Queue.Queue()
+		self.lock = threading.Lock()
+		self.active = set()
+		self.bytes = 0
+		self.busy_time = 0.0
+		self.done = 0
+		self.failed = 0
+		self.threads = []
+		for i in range(max(1, nworkers)):
+			t = threading.Thread(target=self.loop, name='transfer worker %d' % (i,))
+			t.setDaemon(True)
+			t.start()
+			self.threads.append(t)
+
+	def submit(self, key, func, *args):
+		'''queue func(*args), which should return the number of bytes moved'''
+		self.lock.acquire()
+		try:
+			if key in self.active:
+				return False
+			self.active.add(key)
+		finally:
+			self.lock.release()
+		self.queue.put((key, func, args))
+		return True
+
+	def isActive(self, key):
+		self.lock.acquire()
+		try:
+			return key in self.active
+		finally:
+			self.lock.release()
+
+	def getQueueDepth(self):
+		self.lock.acquire()
+		try:
+			return len(self.active)
+		finally:
+			self.lock.release()
+
+	def loop(self):
+		while True:
+			key, func, args = self.queue.get()
+			t0 = time.time()
+			nbytes = 0
+			ok = True
+			try:
+				nbytes = func(*args) or 0
+			except Exception, e:
+				ok = False
+				print 'transfer of %s failed: %s' % (key, e)
+			elapsed = time.time() - t0
+			if ok and nbytes:
+				print 'transferred %s: %.1f MB in %.1f s, %.1f MB/s' % (key, nbytes/1e6, elapsed, nbytes/1e6/max(elapsed, 1e-6))
+			self.lock.acquire()
+			try:
+				self.active.discard(key)
+				self.bytes += nbytes
+				self.busy_time += elapsed
+				if ok:
+					self.done += 1
+				else:
+					self.failed += 1
+			finally:
+				self.lock.release()
+
+	def getStats(self):
+		self.lock.acquire()
+		try:
+			return {'queued': len(self.active), 'done': self.done, 'failed': self.failed, 'bytes': self.bytes, 'busy time': self.busy_time}
+		finally:
+			self.lock.release()
+
+	def wait(self):
+		'''wait until no job is queued or running'''
+		while self.getQueueDepth():
+			time.sleep(0.5)
+
 class ReferenceCopier(object):
 	'''
 	Copy references and modify orientation if needed for archiving
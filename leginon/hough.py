@@ -8,6 +8,7 @@
 import numpy
 import scipy.linalg
 import scipy.fftpack
+import houghcircle
 
 def gradient(image):
 	'''
@@ -80,65 +81,71 @@ def findPeak(image):
 		c = fit[0]
 		row = -c[1] / (2.0 * c[0])
 
+## number of (point, theta) votes cast at once by houghLine
+line_chunk = 4*1024*1024
+
+def roundHalfAway(a):
+	'''numpy version of python round(): halves are rounded away from zero'''
+	return numpy.sign(a) * numpy.floor(numpy.absolute(a) + 0.5)
+
 def houghLine(image, threshold):
+	'''
+	Hough transform for lines through points above threshold.  Returns
+	an (r, theta, 5) array of vote count, min row, min col, max row and
+	max col of the voting points.  Votes for lines whose points span
+	less than lengththreshold are zeroed.  Negative r wraps around, as
+	in python indexing.
+	'''
 	m, n = image.shape
 
 	r = int(numpy.ceil(numpy.sqrt(((m/2.0)**2 + (n/2.0)**2))))
-	houghimage = numpy.zeros((r, 360, 5))
-
-	houghimage[:,:,1] = houghimage[:,:,1] + m
-	houghimage[:,:,2] = houghimage[:,:,2] + n
-
-	offset = r/2
+	nthetas = 360
+	houghimage = numpy.zeros((r, nthetas, 5))
 
 	hm = int(numpy.ceil(m/2.0))
-	i = numpy.arange(-hm, hm)
-	i.shape = (m, 1)
 	hn = int(numpy.ceil(n/2.0))
-	j = numpy.arange(-hn, hn)
-	j.shape = (n, 1)
-	conversion = numpy.pi*2/houghimage.shape[1]
-	cos = numpy.cos(numpy.arange(houghimage.shape[1])*conversion)
-	cos.shape = (1, houghimage.shape[1])
-	sin = numpy.sin(numpy.arange(houghimage.shape[1])*conversion)
-	sin.shape = (1, houghimage.shape[1])
-
-	icos = numpy.matrixmultiply(i, cos)
-	jsin = numpy.matrixmultiply(j, sin)
-
-#	i = numpy.transpose(numpy.array([numpy.arange(n)]*m)).astype(numpy.float)
-#	j = numpy.array([numpy.arange(m)]*n).astype(numpy.float)
-#
-#	i *= numpy.cos(theta)
-#	j *= numpy.sin(theta)
-#
-#	r = i + j + offset
-
-	mrange = range(m)
-	nrange = range(n)
-	for i in mrange:
-		for j in nrange:
-			if image[i, j] > threshold: 
-				for theta in range(houghimage.shape[1]):
-					r = int(round(icos[i - m, theta] + jsin[j - n, theta]))
-					houghimage[r, theta, 0] = houghimage[r, theta, 0] + 1
-
-					if i < houghimage[r, theta, 1]:
-						houghimage[r, theta, 1] = i
-					if j < houghimage[r, theta, 2]:
-						houghimage[r, theta, 2] = j
-					if i > houghimage[r, theta, 3]:
-						houghimage[r, theta, 3] = i
-					if j > houghimage[r, theta, 4]:
-						houghimage[r, theta, 4] = j
+	conversion = numpy.pi*2/nthetas
+	cos = numpy.cos(numpy.arange(nthetas)*conversion)
+	sin = numpy.sin(numpy.arange(nthetas)*conversion)
+
+	rows, cols = numpy.nonzero(image > threshold)
+	thetas = numpy.arange(nthetas)
+	counts = numpy.zeros(r*nthetas)
+	mins = numpy.zeros((2, r*nthetas))
+	mins[0] = m
+	mins[1] = n
+	maxs = numpy.zeros((2, r*nthetas))
+	step = max(1, line_chunk // nthetas)
+	for start in range(0, len(rows), step):
+		i = rows[start:start+step, numpy.newaxis]
+		j = cols[start:start+step, numpy.newaxis]
+		rs = roundHalfAway((i - hm) * cos + (j - hn) * sin).astype(numpy.int64)
+		if rs.size and (rs.max() >= r or rs.min() < -r):
+			raise IndexError('line distance out of hough image range')
+		## negative r wraps around like python indexing
+		bins = (rs % r) * nthetas + thetas
+		bins = bins.ravel()
+		i = numpy.repeat(i.ravel(), nthetas)
+		j = numpy.repeat(j.ravel(), nthetas)
+		counts += numpy.bincount(bins, minlength=r*nthetas)
+		## min and max per bin from the votes sorted by bin
+		order = numpy.argsort(bins, kind='mergesort')
+		bins = bins[order]
+		starts = numpy.concatenate(([0], numpy.flatnonzero(numpy.diff(bins)) + 1))
+		ubins = bins[starts]
+		for k, values in enumerate((i[order], j[order])):
+			mins[k,ubins] = numpy.minimum(mins[k,ubins], numpy.minimum.reduceat(values, starts))
+			maxs[k,ubins] = numpy.maximum(maxs[k,ubins], numpy.maximum.reduceat(values, starts))
+	houghimage[:,:,0] = counts.reshape((r, nthetas))
+	houghimage[:,:,1] = mins[0].reshape((r, nthetas))
+	houghimage[:,:,2] = mins[1].reshape((r, nthetas))
+	houghimage[:,:,3] = maxs[0].reshape((r, nthetas))
+	houghimage[:,:,4] = maxs[1].reshape((r, nthetas))
 
 	lengththreshold = 768
-	for r in range(houghimage.shape[0]):
-		for theta in range(houghimage.shape[1]):
-			m = numpy.sqrt((houghimage[r, theta, 3] - houghimage[r, theta, 1])**2 +
-										(houghimage[r, theta, 4] - houghimage[r, theta, 2])**2)
-			if m < lengththreshold:
-				houghimage[r, theta, 0] = 0
+	lengths = numpy.sqrt((houghimage[:,:,3] - houghimage[:,:,1])**2 +
+										(houghimage[:,:,4] - houghimage[:,:,2])**2)
+	houghimage[:,:,0] = numpy.where(lengths < lengththreshold, 0, houghimage[:,:,0])
 
 	return houghimage
 
@@ -155,28 +162,26 @@ def houghCircle(image, threshold, radiusrange=None):
 	if radiusrange is None:
 		radiusrange = (1, min(m, n)/2)
 
-	# give the transform accumulator a buffer since a shifted copy will be added
-	# inplace. this is probably not the best way if the radius is large
 	border = max(radiusrange)
-	houghimage = numpy.zeros((m + border*2, n + border*2), numpy.int16)
 
 	# threshold the image, making it a bitmask of above/below threshold
 	thresholdimage = image >= threshold
-	# convert to type to be added to the accumulator
-	thresholdimage = thresholdimage.astype(numpy.int16)
 
 	# make a list of all points (offsets) for circles with radii in range
 	shifts = []
 	for radius in range(radiusrange[0], radiusrange[1] + 1):
 		shifts += bresenhamCirclePoints(radius)
 
-	# shift the bitmask of the threshold to each point in each of the circles
-	# and add the value to the accumulator
-	def set(shift):
-		houghimage[shift[0]:shift[0] + m, shift[1]:shift[1] + n] += thresholdimage
-	map(set, shifts)
+	# each point of each circle votes with the bitmask shifted to that
+	# point.  Votes are collected at the image size plus a border wide
+	# enough that they do not wrap around, then cropped.
+	paddedshape = m + 2*border, n + 2*border
+	paddedimage = numpy.zeros(paddedshape, numpy.int16)
+	paddedimage[:m, :n] = thresholdimage
+	offsets = [(border - 1 - shift[0], border - 1 - shift[1]) for shift in shifts]
+	houghimage = houghcircle.ringVotes(paddedimage, [offsets], numpy.int16)[0]
 
-	return houghimage[border - 1:border + m - 1, border - 1:border + n - 1]
+	return houghimage[:m, :n]
 
 if __name__=='__main__':
 	from wxPython.wx import *
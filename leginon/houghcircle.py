@@ -3,6 +3,7 @@
 import numpy
 import scipy.ndimage as ndimage
 import scipy.signal
+import pyami.fft.engine
 
 sqrtof2 = numpy.sqrt(2.0)
 
@@ -75,39 +76,88 @@ def circleKernel(radius):
 	kernel[rows,cols] = 1
 	return kernel
 
-def transform(image, radii):
-	maxradius = max(radii)
-	inputshape = image.shape
-	resultshape = len(radii), inputshape[0]+2*maxradius, inputshape[1]+2*maxradius
-	result = numpy.zeros(resultshape, image.dtype)
-	for r,radius in enumerate(radii):
-		circlepoints = rasterCircle00(radius)
-		for circlepoint in circlepoints:
-			row0 = maxradius - circlepoint[0]
-			row1 = row0 + inputshape[0]
-			col0 = maxradius - circlepoint[1]
-			col1 = col0 + inputshape[1]
-			result[r][row0:row1, col0:col1] += image
+def ringVotes(image, pointlists, dtype=None):
+	'''
+	Hough voting by FFT.  For each list of (row, col) offsets, returns
+	  votes[y, x] = sum of image[y+row, x+col] over the offsets
+	with indices wrapping around the image edges, so pad the image with
+	zeros if votes should not wrap.  A repeated offset votes repeatedly.
+	The image is transformed once and each ring kernel once.  Integer
+	dtypes are rounded, since the votes are exact sums.
+	'''
+	if dtype is None:
+		dtype = image.dtype
+	dtype = numpy.dtype(dtype)
+	shape = image.shape
+	eng = pyami.fft.engine.get_engine()
+	imagefft = eng.forward(image.astype(numpy.float64))
+	result = numpy.empty((len(pointlists),)+shape, dtype)
+	for k, points in enumerate(pointlists):
+		kernel = numpy.zeros(shape, numpy.float64)
+		if len(points):
+			rows, cols = numpy.array(points).transpose()
+			## correlation: the kernel is the ring flipped through the origin
+			numpy.add.at(kernel, (-rows % shape[0], -cols % shape[1]), 1)
+		votes = eng.reverse(imagefft * eng.forward(kernel), shape)
+		if dtype.kind in 'iub':
+			votes = numpy.rint(votes).astype(numpy.int64)
+		result[k] = votes.astype(dtype)
 	return result
 
-def transform2(image, radii, limit=None):
-	# limit = (rowstart, rowend, colstart, colend)
-	maxradius = max(radii)
-	inputshape = image.shape
-	resultshape = len(radii), limit[1]-limit[0], limit[3]-limit[2]
-	result = numpy.zeros(resultshape, image.dtype)
-	paddedshape = inputshape[0]+2*maxradius, inputshape[1]+2*maxradius
+def padImage(image, pad):
+	paddedshape = image.shape[0]+2*pad, image.shape[1]+2*pad
 	paddedimage = numpy.zeros(paddedshape, image.dtype)
-	paddedimage[maxradius:maxradius+inputshape[0], maxradius:maxradius+inputshape[1]] = image
-	for r,radius in enumerate(radii):
-		circlepoints = rasterCircle00(radius)
-		for circlepoint in circlepoints:
+	paddedimage[pad:pad+image.shape[0], pad:pad+image.shape[1]] = image
+	return paddedimage
 
-			row0 = maxradius + circlepoint[0] + limit[0]
-			row1 = maxradius + circlepoint[0] + limit[1]
-			col0 = maxradius + circlepoint[1] + limit[2]
-			col1 = maxradius + circlepoint[1] + limit[3]
+def transform(image, radii):
+	'''
+	Stack of Hough transforms, one per radius, each the size of the
+	image plus max(radii) on all sides.
+	'''
+	maxradius = max(radii)
+	## the padding is wider than any ring, so the votes do not wrap
+	paddedimage = padImage(image, maxradius)
+	pointlists = [rasterCircle00(radius) for radius in radii]
+	return ringVotes(paddedimage, pointlists, image.dtype)
 
-			result[r] += paddedimage[row0:row1, col0:col1]
+def transform2(image, radii, limit=None):
+	'''
+	Like transform, but only the region limit = (rowstart, rowend,
+	colstart, colend) in image coordinates is returned.  limit=None
+	returns the region of the original image.
+	'''
+	if limit is None:
+		limit = 0, image.shape[0], 0, image.shape[1]
+	maxradius = max(radii)
+	## only pixels within maxradius of the region vote in it, so the
+	## votes are made on the region plus maxradius on all sides, which
+	## is zero outside of the image like the padding of transform
+	rowstart, rowend = limit[0]-maxradius, limit[1]+maxradius
+	colstart, colend = limit[2]-maxradius, limit[3]+maxradius
+	window = numpy.zeros((rowend-rowstart, colend-colstart), image.dtype)
+	r0, r1 = max(rowstart, 0), min(rowend, image.shape[0])
+	c0, c1 = max(colstart, 0), min(colend, image.shape[1])
+	if r1 > r0 and c1 > c0:
+		window[r0-rowstart:r1-rowstart, c0-colstart:c1-colstart] = image[r0:r1, c0:c1]
+	pointlists = [rasterCircle00(radius) for radius in radii]
+	result = ringVotes(window, pointlists, image.dtype)
+	return result[:, maxradius:maxradius+limit[1]-limit[0], maxradius:maxradius+limit[3]-limit[2]]
 
-	return result
+def findPeaks(hough, threshold=None, size=3, maxpeaks=None):
+	'''
+	Peaks of a Hough accumulator (2-D, or 3-D radius,row,col) with
+	non-maximum suppression: a peak is the maximum of its size-wide
+	neighborhood and above threshold.  Returns a list of
+	(index tuple, value) sorted by decreasing value.
+	'''
+	localmax = ndimage.maximum_filter(hough, size=size, mode='constant', cval=hough.min())
+	peaks = hough == localmax
+	if threshold is not None:
+		peaks &= hough > threshold
+	indices = numpy.nonzero(peaks)
+	values = hough[indices]
+	order = numpy.argsort(values, kind='mergesort')[::-1]
+	if maxpeaks is not None:
+		order = order[:maxpeaks]
+	return [(tuple([int(index[i]) for index in indices]), values[i]) for i in order]
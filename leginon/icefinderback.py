@@ -64,7 +64,7 @@ class IceFinder(object):
 	def setComponents(self):
 		## other necessary components
 		self.circle = pyami.circle.CircleMaskCreator()
-		self.holestats = statshole.HoleStatsCalculator()
+		self.holestats = statshole.HoleStatsCalculator(self.circle)
 		self.ice = statshole.HoleIceCalculator()
 		self.convolve = statshole.HoleConvolver()
 		self.good = statshole.GoodHoleFilter()
@@ -30,7 +30,7 @@ class ImodProcessor(imageprocessor.ImageProcessor):
 			self.logger.warning('No images in image list.')
 			return
 		self.nopeaks = True
-		self.correlator = tiltcorrelator.Correlator(self, 0, 4,lpf=1.5)
+		self.correlator = tiltcorrelator.Correlator(self, 0, 4,lpf=1.5, search_levels=3)
 		mrc_files = []
 		self.peaks = [{'x':0.0,'y':0.0}]
 		imagepath = self.session['image path']
@@ -2,6 +2,14 @@
 
 import numpy
 import math
+import scipy.spatial
+
+## pointsToLattice tries every point as the lattice origin up to this
+## many points.  With more, the lattice vector is estimated once from
+## nearest neighbors and the largest domain is found by RANSAC.
+exact_max_points = 500
+## origins tried by the RANSAC domain search
+ransac_trials = 50
 
 class Lattice(object):
 	def __init__(self, firstpoint, spacing, tolerance):
@@ -43,8 +51,22 @@ class Lattice(object):
 		return points
 
 	def optimizeRaster(self,all_points, better_points):
+		'''
+		Replace the raster point closest in index order to each
+		better point, if within tolerance.
+		'''
+		if not len(all_points) or not len(better_points):
+			return all_points
+		maxdist = self.tolerance * self.spacing
+		## points found in the tree are at their original position.
+		## A replaced point moved less than maxdist, so search twice as far
+		## and check the current positions.
+		tree = scipy.spatial.cKDTree(numpy.asarray(all_points, numpy.float64))
 		for better_point in better_points:
-			for i,point in enumerate(all_points):
+			candidates = tree.query_ball_point(better_point, 2*maxdist)
+			candidates.sort()
+			for i in candidates:
+				point = all_points[i]
 				distance = math.hypot(point[0]-better_point[0],point[1]-better_point[1])
 				if distance / self.spacing < self.tolerance:
 					all_points[i] = better_point
@@ -89,14 +111,7 @@ class Lattice(object):
 			err = numpy.absolute(nf - n)
 			if err < self.tolerance:
 				point = (n,0)
-				m = numpy.array(((v0/n, v1/n),(v1/n, -v0/n)), numpy.float32)
-				self.matrix = m
-				tmatrix = numpy.linalg.inv(m)
-				self.t00 = tmatrix[0,0]
-				self.t01 = tmatrix[0,1]
-				self.t10 = tmatrix[1,0]
-				self.t11 = tmatrix[1,1]
-				self.angle = numpy.arctan2(v1,v0)
+				self.set_vector(v0, v1, n)
 				self.spacing = dist
 				self.lattice_points[point] = secondpoint
 				## I am trusting that my new calculated
@@ -108,6 +123,76 @@ class Lattice(object):
 		else:
 			self.add_any_point(secondpoint)
 
+	def set_vector(self, v0, v1, n=1):
+		'''
+		Set the lattice matrix from the first lattice vector (v0,v1)/n.
+		The second vector is perpendicular to it.
+		'''
+		m = numpy.array(((v0/n, v1/n),(v1/n, -v0/n)), numpy.float32)
+		self.matrix = m
+		tmatrix = numpy.linalg.inv(m)
+		self.t00 = tmatrix[0,0]
+		self.t01 = tmatrix[0,1]
+		self.t10 = tmatrix[1,0]
+		self.t11 = tmatrix[1,1]
+		self.angle = numpy.arctan2(v1,v0)
+		self.spacing = numpy.hypot(m[0,0],m[0,1])
+
+	def lattice_coordinates(self, points):
+		'''
+		Nearest lattice index and distance from it, in units of the
+		lattice spacing, for an array of points.  Same arithmetic as
+		add_any_point.
+		'''
+		p0 = points[:,0] - self.center[0]
+		p1 = points[:,1] - self.center[1]
+		c0 = p0 * self.t00 + p1 * self.t01
+		c1 = p0 * self.t10 + p1 * self.t11
+		cint0 = roundHalfAway(c0)
+		cint1 = roundHalfAway(c1)
+		err0 = c0 - cint0
+		err1 = c1 - cint1
+		err = numpy.sqrt(err0*err0+err1*err1)
+		return cint0.astype(numpy.int64), cint1.astype(numpy.int64), err
+
+	def add_points(self, points, indices=None):
+		'''
+		Same result as add_any_point on each point in order, done with
+		arrays.  Each lattice index keeps the point with the least error,
+		the earlier one on a tie.  indices are the positions of points in
+		the caller's list, used for that order.
+		'''
+		if not len(points):
+			return
+		a = numpy.asarray(points, numpy.float64)
+		if indices is None:
+			indices = numpy.arange(len(a))
+		cint0, cint1, err = self.lattice_coordinates(a)
+		keep = numpy.flatnonzero(err < self.tolerance)
+		## lattice indices already set keep their point unless beaten
+		existing = {}
+		for key in self.lattice_points:
+			existing[key] = self.lattice_points_err[key]
+		## order by lattice index, then error, then position in the list
+		order = numpy.lexsort((indices[keep], err[keep], cint1[keep], cint0[keep]))
+		keep = keep[order]
+		first = numpy.ones(len(keep), numpy.bool)
+		first[1:] = (numpy.diff(cint0[keep]) != 0) | (numpy.diff(cint1[keep]) != 0)
+		best = keep[first]
+		## points are appended in list order, like add_any_point
+		best = best[numpy.argsort(indices[best], kind='mergesort')]
+		for i in best:
+			closest = int(cint0[i]), int(cint1[i])
+			point = points[i]
+			if closest in existing:
+				if existing[closest] > err[i]:
+					self.points.remove(self.lattice_points[closest])
+				else:
+					continue
+			self.lattice_points[closest] = point
+			self.lattice_points_err[closest] = err[i]
+			self.points.append(point)
+
 	def add_any_point(self, point):
 		'''
 		this checks to see if a point falls on a lattice
@@ -189,31 +274,215 @@ def pointsToFakeLattice(points):
 			lat.matrix = m
 		return lat
 
+def roundHalfAway(a):
+	'''numpy version of python round(): halves are rounded away from zero'''
+	return numpy.sign(a) * numpy.floor(numpy.absolute(a) + 0.5)
+
+def findSecondPoint(a, index, spacing, tolerance):
+	'''
+	Index of the first point that Lattice.add_second_point would accept
+	for a lattice centered on a[index], or None.
+	'''
+	d = a - a[index]
+	nf = numpy.hypot(d[:,0], d[:,1]) / spacing
+	n = numpy.floor(nf + 0.5)
+	good = numpy.flatnonzero((n != 0) & (numpy.absolute(nf - n) < tolerance))
+	if not len(good):
+		return None
+	return good[0]
+
+def latticeAtCenter(points, a, index, spacing, tolerance):
+	'''
+	Same lattice as Lattice(points[index]) followed by add_point of
+	every point, in order.
+	'''
+	lat = Lattice(points[index], spacing, tolerance)
+	second = findSecondPoint(a, index, spacing, tolerance)
+	if second is None:
+		return lat
+	lat.add_second_point(points[second])
+	## earlier points were rejected by add_second_point
+	rest = numpy.arange(second+1, len(points))
+	lat.add_points([points[i] for i in rest], rest)
+	return lat
+
+def latticeSizeAtCenter(points, a, index, spacing, tolerance):
+	'''number of points in latticeAtCenter, without making it'''
+	second = findSecondPoint(a, index, spacing, tolerance)
+	if second is None:
+		return 1
+	lat = Lattice(points[index], spacing, tolerance)
+	lat.add_second_point(points[second])
+	cint0, cint1, err = lat.lattice_coordinates(a[second+1:])
+	## the center and second point hold their lattice indices
+	taken = set(lat.lattice_points.keys())
+	good = numpy.flatnonzero(err < tolerance)
+	keys = set(zip(cint0[good].tolist(), cint1[good].tolist()))
+	return len(taken) + len(keys - taken)
+
+def estimateLatticeVector(a, spacing, tolerance):
+	'''
+	Lattice vector from the vectors to nearest neighbors that are one
+	spacing away.  The angle is averaged modulo 90 degrees, since the
+	lattice is square.  Returns None if no neighbor is at the spacing.
+	'''
+	k = min(5, len(a))
+	if k < 2:
+		return None
+	tree = scipy.spatial.cKDTree(a)
+	dists, neighbors = tree.query(a, k)
+	dists = dists[:,1:].ravel()
+	neighbors = neighbors[:,1:].ravel()
+	sources = numpy.repeat(numpy.arange(len(a)), k-1)
+	good = numpy.absolute(dists / spacing - 1.0) < tolerance
+	if not good.any():
+		return None
+	vectors = a[neighbors[good]] - a[sources[good]]
+	angles = numpy.arctan2(vectors[:,1], vectors[:,0])
+	angle = numpy.angle(numpy.exp(4j*angles).mean()) / 4.0
+	length = numpy.median(dists[good])
+	return length*numpy.cos(angle), length*numpy.sin(angle)
+
+def findLatticeDomain(a, vector, tolerance):
+	'''
+	RANSAC search for the largest set of points on one lattice with the
+	given vector.  Points of another domain have a different offset, so
+	they do not fit a lattice through an origin in this one.  Returns
+	a boolean array of the points in the largest domain.
+	'''
+	npoints = len(a)
+	trials = [0]
+	if npoints > 1:
+		random = numpy.random.RandomState(0)
+		trials.extend(random.permutation(numpy.arange(1, npoints))[:ransac_trials-1])
+	lat = Lattice(tuple(a[0]), 1, tolerance)
+	lat.set_vector(*vector)
+	best = None
+	bestcount = 0
+	tried = numpy.zeros(npoints, numpy.bool)
+	for index in trials:
+		if tried[index]:
+			continue
+		lat.center = a[index]
+		cint0, cint1, err = lat.lattice_coordinates(a)
+		inliers = err < tolerance
+		## other points of this domain would give the same answer
+		tried |= inliers
+		count = inliers.sum()
+		if count > bestcount:
+			best = inliers
+			bestcount = count
+		## a domain among the untried points could not be larger
+		if bestcount >= npoints - tried.sum():
+			break
+	return best
+
+def fitLatticeParameters(a, cint0, cint1):
+	'''
+	Least squares origin and lattice vector (v0,v1) for points a at
+	lattice indices cint0, cint1, with the second vector perpendicular
+	as in Lattice.set_vector:
+		a = origin + cint0*(v0,v1) + cint1*(v1,-v0)
+	Returns (origin, vector), or None if the indices do not determine
+	them.
+	'''
+	n = len(a)
+	design = numpy.zeros((2*n, 4))
+	design[:n,0] = 1
+	design[:n,2] = cint0
+	design[:n,3] = cint1
+	design[n:,1] = 1
+	design[n:,2] = -cint1
+	design[n:,3] = cint0
+	target = numpy.concatenate((a[:,0], a[:,1]))
+	solution, residuals, rank, sv = numpy.linalg.lstsq(design, target, rcond=None)
+	if rank < 4:
+		return None
+	return (solution[0], solution[1]), (solution[2], solution[3])
+
+def fitLattice(points, a, spacing, tolerance):
+	'''
+	Lattice for many points in near linear time: estimate the vector
+	once, find the largest domain, then assign points by rounding.
+	The vector is turned to point at the first point on a lattice axis
+	at the spacing from the first point of the domain, as
+	add_second_point would use.  The origin and the vector are then
+	fitted together by least squares on all points of the lattice, so
+	neither carries the position error of a single point.
+	'''
+	vector = estimateLatticeVector(a, spacing, tolerance)
+	if vector is None:
+		return None
+	domain = findLatticeDomain(a, vector, tolerance)
+	members = numpy.flatnonzero(domain)
+	center = members[0]
+	lat = Lattice(points[center], spacing, tolerance)
+	lat.set_vector(*vector)
+	cint0, cint1, err = lat.lattice_coordinates(a[members])
+	d = a[members] - a[center]
+	nf = numpy.hypot(d[:,0], d[:,1]) / spacing
+	n = numpy.floor(nf + 0.5)
+	onaxis = (cint0 == 0) != (cint1 == 0)
+	second = numpy.flatnonzero(onaxis & (numpy.absolute(nf - n) < tolerance))
+	if len(second):
+		## the four 90 degree turns of the vector, pick the closest
+		v = d[second[0]]
+		turns = numpy.array((vector, (vector[1],-vector[0]), (-vector[0],-vector[1]), (-vector[1],vector[0])))
+		vector = tuple(turns[numpy.argmax(numpy.dot(turns, v))])
+	origin = tuple(a[center])
+	for i in range(3):
+		lat.center = origin
+		lat.set_vector(*vector)
+		cint0, cint1, err = lat.lattice_coordinates(a)
+		good = err < tolerance
+		fit = fitLatticeParameters(a[good], cint0[good], cint1[good])
+		if fit is None:
+			break
+		origin, vector = fit
+	## assign every point, the (0,0) one included, to the fitted lattice
+	lat.points = []
+	lat.lattice_points = {}
+	lat.lattice_points_err = {}
+	lat.center = origin
+	lat.set_vector(*vector)
+	lat.add_points(points, numpy.arange(len(points)))
+	if len(lat.points) < 2:
+		return None
+	return lat
+
 def pointsToLattice(points, spacing, tolerance, first_is_center=False):
-	# create a lattice for every point, or if centerfirst, then only
-	# create a lattice with first point as center
-	if first_is_center:
-		lattices = [Lattice(points[0], spacing, tolerance)]
-	else:
-		lattices = []
-		for point in points:
-			lattices.append(Lattice(point, spacing, tolerance))
-	# see which points fit in which lattices
-	for point in points:
-		#found_lattice = False
-		for lat in lattices:
-			lat.add_point(point)
+	'''
+	Find the lattice that includes the most points.  Every point is
+	tried as the lattice origin, or only the first if first_is_center.
+	The result is the same as adding every point in order to a Lattice
+	at each origin, and taking the first with the most points.  Above
+	exact_max_points, the lattice is fitted by fitLattice instead.
+	'''
+	if not len(points):
+		return None
+	a = numpy.asarray(points, numpy.float64)
 	if len(points) == 1:
-		best_lattice = lattices[0]
-	else:
-		# find the best lattice
-		maxpoints = 1
-		best_lattice = None
-		for lat in lattices:
-			if len(lat.points) > maxpoints:
-				maxpoints = len(lat.points)
-				best_lattice = lat
-	return best_lattice
+		return Lattice(points[0], spacing, tolerance)
+	if first_is_center:
+		lat = latticeAtCenter(points, a, 0, spacing, tolerance)
+		if len(lat.points) < 2:
+			return None
+		return lat
+	if len(points) > exact_max_points:
+		lat = fitLattice(points, a, spacing, tolerance)
+		if lat is not None:
+			return lat
+	# find the best lattice
+	maxpoints = 1
+	best_index = None
+	for index in range(len(points)):
+		npoints = latticeSizeAtCenter(points, a, index, spacing, tolerance)
+		if npoints > maxpoints:
+			maxpoints = npoints
+			best_index = index
+	if best_index is None:
+		return None
+	return latticeAtCenter(points, a, best_index, spacing, tolerance)
 
 if __name__ == '__main__':
 	from numpy.random import randint
@@ -15,7 +15,10 @@ import polygon
 import raster
 import time
 import sys
-from pyami import ordereddict, mrc
+import Queue
+import multiprocessing
+import traceback
+from pyami import ordereddict, mrc, imagefun
 import cPickle
 import os.path
 import sinedon
@@ -23,6 +26,9 @@ from pyami import affine
 import caltransformer
 import xml.dom.minidom
 
+## spline order of the affine transforms, set by --spline-order
+splineorder = 1
+
 def getMosaicXMLData(data):
 	'''
 	data = [
@@ -67,6 +73,24 @@ def memmapMRC(fileref):
 	im = mrc.mmap(fullname)
 	return im
 
+def inputRegion(inputshape, outputshape, atmatrix, offset, margin):
+	'''
+	Bounding box (row0, row1, col0, col1) of the input pixels that
+	affine_transform samples to fill outputshape, padded by margin
+	for the spline and clipped to the input.  None if the output
+	does not overlap the input at all.
+	'''
+	rows, cols = outputshape
+	corners = numpy.array(((0,0), (0,cols-1), (rows-1,0), (rows-1,cols-1)), numpy.float64)
+	incorners = numpy.dot(corners, numpy.transpose(atmatrix)) + offset
+	lo = numpy.floor(incorners.min(axis=0)).astype(int) - margin
+	hi = numpy.ceil(incorners.max(axis=0)).astype(int) + margin + 1
+	lo = numpy.maximum(lo, 0)
+	hi = numpy.minimum(hi, inputshape)
+	if (hi <= lo).any():
+		return None
+	return lo[0], hi[0], lo[1], hi[1]
+
 class Image(object):
 	def __init__(self, scope, camera, timestamp, fileref=None, rotation=0.0):
 		self.scope = leginondata.ScopeEMData(initializer=scope)
@@ -253,8 +277,15 @@ class MontageImage(Image):
 
 			inputarray = memmapMRC(input.fileref)
 
-			#inputarray = splines.filter(input.fileref.filename, inputarray)
-			scipy.ndimage.affine_transform(inputarray, atmatrix, offset=offset, output=output, output_shape=self.shape, mode='constant', cval=0.0, order=splineorder, prefilter=False)
+			## only the part of the input under this output is read from
+			## the memory map, so a tile does not page in whole inputs
+			region = inputRegion(inputarray.shape, self.shape, atmatrix, offset, splineorder+2)
+			if region is not None:
+				row0, row1, col0, col1 = region
+				inputarray = inputarray[row0:row1, col0:col1]
+				offset = offset - (row0, col0)
+				#inputarray = splines.filter(input.fileref.filename, inputarray)
+				scipy.ndimage.affine_transform(inputarray, atmatrix, offset=offset, output=output, output_shape=self.shape, mode='constant', cval=0.0, order=splineorder, prefilter=False)
 
 			if self.image is None:
 				self.image = numpy.zeros(self.shape, numpy.float32)
@@ -398,9 +429,104 @@ def createSingleImage(inputimages, globaloutput, outfilename, outformat, outtext
 	if outfilename is not None:
 		mrc.write(globaloutput.image, outfilename)
 
-def createTiles(inputs, tiledict, tilesize, row1=None, row2=None, col1=None, col2=None):
-	blank = numpy.zeros((tilesize,tilesize), numpy.float32)
+def tileFilename(level, tileindex):
+	'''level 0 tiles are row_col.mrc, binned levels go in levelN/'''
+	name = '%d_%d.mrc' % tileindex
+	if level:
+		name = os.path.join('level%d' % (level,), name)
+	return name
+
+## state of a tile worker process, set by initTileWorker
+worker_inputs = None
+worker_tiledict = None
+worker_tilesize = None
+
+def initTileWorker(inputs, tiledict, tilesize, order):
+	global worker_inputs, worker_tiledict, worker_tilesize, splineorder
+	worker_inputs = inputs
+	worker_tiledict = tiledict
+	worker_tilesize = tilesize
+	splineorder = order
+
+def makeTile(tileindex):
+	'''
+	Insert the inputs into one output tile and write it.  Only the
+	tile and the overlapping regions of the inputs are in memory.
+	'''
+	tileargs = worker_tiledict[tileindex]
+	output = MontageImage(*tileargs['args'], **tileargs['kwargs'])
+	for input in worker_inputs:
+		output.insertImage(input)
+	if output.inserted:
+		outim = output.image
+	else:
+		outim = numpy.zeros((worker_tilesize,worker_tilesize), numpy.float32)
+	mrc.write(outim, tileFilename(0, tileindex))
+	x,y = output.scope['stage position']['x'], output.scope['stage position']['y']
+	return output.inserted, x, y
+
+def makeLevelTile(level, tileindex):
+	'''
+	Bin by 2 the (up to) four tiles of level-1 that make up this tile
+	of level.  Missing children are left blank.
+	'''
+	tilesize = worker_tilesize
+	half = tilesize // 2
+	outim = numpy.zeros((tilesize,tilesize), numpy.float32)
+	r,c = tileindex
+	for i in (0,1):
+		for j in (0,1):
+			childname = tileFilename(level-1, (2*r+i,2*c+j))
+			if not os.path.exists(childname):
+				continue
+			child = mrc.read(childname)
+			outim[i*half:(i+1)*half, j*half:(j+1)*half] = imagefun.bin2(child[:2*half,:2*half], 2)
+	mrc.write(outim, tileFilename(level, tileindex))
+
+def runTileJob(job):
+	'''
+	Run one job in a worker.  Errors are returned rather than raised,
+	because Pool.apply_async has no error callback to report them.
+	'''
+	level, tileindex = job
+	try:
+		if level == 0:
+			result = makeTile(tileindex)
+		else:
+			result = makeLevelTile(level, tileindex)
+	except:
+		return job, None, traceback.format_exc()
+	return job, result, None
+
+## seconds between checks that no tile worker process has died
+worker_check_interval = 5.0
 
+def waitTileJob(pool, workers, done, results):
+	'''
+	Wait for the next job to finish and return what runTileJob returned.
+	A worker that is killed, e.g. for lack of memory, never finishes its
+	job, so the worker processes are checked while waiting.  workers is
+	the set of worker processes seen so far.
+	'''
+	while True:
+		try:
+			job = done.get(True, worker_check_interval)
+		except Queue.Empty:
+			## the pool replaces a dead worker, so look for it among all seen
+			workers.update(pool._pool)
+			for worker in workers:
+				if worker.exitcode is not None:
+					raise RuntimeError('tile worker process %d died with exit code %d' % (worker.pid, worker.exitcode))
+			continue
+		return results.pop(job).get(worker_check_interval)
+
+def createTiles(inputs, tiledict, tilesize, row1=None, row2=None, col1=None, col2=None, nproc=1, levels=0):
+	'''
+	Write each output tile as row_col.mrc, computing nproc tiles at a
+	time in worker processes.  With levels > 0, binned pyramid levels
+	are also written to levelN/, each tile as soon as the tiles it
+	bins are done, so no level is ever held in memory as a whole.
+	'''
 	if None in (row1,row2,col1,col2):
 		tileindices = tiledict.keys()
 	else:
@@ -409,42 +535,75 @@ def createTiles(inputs, tiledict, tilesize, row1=None, row2=None, col1=None, col
 			for coli in range(col1, col2+1):
 				tileindices.append((rowi,coli))
 
+	## for each binned tile, how many tiles below it are still to do
+	waiting = {}
+	below = tileindices
+	for level in range(1, levels+1):
+		if not os.path.isdir('level%d' % (level,)):
+			os.mkdir('level%d' % (level,))
+		for r,c in below:
+			key = (level, (r//2,c//2))
+			waiting[key] = waiting.get(key, 0) + 1
+		below = [tileindex for (l,tileindex) in waiting.keys() if l == level]
+
 	f = open('outputinfo', 'w')
 	f.close()
 
+	## finished jobs, and the AsyncResult of each job
+	done = Queue.Queue()
+	results = {}
+	if nproc > 1:
+		## workers are forked with the inputs, tile definitions and
+		## cached stage calibrations already in memory
+		pool = multiprocessing.Pool(nproc, initTileWorker, (inputs, tiledict, tilesize, splineorder))
+		workers = set(pool._pool)
+		def submit(job):
+			results[job] = pool.apply_async(runTileJob, (job,), callback=lambda result, job=job: done.put(job))
+	else:
+		pool = None
+		initTileWorker(inputs, tiledict, tilesize, splineorder)
+		todo = []
+		def submit(job):
+			todo.append(job)
+
+	for tileindex in tileindices:
+		submit((0, tileindex))
+
 	tilestotal = len(tileindices)
+	jobsleft = tilestotal + len(waiting)
+	tilesdone = 0
 	t0 = time.time()
-	for i,tileindex in enumerate(tileindices):
-			tileargs = tiledict[tileindex]
-			print 'Creating tile:', tileindex
-			output = MontageImage(*tileargs['args'], **tileargs['kwargs'])
-		
-			for input in inputs:
-				output.insertImage(input)
-			print '   Inserted %d images' % (output.inserted,)
-			if output.inserted:
-				outim = output.image
+	try:
+		while jobsleft:
+			if pool is None:
+				job, result, error = runTileJob(todo.pop(0))
 			else:
-				outim = blank
-		
+				job, result, error = waitTileJob(pool, workers, done, results)
+			jobsleft -= 1
+			if error is not None:
+				raise RuntimeError('tile %s of level %d failed:\n%s' % (job[1], job[0], error))
+			level, tileindex = job
+			parent = (level+1, (tileindex[0]//2,tileindex[1]//2))
+			if parent in waiting:
+				waiting[parent] -= 1
+				if not waiting[parent]:
+					submit(parent)
+			if level:
+				continue
+
+			inserted, x, y = result
+			print 'Created tile %s, inserted %d images' % (tileindex, inserted)
 			f = open('outputinfo', 'a')
 			r,c = tileindex
-			x,y = output.scope['stage position']['x'], output.scope['stage position']['y']
 			f.write('%d\t%d\t%e\t%e\n' % (r,c,x,y))
 			f.close()
-	
-			mrc.write(outim, '%d_%d.mrc' % tileindex)
-	
-			'''
-			jpeg.save(output.image, clip[0], clip[1], '%d_%d.jpg' % tileindex, 90)
-			'''
-	
-			tilesdone = i+1
+
+			tilesdone += 1
 			tilesleft = tilestotal - tilesdone
 			elapsed = time.time() - t0
 			tilespersec = tilesdone / elapsed
-	
-			secleft = tilesleft * tilespersec
+
+			secleft = tilesleft / tilespersec
 			hrleft = secleft / 3600.0
 			hrleft = int(hrleft)
 			secleft = secleft - hrleft * 3600.0
@@ -453,6 +612,10 @@ def createTiles(inputs, tiledict, tilesize, row1=None, row2=None, col1=None, col
 			secleft = secleft - minleft * 60.0
 			secleft = int(secleft)
 			print '   Done %d of %d, Avg: %.2f tiles/sec,  Estimated time left: %02d:%02d:%02d' % (tilesdone,tilestotal,tilespersec,hrleft,minleft,secleft)
+	finally:
+		if pool is not None:
+			pool.terminate()
+			pool.join()
 
 ########## End of classes and functions...
 ########## Now the script!
@@ -476,6 +639,8 @@ if __name__ == '__main__':
 	parser.add_option('-f', '--output-format-order', action='store', type='string', dest='outformat', help="jpeg or mrc")
 	parser.add_option('-O', '--output-text', action='store', type='string', dest='output_text', help="save transform details to file")
 	parser.add_option('-X', '--xml', action='store_true', dest='output_xml', help="save transform details to xml file")
+	parser.add_option('-n', '--processes', action='store', type='int', dest='nproc', default=1, help="number of processes generating tiles in parallel")
+	parser.add_option('-L', '--levels', action='store', type='int', dest='levels', default=0, help="also write this many binned levels of the tiles")
 
 	(options, args) = parser.parse_args()
 
@@ -577,7 +742,7 @@ if __name__ == '__main__':
 		print 'calc tiles'
 		tiledict = globaloutput.calculateTiles(tilesize)
 		#storeTileInfo(tiledict)
-		createTiles(inputimages, tiledict, tilesize)
+		createTiles(inputimages, tiledict, tilesize, nproc=options.nproc, levels=options.levels)
 	elif options.outfilename is not None:
 		createSingleImage(inputimages, globaloutput, options.outfilename, options.outformat, options.output_text)
 		#profile.run('createSingleImage(inputimages, globaloutput, options.outfilename, options.outformat)')
@@ -5,16 +5,99 @@
 #       For terms of the license agreement
 #       see  http://leginon.org
 #
+import collections
+import os
 import numpy
-from pyami import correlator, peakfinder, imagefun
+import scipy.ndimage
+from pyami import correlator, peakfinder, imagefun, mrc
 import math
 from leginon import leginondata
 
+class TilePyramid(object):
+	'''
+	A tile image binned by 2, 4, 8... computed once, so that the tile
+	can be scaled for a mosaic of any size by zooming the smallest level
+	that is still larger than the result.  Scaled images are cached for
+	the last few scales used.
+	'''
+	## smallest level kept
+	minsize = 64
+	## number of scaled images kept
+	maxscaled = 4
+
+	def __init__(self, image, levels=None):
+		self.shape = image.shape
+		if levels is None:
+			levels = self.makeLevels(image)
+		self.levels = levels
+		self.scaled = collections.OrderedDict()
+
+	def makeLevels(self, image):
+		levels = [image]
+		level = image
+		while min(level.shape) >= 2*self.minsize:
+			rows, cols = level.shape[0]//2*2, level.shape[1]//2*2
+			level = imagefun.bin2(numpy.asarray(level[:rows,:cols], numpy.float32), 2)
+			levels.append(level)
+		return levels
+
+	def scaledShape(self, scale):
+		'''shape of the tile scaled by scipy.ndimage.zoom'''
+		if scale == 1.0:
+			return self.shape
+		return tuple([int(round(dim * scale)) for dim in self.shape])
+
+	def getScaled(self, scale, numtype):
+		'''the tile scaled as by imagefun.scale, but zoomed from the pyramid'''
+		key = scale, numpy.dtype(numtype).char
+		if key in self.scaled:
+			scaled = self.scaled.pop(key)
+			self.scaled[key] = scaled
+			return scaled
+		shape = self.scaledShape(scale)
+		level = self.levels[0]
+		for level in reversed(self.levels):
+			if level.shape[0] >= shape[0] and level.shape[1] >= shape[1]:
+				break
+		if level.shape != shape:
+			zoom = [float(shape[i])/level.shape[i] for i in (0,1)]
+			level = scipy.ndimage.zoom(level, zoom, order=1)
+		if level.dtype.kind == 'f' and numpy.dtype(numtype).kind in 'iu':
+			level = numpy.rint(level)
+		scaled = numpy.asarray(level, numtype)
+		self.scaled[key] = scaled
+		while len(self.scaled) > self.maxscaled:
+			self.scaled.popitem(last=False)
+		return scaled
+
+	def save(self, path, name):
+		'''write the binned levels as MRC files name.pyr1.mrc, ...'''
+		for i, level in enumerate(self.levels[1:]):
+			mrc.write(level, os.path.join(path, '%s.pyr%d.mrc' % (name, i+1)))
+
+	@classmethod
+	def load(cls, image, path, name):
+		'''pyramid of image with levels read back from save, or None'''
+		levels = [image]
+		i = 1
+		while True:
+			filename = os.path.join(path, '%s.pyr%d.mrc' % (name, i))
+			if not os.path.exists(filename):
+				break
+			levels.append(mrc.read(filename))
+			i += 1
+		if len(levels) == 1 and min(image.shape) >= 2*cls.minsize:
+			return None
+		return cls(image, levels)
+
 class Tile(object):
-	def __init__(self, image, position, imagedata):
+	def __init__(self, image, position, imagedata=None, pyramid=None):
 		self.image = image
 		self.position = position
 		self.imagedata = imagedata
+		if pyramid is None and image is not None:
+			pyramid = TilePyramid(image)
+		self.pyramid = pyramid
 
 class Mosaic(object):
 	def __init__(self):
@@ -105,8 +188,7 @@ class Mosaic(object):
 			offset = (int(round(offset[0] * scale + scaleoffset[0])),
 									int(round(offset[1] * scale + scaleoffset[1])))
 
-			image = imagefun.scale(tile.image, scale)
-			image = numpy.asarray(image, numtype)
+			image = tile.pyramid.getScaled(scale, numtype)
 			mosaicimage[offset[0]:offset[0] + image.shape[0],
 									offset[1]:offset[1] + image.shape[1]] = image
 		self.scale = scale
@@ -315,15 +397,30 @@ class Mosaic(object):
 		return nearesttile, nearestdelta, location
 
 class EMTile(Tile):
-	def __init__(self, imagedata):
+	def __init__(self, imagedata, pyramid_path=None):
 		image = imagedata['image']
-		Tile.__init__(self, image, position=None, imagedata=imagedata)
+		pyramid = None
+		name = imagedata['filename']
+		if pyramid_path is not None and name:
+			pyramid = TilePyramid.load(image, pyramid_path, name)
+			if pyramid is None:
+				pyramid = TilePyramid(image)
+				try:
+					if not os.path.isdir(pyramid_path):
+						os.makedirs(pyramid_path)
+					pyramid.save(pyramid_path, name)
+				except (IOError, OSError), e:
+					# not writable, e.g. another user's session: keep it in memory
+					print 'tile pyramid of %s not saved: %s' % (name, e)
+		Tile.__init__(self, image, position=None, imagedata=imagedata, pyramid=pyramid)
 
 class EMMosaic(object):
 	def __init__(self, calibrationclient):
 		# This will be set to a float number once getMosaicImage is called
 		# with maxdimension is input
 		self.scale = None
+		# directory to keep tile pyramids in, so they are made only once
+		self.pyramid_path = None
 		self.setCalibrationClient(calibrationclient)
 		self.clear()
 
@@ -335,12 +432,18 @@ class EMMosaic(object):
 
 	def clear(self):
 		self.tiles = []
+		# last composed mosaic image, to add only the new tiles to
+		self.composed = None
 
 	def setCalibrationClient(self, calibrationclient):
 		self.calibrationclient = calibrationclient
+		self.composed = None
+
+	def setPyramidPath(self, path):
+		self.pyramid_path = path
 
 	def addTile(self, imagedata):
-		tile = EMTile(imagedata)
+		tile = EMTile(imagedata, self.pyramid_path)
 		self.tiles.append(tile)
 		return tile
 
@@ -447,38 +550,47 @@ class EMMosaic(object):
 
 		numtype = self.tiles[0].image.dtype
 
-		### find shape of final mosaic
-		### optimize me
+		### find shape of final mosaic and where the scaled tiles go
 		maxrow = maxcol = 0
+		placements = []
 		for tile in self.tiles:
-			scaled_tile = imagefun.scale(tile.image, scale)
-			scaled_tile = numpy.asarray(scaled_tile, numtype)
-			scaled_shape = scaled_tile.shape
+			scaled_shape = tile.pyramid.scaledShape(scale)
 			scaled_pos = self.scaled(tile.corner_pos)
-			rowslice1 = scaled_pos[0],scaled_pos[0]+scaled_shape[0]
-			colslice1 = scaled_pos[1],scaled_pos[1]+scaled_shape[1]
 			rowslice = slice(scaled_pos[0],scaled_pos[0]+scaled_shape[0])
 			colslice = slice(scaled_pos[1],scaled_pos[1]+scaled_shape[1])
-			if rowslice1[1] > maxrow:
-				maxrow = rowslice1[1]
-			if colslice1[1] > maxcol:
-				maxcol = colslice1[1]
+			placements.append((tile, rowslice, colslice))
+			if rowslice.stop > maxrow:
+				maxrow = rowslice.stop
+			if colslice.stop > maxcol:
+				maxcol = colslice.stop
 		### mosaic image shape
 		mshape = (maxrow,maxcol)
 
-		### create mosaic image
-		mosaicimage = numpy.zeros(mshape, numtype)
+		### reuse the last mosaic if only tiles were added since, and
+		### the ones it has did not move. Tiles are inserted in order,
+		### so the new ones go on top.
+		composed = self.composed
+		ndone = 0
+		if composed is not None and composed['scale'] == scale and composed['shape'] == mshape and composed['numtype'] == numtype:
+			done = composed['placements']
+			if len(done) <= len(placements):
+				for old, new in zip(done, placements):
+					if old[0] is not new[0] or old[1] != new[1] or old[2] != new[2]:
+						break
+				else:
+					ndone = len(done)
+		if ndone:
+			mosaicimage = composed['image']
+		else:
+			mosaicimage = numpy.zeros(mshape, numtype)
 
 		### scale and insert tiles
-		for tile in self.tiles:
-			scaled_tile = imagefun.scale(tile.image, scale)
-			scaled_tile = numpy.asarray(scaled_tile, numtype)
-			scaled_shape = scaled_tile.shape
-			scaled_pos = self.scaled(tile.corner_pos)
-			rowslice = slice(scaled_pos[0],scaled_pos[0]+scaled_shape[0])
-			colslice = slice(scaled_pos[1],scaled_pos[1]+scaled_shape[1])
+		for tile, rowslice, colslice in placements[ndone:]:
+			scaled_tile = tile.pyramid.getScaled(scale, numtype)
 			mosaicimage[rowslice, colslice] = scaled_tile
-		return mosaicimage
+		self.composed = {'scale': scale, 'shape': mshape, 'numtype': numtype, 'placements': placements, 'image': mosaicimage}
+		## callers may draw on the result
+		return mosaicimage.copy()
 
 	def distanceToTile(self, tile, row, col):
 		tilepos = tile.center_pos
@@ -430,6 +430,13 @@ class MosaicClickTargetFinder(targetfinder.ClickTargetFinder, imagehandler.Image
 		self.clearMosaicImage()
 		self.clearFinderMosaicImage()
 
+	def getPyramidPath(self, imagedata):
+		'''
+		Directory in the session of the tile image to keep its binned
+		pyramid in, so reloading the mosaic does not bin it again.
+		'''
+		return os.path.join(imagedata['session']['image path'], 'pyramid')
+
 	def addTile(self, imagedata):
 		'''
 		Add tile into mosaic and various mappings. Lock autofinder
@@ -449,6 +456,9 @@ class MosaicClickTargetFinder(targetfinder.ClickTargetFinder, imagehandler.Image
 		'''
 		self.logger.info('Adding image to mosaic')
 		imid = imagedata.dbid
+		pyramid_path = self.getPyramidPath(imagedata)
+		self.mosaic.setPyramidPath(pyramid_path)
+		self.finder_mosaic.setPyramidPath(pyramid_path)
 		newtile = self.mosaic.addTile(imagedata)
 		self.finder_mosaic.addTile(imagedata)
 		self.tilemap[imid] = newtile
@@ -958,6 +968,7 @@ class MosaicClickTargetFinder(targetfinder.ClickTargetFinder, imagehandler.Image
 		tiles = self._researchMosaicTileData(tile_imagelist, tile_imagelist['session'])
 		for i, tile in enumerate(tiles):
 			imagedata = tile['image']
+			self.oldmosaic.setPyramidPath(self.getPyramidPath(imagedata))
 			added_tile = self.oldmosaic.addTile(imagedata)
 			imid = imagedata.dbid
 			self.oldtilemap[imid] = added_tile
@@ -3,7 +3,6 @@
 import os
 import sys
 import shutil
-import filecmp
 import subprocess
 import time
 import numpy
@@ -17,6 +16,7 @@ mtime = 0
 query_day_limit = 10 # ignore database query for older dates
 expired_names = ['.DS_Store',] # files that should not be transferred
 check_interval = 20  # seconds between checking for new frames
+settle_time = 10 # seconds since last modification before a source is considered completely written
 max_image_query_delay = 1200 # seconds before an image query by CameraEMData.'frames name' should be queryable. Need to account for difference in the clocks of the camera computer and where this script is running.
 
 class RawTransfer(filetransfer.FileTransfer):
@@ -24,6 +24,7 @@ class RawTransfer(filetransfer.FileTransfer):
 		super(RawTransfer, self).setOptions(parser)
 		# options
 		parser.add_option("--cleanup_delay_minutes", dest="cleanup_delay_minutes", help="Delay non-database recorded images clean up by this. default is 20 min", type="float", default=max_image_query_delay/60.0)
+		parser.add_option("--workers", dest="workers", help="Number of files transferred at the same time, default is 4", type="int", default=4)
 
 	def query_image_by_frames_name(self,name,cam_host,dest_head):
 		# speed up query by adding time limit Issue #6127
@@ -91,6 +92,10 @@ class RawTransfer(filetransfer.FileTransfer):
 		self.makeDirWithOwnershipChange(sessionpath,uid,gid)
 		self.makeDirWithOwnershipChange(dirname,uid,gid)
 
+		if method == 'copy' and not self.is_win32:
+			# one streaming pass with checksum. ownership and mode are
+			# set on each file as it is copied.
+			return self.copyWithChecksum(src,dst,uid,gid,mode_str)
 		if method == 'rsync' and not self.is_win32:
 			# safer method but slower
 			self._rsyncWithOwnershipChange(src,dst,uid,gid,method)
@@ -101,17 +106,85 @@ class RawTransfer(filetransfer.FileTransfer):
 
 		if mode_str:
 			self.changeMode(dst, mode_str, recursive=True)
+		if os.path.isfile(dst):
+			return os.path.getsize(dst)
+		return 0
 
 		# comment out cleanUp here and rely on rsync to do its job
 		# and clean up on the next source search iteration.
 		# see Issue #10244
 		# self.cleanUp(src,method)
 
+	def transferJob(self, src_path, dst_path, imdata, uid, gid, method, mode_str):
+		'''
+		File operations of one frames source, run in a pool worker.
+		Returns the number of bytes transferred.
+		'''
+		# skip  and clean up finished ones. Needed when the
+		# destination user lost write privilege temporarily.
+		if os.path.exists(dst_path):
+			if os.path.isfile(dst_path):
+				# check files to be identical.
+				if self.isSameFile(src_path, dst_path):
+					print 'Destination path %s is good, cleaning up source' % dst_path
+					os.remove(src_path)
+					return 0
+				else:
+					print 'Destination path %s not good, redo transfer' % dst_path
+					self.cleanUp(dst_path,method)
+			#TODO: directory ?
+		# do actual copy and delete
+		nbytes = self.transfer(src_path, dst_path, uid, gid, method, mode_str)
+		# de only
+		leginon.ddinfo.saveImageDDinfoToDatabase(imdata,os.path.join(dst_path,'info.txt'))
+		# falcon3 only, xml file transfer
+		xml_src_path = src_path.replace('mrc','xml')
+		xml_dst_path = dst_path.replace('mrc','xml')
+		if os.path.exists(xml_src_path):
+			nbytes += self.transfer(xml_src_path, xml_dst_path, uid, gid, method, mode_str)
+		return nbytes
+
+	def isSameFile(self, src_path, dst_path):
+		'''
+		Quick check like rsync: same size and modification time.  All
+		transfer methods keep the source mtime, so this needs no read
+		of either file.
+		'''
+		src_stat = os.stat(src_path)
+		dst_stat = os.stat(dst_path)
+		return src_stat.st_size == dst_stat.st_size and int(src_stat.st_mtime) == int(dst_stat.st_mtime)
+
+	def getNewestModifiedTime(self, path):
+		'''
+		modification time of path, or of the newest file in it if it is
+		a directory such as .frames.  Writing a file into a directory does
+		not change the directory mtime.
+		'''
+		newest = os.path.getmtime(path)
+		if os.path.isdir(path):
+			for dirpath, dirnames, filenames in os.walk(path):
+				for name in dirnames + filenames:
+					try:
+						newest = max(newest, os.path.getmtime(os.path.join(dirpath, name)))
+					except OSError:
+						# removed while walking
+						pass
+		return newest
+
+	def isSettled(self, path):
+		'''
+		True if path has not been modified for settle_time seconds, so the
+		camera has finished writing it.
+		'''
+		try:
+			return time.time() - self.getNewestModifiedTime(path) >= settle_time
+		except OSError:
+			return False
+
 	def run_once(self,parent_src_path,cam_host,dest_head,method,mode_str):
 		global next_time_start
 		global mtime
 		names = os.listdir(parent_src_path)
-		time.sleep(10)  # wait for any current writes to finish
 		time_start = next_time_start
 		for name in names:
 			src_path = os.path.join(parent_src_path, name)
@@ -119,6 +192,9 @@ class RawTransfer(filetransfer.FileTransfer):
 			# skip expired dirs, mrcs
 			if name in expired_names:
 				continue
+			# skip sources queued or being transferred by the pool
+			if self.pool.isActive(src_path) or self.pool.isActive(src_path + os.sep):
+				continue
 			print '**checking', src_path
 			# check access instead of wait for files to write. Speeds up interval
 			try:
@@ -141,6 +217,11 @@ class RawTransfer(filetransfer.FileTransfer):
 			if not ext.startswith('.mrc') and ext != '.tif' and  ext !='.eer' and ext != '.frames' and not name.startswith('20'):
 				continue
 
+			# wait for any current writes to finish
+			if not self.isSettled(src_path):
+				print 'still being written. Deferring to next iteration'
+				continue
+
 			# adjust next expiration timer to most recent time
 			if mtime > next_time_start:
 				next_time_start = mtime
@@ -202,28 +283,14 @@ class RawTransfer(filetransfer.FileTransfer):
 				except:
 					raise
 					print 'reference copying error. skip'
-			# skip  and clean up finished ones. Needed when the
-			# destination user lost write privilege temporarily.
-			if os.path.exists(dst_path):
-				if os.path.isfile(dst_path):
-					# check files to be identical.
-					if filecmp.cmp(src_path, dst_path):
-						print 'Destination path %s is good, cleaning up source' % dst_path
-						os.remove(src_path)
-						return
-					else:
-						print 'Destination path %s not good, redo transfer' % dst_path
-						self.cleanUp(dst_path,method)
-				#TODO: directory ?
-			# do actual copy and delete
-			self.transfer(src_path, dst_path, uid, gid, method, mode_str)
-			# de only
-			leginon.ddinfo.saveImageDDinfoToDatabase(imdata,os.path.join(dst_path,'info.txt'))
-			# falcon3 only, xml file transfer
-			xml_src_path = src_path.replace('mrc','xml')
-			xml_dst_path = dst_path.replace('mrc','xml')
-			if os.path.exists(xml_src_path):
-				self.transfer(xml_src_path, xml_dst_path, uid, gid, method, mode_str)
+			# file operations are done by the worker pool
+			self.pool.submit(src_path, self.transferJob, src_path, dst_path, imdata, uid, gid, method, mode_str)
+		self.printPoolStatus()
+
+	def printPoolStatus(self):
+		stats = self.pool.getStats()
+		elapsed = time.time() - self.pool_start
+		print 'Transfer queue depth %d, %d done, %d failed, %.1f GB at %.1f MB/s since start' % (stats['queued'], stats['done'], stats['failed'], stats['bytes']/1e9, stats['bytes']/1e6/max(elapsed, 1e-6))
 
 	def run(self):
 		self.params = self.parseParams()
@@ -233,6 +300,8 @@ class RawTransfer(filetransfer.FileTransfer):
 		dst_head = self.get_dst_head()
 		if dst_head:
 			print "Limit processing to destination frame path started with %s" % (dst_head)
+		self.pool = filetransfer.TransferPool(self.params['workers'])
+		self.pool_start = time.time()
 		while True:
 			print 'Iterating...'
 			self.run_once(src_path,self.params['camera_host'],dst_head,method=self.params['method'], mode_str=self.params['mode_str'])
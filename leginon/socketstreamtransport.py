@@ -9,15 +9,45 @@
 DEBUG = False
 
 import cPickle as pickle
+import cStringIO
+import os
 import socket
 import SocketServer
+import struct
 import threading
 import math
+import numpy
 import datatransport
 from pyami import mysocket
 
 CHUNK_SIZE = 8*1024*1024
 
+## Out-of-band array framing.  Arrays of at least OOB_MIN_BYTES are taken
+## out of the pickle and sent as raw buffers after it, then received
+## directly into new arrays.  Between processes of the same user on the
+## same host, arrays of at least SHM_MIN_BYTES are passed through files in
+## SHM_DIR instead.  An array that can not be written there, e.g. when it
+## is full, is sent in the stream.  The receiver maps the files copy on
+## write and removes all of them of a message, also when it fails.  If it
+## can not read them, the server answers SHM_FAILED without handling the
+## request, and the client sends it again without shared memory.
+## A message without OOB_MAGIC is a plain pickle, so old clients still work.
+## A client asks each server once with a plain pickled framing ping, and
+## only frames requests to servers that answer it, so old servers still
+## work too.
+OUT_OF_BAND = True
+OOB_MAGIC = 'LOB1'
+OOB_MIN_BYTES = 64*1024
+SHM_DIR = '/dev/shm'
+SHM_MIN_BYTES = 1024*1024
+SHM_FAILED = 'LOB1 shared memory failed'
+shm_counter = [0]
+shm_lock = threading.Lock()
+## server location -> (True if it reads out-of-band framing,
+## True if it may be sent arrays in shared memory)
+framing_servers = {}
+framing_lock = threading.Lock()
+
 # from Tao of Mac
 # Hideous fix to counteract http://python.org/sf/1092502
 # (which should have been fixed ages ago.)
@@ -75,6 +105,197 @@ def _fixed_socket_read(self, size=-1):
 if not hasattr(socket, 'StringIO'):
 	socket._fileobject.read = _fixed_socket_read
 
+def shmAvailable():
+	return os.path.isdir(SHM_DIR) and os.access(SHM_DIR, os.W_OK)
+
+def shmUser():
+	'''user id that must match for shared memory files, None on Windows'''
+	if hasattr(os, 'getuid'):
+		return os.getuid()
+	return None
+
+def writeShm(a):
+	'''
+	Write contiguous array a to a new file in SHM_DIR and return its
+	name, or None if that fails.  Writing rather than mapping a sparse
+	file allocates the pages now, so a full SHM_DIR gives ENOSPC here
+	instead of SIGBUS when they are first touched.
+	'''
+	shmname = newShmName()
+	try:
+		fd = os.open(shmname, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600)
+		f = os.fdopen(fd, 'wb')
+		try:
+			f.write(byteView(a))
+		finally:
+			f.close()
+	except (IOError, OSError):
+		removeShm([shmname])
+		return None
+	return shmname
+
+def removeShm(shmnames):
+	for shmname in shmnames:
+		try:
+			os.remove(shmname)
+		except OSError:
+			pass
+
+class ShmError(Exception):
+	pass
+
+def newShmName():
+	shm_lock.acquire()
+	try:
+		shm_counter[0] += 1
+		n = shm_counter[0]
+	finally:
+		shm_lock.release()
+	return os.path.join(SHM_DIR, 'leginon-transport-%d-%d' % (os.getpid(), n))
+
+def byteView(a):
+	'''flat uint8 memoryview of a contiguous array, no copy'''
+	return memoryview(a.reshape(-1).view(numpy.uint8))
+
+def recvExact(sock, nbytes):
+	buf = bytearray(nbytes)
+	recvInto(sock, memoryview(buf))
+	return str(buf)
+
+def recvInto(sock, view):
+	nbytes = len(view)
+	pos = 0
+	while pos < nbytes:
+		n = sock.recv_into(view[pos:], nbytes - pos)
+		if not n:
+			raise EOFError('connection closed after %d of %d bytes' % (pos, nbytes))
+		pos += n
+
+class PrefixedFile(object):
+	'''file-like object that reads prefix before reading fileobj'''
+	def __init__(self, prefix, fileobj):
+		self.prefix = prefix
+		self.fileobj = fileobj
+
+	def read(self, size=-1):
+		if not self.prefix:
+			return self.fileobj.read(size)
+		if size < 0:
+			data = self.prefix + self.fileobj.read()
+		elif size <= len(self.prefix):
+			data = self.prefix[:size]
+		else:
+			data = self.prefix + self.fileobj.read(size - len(self.prefix))
+		self.prefix = self.prefix[len(data):]
+		return data
+
+	def readline(self):
+		if not self.prefix:
+			return self.fileobj.readline()
+		i = self.prefix.find('\n')
+		if i >= 0:
+			return self.read(i+1)
+		return self.read(len(self.prefix)) + self.fileobj.readline()
+
+def sendObject(sock, obj, use_shm=False):
+	'''
+	Pickle obj with large arrays framed out of band and send it.
+	With use_shm, the largest arrays are copied once into shared memory
+	files that the receiver maps and unlinks, or sent in the stream if
+	that fails.
+	'''
+	descriptors = []
+	rawarrays = []
+	shmnames = []
+	def persistent_id(o):
+		if type(o) is not numpy.ndarray or o.dtype.hasobject or o.nbytes < OOB_MIN_BYTES:
+			return None
+		a = numpy.ascontiguousarray(o)
+		shmname = None
+		if use_shm and a.nbytes >= SHM_MIN_BYTES:
+			shmname = writeShm(a)
+		if shmname is None:
+			rawarrays.append(a)
+		else:
+			shmnames.append(shmname)
+		descriptors.append((a.dtype.str, a.shape, shmname))
+		return len(descriptors) - 1
+	try:
+		f = cStringIO.StringIO()
+		p = pickle.Pickler(f, pickle.HIGHEST_PROTOCOL)
+		p.persistent_id = persistent_id
+		p.dump(obj)
+		mainpickle = f.getvalue()
+		descpickle = pickle.dumps(descriptors, pickle.HIGHEST_PROTOCOL)
+		header = OOB_MAGIC + struct.pack('!QQ', len(descpickle), len(mainpickle))
+		sock.sendall(header + descpickle)
+		sock.sendall(mainpickle)
+		for a in rawarrays:
+			if a.nbytes:
+				sock.sendall(byteView(a))
+	except:
+		## receiver never got the names, so remove the files here
+		removeShm(shmnames)
+		raise
+
+def recvObject(sock, rfile=None):
+	'''
+	Receive one object sent either by sendObject or as a plain pickle.
+	rfile is an unread file object of sock, used for a plain pickle.
+	Returns (object, framed, used_shm).  Raises ShmError, after reading
+	the whole message, if a shared memory file could not be read.
+	'''
+	prefix = recvExact(sock, len(OOB_MAGIC))
+	if prefix != OOB_MAGIC:
+		if rfile is None:
+			rfile = sock.makefile('rb')
+		return pickle.load(PrefixedFile(prefix, rfile)), False, False
+	desclen, mainlen = struct.unpack('!QQ', recvExact(sock, 16))
+	descriptors = pickle.loads(recvExact(sock, desclen))
+	mainpickle = recvExact(sock, mainlen)
+	shmnames = [shmname for dtype, shape, shmname in descriptors if shmname is not None]
+	arrays = []
+	shm_error = None
+	try:
+		for dtype, shape, shmname in descriptors:
+			if shmname is None:
+				a = numpy.empty(shape, dtype)
+				if a.nbytes:
+					recvInto(sock, byteView(a))
+				arrays.append(a)
+				continue
+			if shm_error is not None:
+				## still read the arrays in the stream after it
+				continue
+			## copy on write: the file is opened read-only, and
+			## the mapping stays valid after unlink
+			try:
+				m = numpy.memmap(shmname, dtype=dtype, mode='c', shape=shape)
+			except (IOError, OSError, ValueError), e:
+				shm_error = e
+				continue
+			arrays.append(m.view(numpy.ndarray))
+	finally:
+		removeShm(shmnames)
+	if shm_error is not None:
+		raise ShmError('error reading shared memory, %s' % (shm_error,))
+	used_shm = bool(shmnames)
+	u = pickle.Unpickler(cStringIO.StringIO(mainpickle))
+	u.persistent_load = arrays.__getitem__
+	return u.load(), True, used_shm
+
+def framingPing():
+	'''
+	A Ping that servers reading out-of-band framing answer with
+	(OOB_MAGIC, user id).  Older servers answer any Ping with None.
+	'''
+	ping = datatransport.Ping()
+	ping.framing = OOB_MAGIC
+	return ping
+
+def isFramingPing(request):
+	return isinstance(request, datatransport.Ping) and getattr(request, 'framing', None) == OOB_MAGIC
+
 class ExitException(Exception):
 	pass
 
@@ -92,7 +313,14 @@ class Handler(SocketServer.StreamRequestHandler):
 
 	def handle(self):
 		try:
-			request = pickle.load(self.rfile)
+			request, framed, used_shm = recvObject(self.request, self.rfile)
+		except ShmError, e:
+			## not handled, so the client can send it again in the stream
+			try:
+				sendObject(self.request, SHM_FAILED)
+			except Exception:
+				pass
+			return
 		except Exception, e:
 			estr = 'error reading request, %s' % e
 			try:
@@ -103,6 +331,8 @@ class Handler(SocketServer.StreamRequestHandler):
 
 		if isinstance(request, ExitException):
 			result = None
+		elif isFramingPing(request):
+			result = (OOB_MAGIC, shmUser())
 		else:
 			try:
 				result = self.server.datahandler.handle(request)
@@ -121,16 +351,20 @@ class Handler(SocketServer.StreamRequestHandler):
 			print 'request', request.__class__.__name__
 			print 'result to send', displayed_result
 		try:
-			s = pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
-			psize = len(s)
-			nchunks = int(math.ceil(float(psize) / float(CHUNK_SIZE)))
-			for i in range(nchunks):
-				start = i * CHUNK_SIZE
-				end = start + CHUNK_SIZE
-				chunk = s[start:end]
-				#Peng Hack
-				self.request.send(chunk)
-			self.wfile.flush()
+			if framed:
+				## answer in the framing the client used
+				sendObject(self.request, result, use_shm=used_shm)
+			else:
+				s = pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+				psize = len(s)
+				nchunks = int(math.ceil(float(psize) / float(CHUNK_SIZE)))
+				for i in range(nchunks):
+					start = i * CHUNK_SIZE
+					end = start + CHUNK_SIZE
+					chunk = s[start:end]
+					#Peng Hack
+					self.request.send(chunk)
+				self.wfile.flush()
 		except Exception, e:
 			estr = 'error responding to request, %s' % e
 			try:
@@ -170,8 +404,61 @@ class Client(object):
 	def __init__(self, location):
 		self.serverlocation = location
 
+	def sameHost(self):
+		'''True if shared memory can be used to reach the server'''
+		return False
+
 	def send(self, request):
-		s = self.connect()
+		if OUT_OF_BAND:
+			reads_framing, shm_ok = self.serverFraming()
+			if reads_framing:
+				use_shm = shm_ok and self.sameHost() and shmAvailable()
+				result = self.sendFramed(self.connect(), request, use_shm)
+				if use_shm and isinstance(result, str) and result == SHM_FAILED:
+					## the server did not handle it, send it in the stream
+					self.setServerFraming((True, False))
+					result = self.sendFramed(self.connect(), request, False)
+				return result
+		return self.sendPlain(self.connect(), request)
+
+	def framingKey(self):
+		return repr(sorted(self.serverlocation.items()))
+
+	def setServerFraming(self, framing):
+		framing_lock.acquire()
+		try:
+			framing_servers[self.framingKey()] = framing
+		finally:
+			framing_lock.release()
+
+	def serverFraming(self):
+		'''
+		Ask the server once, with a plain pickle, whether it reads
+		out-of-band framing, and whether it runs as the same user, so
+		it can read and remove shared memory files.  The answer is kept
+		for its location.
+		'''
+		framing_lock.acquire()
+		try:
+			framing = framing_servers.get(self.framingKey())
+		finally:
+			framing_lock.release()
+		if framing is not None:
+			return framing
+		try:
+			answer = self.sendPlain(self.connect(), framingPing())
+		except TransportError:
+			## not known yet, ask again next time
+			return False, False
+		if isinstance(answer, tuple) and len(answer) == 2 and answer[0] == OOB_MAGIC:
+			framing = True, (answer[1] is not None and answer[1] == shmUser())
+		else:
+			framing = False, False
+		self.setServerFraming(framing)
+		return framing
+
+	def sendPlain(self, s, request):
+		'''send request and receive result as plain pickles'''
 		try:
 			sfile = s.makefile('rwb')
 		except Exception, e:
@@ -220,6 +507,21 @@ class Client(object):
 
 		return result
 
+	def sendFramed(self, s, request, use_shm=False):
+		'''send request and receive result with out-of-band arrays'''
+		try:
+			sendObject(s, request, use_shm=use_shm)
+		except Exception, e:
+			s.close()
+			raise TransportError('error sending request, %s' % e)
+		try:
+			result, framed, used_shm = recvObject(s)
+		except Exception, e:
+			raise TransportError('error receiving response, %s' % e)
+		finally:
+			s.close()
+		return result
+
 	def connect(self):
 		raise NotImplementedError
 
@@ -26,25 +26,27 @@ class StatsHole(object):
 		self.stats['hole_std'] = holestats['std']
 
 class HoleStatsCalculator(Configurer):
-	def __init__(self):
-		self.circle = pyami.circle.CircleMaskCreator()
+	def __init__(self, circle=None):
+		if circle is None:
+			circle = pyami.circle.CircleMaskCreator()
+		self.circle = circle
 		self.setDefaults({'radius':20,'im':None})
 
 	def calc_stats(self, holes):
-		bad_indices = []
+		'''
+		Set stats of all holes in one batch. Holes too close to the
+		image edge are removed.
+		'''
 		im = self.configs['im']
 		r = self.configs['radius']
-		for i, hole in enumerate(holes):
-			center = hole.stats['center']
-			holestats = self.calc_center_holestats(center, im, r)
-			if holestats is None:
-				bad_indices.append(i)
-			else:
+		centers = map((lambda x: x.stats['center']), holes)
+		allstats = self.circle.get_circles_stats(im, centers, r)
+		good_holes = []
+		for hole, holestats in zip(holes, allstats):
+			if holestats is not None:
 				hole.set_holestats(holestats, r)
-		bad_indices.sort()
-		bad_indices.reverse()
-		for b in bad_indices:
-			holes.pop(b)
+				good_holes.append(hole)
+		holes[:] = good_holes
 		return holes
 
 	def calc_center_holestats(self, coord, im, r):
@@ -66,6 +66,13 @@ class Client(socketstreamtransport.Client):
 	def __init__(self, location):
 		socketstreamtransport.Client.__init__(self, location)
 
+	def sameHost(self):
+		try:
+			hostname = self.serverlocation['hostname']
+		except KeyError:
+			return False
+		return hostname in ('localhost', mysocket.gethostname().lower())
+
 	def connect(self, family=socket.AF_INET, type=socket.SOCK_STREAM):
 		s = socket.socket(family, type)
 		try:
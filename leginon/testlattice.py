@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+'''
+Compare the fitted lattice used for many points with the exact search
+of pointsToLattice on jittered, shuffled square lattices.  The fitted
+lattice should keep at least as many holes in total, and no more than
+one fewer in any single lattice.
+'''
+import math
+import numpy
+import lattice
+
+def makeLattice(seed, n=24, spacing=20.0, angle=0.3, jitter=0.5):
+	random = numpy.random.RandomState(seed)
+	i, j = numpy.mgrid[0:n, 0:n]
+	v = spacing * numpy.array((math.cos(angle), math.sin(angle)))
+	w = numpy.array((v[1], -v[0]))
+	points = 50 + i.ravel()[:,None]*v + j.ravel()[:,None]*w
+	points += random.normal(0, jitter, points.shape)
+	points = points[random.permutation(len(points))]
+	return [tuple(p) for p in points]
+
+def latticeSize(points, exact):
+	saved = lattice.exact_max_points
+	if exact:
+		lattice.exact_max_points = len(points)
+	else:
+		lattice.exact_max_points = 0
+	try:
+		return len(lattice.pointsToLattice(points, 20.0, 0.1).points)
+	finally:
+		lattice.exact_max_points = saved
+
+def test(nseeds=10):
+	totalfit = 0
+	totalexact = 0
+	for seed in range(nseeds):
+		points = makeLattice(seed)
+		nfit = latticeSize(points, exact=False)
+		nexact = latticeSize(points, exact=True)
+		print 'seed %d: fitted %d, exact %d of %d' % (seed, nfit, nexact, len(points))
+		assert nfit >= nexact - 1
+		totalfit += nfit
+		totalexact += nexact
+	assert totalfit >= totalexact
+	print 'OK'
+
+if __name__ == '__main__':
+	test()
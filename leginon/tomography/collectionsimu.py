@@ -88,7 +88,7 @@ class Collection(object):
 			correlation_bin = self.calcBinning(maxsize, 256, 512)
 		else:
 			correlation_bin = 1
-		self.correlator = tiltcorrelator.Correlator(self.node, self.theta, correlation_bin, lpf)
+		self.correlator = tiltcorrelator.Correlator(self.node, self.theta, correlation_bin, lpf, search_levels=3)
 
 		if self.settings['run buffer cycle']:
 			self.runBufferCycle()
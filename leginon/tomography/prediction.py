@@ -342,16 +342,13 @@ class Prediction(object):
 		if len(xs) != len(ys):
 			return 0
 		m = len(xs)
-		xa = scipy.zeros((m, 1), scipy.dtype('d'))
-		ya = scipy.zeros((m, 1), scipy.dtype('d'))
-		for i in range(m):
-			xa[i] = xs[i]
-			ya[i] = ys[i]
-		xmean = sum(xa)/m
-		ssxx = sum(xa*xa) - m*xmean*xmean
-		ymean = sum(ya)/m
-		ssyy = sum(ya*ya) - m*ymean*ymean
-		ssxy = sum(xa*ya) - m*xmean*ymean
+		xa = numpy.asarray(xs, numpy.float64)
+		ya = numpy.asarray(ys, numpy.float64)
+		xmean = xa.sum()/m
+		ssxx = numpy.dot(xa, xa) - m*xmean*xmean
+		ymean = ya.sum()/m
+		ssyy = numpy.dot(ya, ya) - m*ymean*ymean
+		ssxy = numpy.dot(xa, ya) - m*xmean*ymean
 		r2 = ssxy * ssxy / (ssxx * ssyy)
 		return r2
 
@@ -438,9 +435,18 @@ class Prediction(object):
 				debug_print('%d tilts are included for fitting from series %d' % (len(goodtilts),s))
 		# There should be at least one tilt series (current one) left at this point
 		debug_print('%d tilt series left for fitting' % len(args_list))
-		args = (args_list,)
+		fitdata = self.stackArgs(args_list)
+		if self.fixed_model:
+			# phi and optical axis are held, so z0 of each tilt series
+			# is a linear least squares fit with a closed form solution
+			return parameters[:2] + list(self.fitZ(phi, optical_axis, fitdata))
+		# start z0 from their best fit at the current phi and optical axis
+		# so that leastsq only has to refine from there
+		parameters[2:] = self.fitZ(phi, optical_axis, fitdata)
+		args = (fitdata,)
 		kwargs = {
 			'args': args,
+			'Dfun': self.jacobian,
 			#'full_output': 1,
 			#'ftol': 1e-12,
 			#'xtol': 1e-12,
@@ -460,66 +466,120 @@ class Prediction(object):
 		zs = scipy.array(parameters[2:], scipy.dtype('d'))
 		return phi, optical_axis, zs
 
+	def stackArgs(self, args_list):
+		'''
+		Concatenate the (cos_tilts, sin_tilts, x0, y0, x, y) of each tilt
+		series into flat arrays, with the index of the series of each tilt,
+		so that model and residuals work on all series at once.
+		'''
+		counts = [args[0].shape[0] for args in args_list]
+		fitdata = {
+			'counts': counts,
+			'index': numpy.repeat(numpy.arange(len(args_list)), counts),
+			'cos_tilts': numpy.concatenate([args[0] for args in args_list]),
+			'sin_tilts': numpy.concatenate([args[1] for args in args_list]),
+			'x0': numpy.repeat([args[2] for args in args_list], counts),
+			'y0': numpy.repeat([args[3] for args in args_list], counts),
+		}
+		if args_list and args_list[0][4] is not None:
+			fitdata['x'] = numpy.concatenate([args[4] for args in args_list])
+			fitdata['y'] = numpy.concatenate([args[5] for args in args_list])
+		return fitdata
+
+	def modelXY(self, phi, optical_axis, zs, fitdata):
+		'''
+		model x, y positions of the stacked fit data and the intermediate
+		values the jacobian needs
+		'''
+		sin_phi = math.sin(phi)
+		cos_phi = math.cos(phi)
+		cos_tilts = fitdata['cos_tilts']
+		sin_tilts = fitdata['sin_tilts']
+		z = zs[fitdata['index']]
+		# transform position, rotate, inverse transform to get rotated x, y, z
+		u = cos_phi*fitdata['x0'] + sin_phi*fitdata['y0'] + optical_axis
+		v = -sin_phi*fitdata['x0'] + cos_phi*fitdata['y0']
+		w = sin_tilts*u + cos_tilts*z
+		p = cos_tilts*u - sin_tilts*z - optical_axis
+		x = cos_phi*p - sin_phi*v
+		y = sin_phi*p + cos_phi*v
+		return x, y, w, u, v, p
+
 	def model(self, parameters, args_list):
 		'''
 		x, y positions according to phi, optical axis and each zs
 		'''
 		phi, optical_axis, zs = self.getParameters(parameters)
-		sin_phi = scipy.sin(phi)
-		cos_phi = scipy.cos(phi)
-		position_groups = []
-		for i, (cos_tilts, sin_tilts, x0, y0, x, y) in enumerate(args_list):
-			positions = scipy.zeros((cos_tilts.shape[0], 3), 'd')
-			z = zs[i]
-			# transform position, rotate, inverse transform to get rotated x, y, z
-			positions[:, 0] = cos_phi*x0 + sin_phi*y0
-			positions[:, 1] = -sin_phi*x0 + cos_phi*y0
-			positions[:, 0] += optical_axis
-			positions[:, 2] = sin_tilts*positions[:, 0] + cos_tilts*(z)
-			positions[:, 0] = cos_tilts*positions[:, 0] - sin_tilts*(z)
-			positions[:, 0] -= optical_axis
-			x_positions = cos_phi*positions[:, 0] - sin_phi*positions[:, 1]
-			y_positions = sin_phi*positions[:, 0] + cos_phi*positions[:, 1]
-			positions[:, 0] = x_positions
-			positions[:, 1] = y_positions
-			position_groups.append(positions)
-		return position_groups
-
-	def residuals(self, parameters, args_list):
+		fitdata = self.stackArgs(args_list)
+		x, y, w = self.modelXY(phi, optical_axis, zs, fitdata)[:3]
+		positions = numpy.column_stack((x, y, w))
+		return numpy.split(positions, numpy.cumsum(fitdata['counts'])[:-1])
+
+	def residuals(self, parameters, fitdata):
 		'''
-		Calculate residual list which sum of squares is to be minimized.
+		Calculate residual array which sum of squares is to be minimized:
+		the x residuals of all tilts followed by the y residuals.
 		'''
-		residuals_list = []
-		position_groups = self.model(parameters, args_list)
-		for i, positions in enumerate(position_groups):
-			n = positions.shape[0]
-			cos_tilts, sin_tilts, x0, y0, x, y = args_list[i]
-			residuals = scipy.zeros((n, 2), scipy.dtype('d'))
-			residuals[:, 0] = x
-			residuals[:, 1] = y
-			residuals -= positions[:, :2]
-			# put in list
-			residuals_list.extend(residuals[:, 0])
-			residuals_list.extend(residuals[:, 1])
-		residuals_list = scipy.array(residuals_list, scipy.dtype('d'))
-		residuals_list.shape = (residuals_list.size,)
-		return residuals_list
+		phi, optical_axis, zs = self.getParameters(parameters)
+		x, y = self.modelXY(phi, optical_axis, zs, fitdata)[:2]
+		return numpy.concatenate((fitdata['x'] - x, fitdata['y'] - y))
+
+	def jacobian(self, parameters, fitdata):
+		'''
+		Analytic derivatives of residuals with respect to phi, optical
+		axis and each z0, one row per residual.
+		'''
+		phi, optical_axis, zs = self.getParameters(parameters)
+		x, y, w, u, v, p = self.modelXY(phi, optical_axis, zs, fitdata)
+		sin_phi = math.sin(phi)
+		cos_phi = math.cos(phi)
+		cos_tilts = fitdata['cos_tilts']
+		sin_tilts = fitdata['sin_tilts']
+		index = fitdata['index']
+		n = index.shape[0]
+		jac = numpy.zeros((2*n, len(parameters)))
+		if not self.fixed_model:
+			# d/dphi of u is v and of v is -(u - optical_axis)
+			dp = cos_tilts*v
+			dv = optical_axis - u
+			jac[:n,0] = -(cos_phi*dp - sin_phi*p - sin_phi*dv - cos_phi*v)
+			jac[n:,0] = -(sin_phi*dp + cos_phi*p + cos_phi*dv - sin_phi*v)
+			jac[:n,1] = -cos_phi*(cos_tilts - 1)
+			jac[n:,1] = -sin_phi*(cos_tilts - 1)
+		rows = numpy.arange(n)
+		jac[rows,2+index] = cos_phi*sin_tilts
+		jac[n+rows,2+index] = sin_phi*sin_tilts
+		return jac
+
+	def fitZ(self, phi, optical_axis, fitdata):
+		'''
+		Least squares z0 of each tilt series for fixed phi and optical axis.
+		Rotated by -phi, only the x residual depends on z0 and it is linear
+		in it, so each z0 comes from one normal equation.  A tilt series
+		without tilted images leaves z0 undetermined at 0.
+		'''
+		sin_phi = math.sin(phi)
+		cos_phi = math.cos(phi)
+		cos_tilts = fitdata['cos_tilts']
+		sin_tilts = fitdata['sin_tilts']
+		index = fitdata['index']
+		nseries = len(fitdata['counts'])
+		u = cos_phi*fitdata['x0'] + sin_phi*fitdata['y0'] + optical_axis
+		observed = cos_phi*fitdata['x'] + sin_phi*fitdata['y']
+		b = cos_tilts*u - optical_axis - observed
+		sts = numpy.bincount(index, sin_tilts*sin_tilts, nseries)
+		stb = numpy.bincount(index, sin_tilts*b, nseries)
+		zs = numpy.zeros(nseries)
+		good = sts > 0
+		zs[good] = stb[good] / sts[good]
+		return zs
 
 	def _leastSquaresXY(self, tilts, positions, tilt):
-		m = len(tilts)
 		n = 3
-		a = scipy.zeros((m, n), scipy.dtype('d'))
-		b = scipy.zeros((m, 1), scipy.dtype('d'))
-		for i in range(m):
-			v = tilts[i]
-			for j in range(n):
-				a[i, j] = v**j
-			b[i] = positions[i]
+		a = numpy.vander(numpy.asarray(tilts, numpy.float64), n, increasing=True)
+		b = numpy.asarray(positions, numpy.float64)
 		x, resids, rank, s = lstsq(a, b)
-		position = 0
-		for j in range(n):
-			position += x[j]*tilt**j
-		return position
+		return numpy.dot(x, tilt**numpy.arange(n))
 
 	def leastSquaresXY(self, tilts, xs, ys, tilt, n_smooth_fit=4):
 		n = n_smooth_fit+1
@@ -1,4 +1,5 @@
 import math
+import time
 import numpy
 import scipy.ndimage
 
@@ -19,16 +20,43 @@ def hanning(size):
 		return 0.5*(1 - numpy.cos(numpy.pi*v/border - numpy.pi))
 	return numpy.fromfunction(function, (size, size))
 
+## Hanning windows by image size.  A tilt series is tracked at one size,
+## so this is built once rather than for every tilt.
+hanning_windows = {}
+
+def getHanning(size):
+	if size not in hanning_windows:
+		hanning_windows[size] = hanning(size)
+	return hanning_windows[size]
+
+def wrapWindow(image, origin, shape):
+	'''shape sized window of image starting at origin, wrapping at the edges'''
+	rows = numpy.arange(origin[0], origin[0]+shape[0]) % image.shape[0]
+	cols = numpy.arange(origin[1], origin[1]+shape[1]) % image.shape[1]
+	return image[rows[:,numpy.newaxis], cols]
+
 class Correlator(object):
-	def __init__(self, node, tilt_axis, correlation_binning=1,lpf=None):
+	'''
+	Tracks the shift between successive images of a tilt series.
+
+	The windowed FFT of the previous image stays in the correlation
+	buffer, so each step transforms only the new image.  With
+	search_levels > 1 the correlation peak is found coarse to fine:
+	first in the correlation binned by 2**(search_levels-1), then
+	refined one level at a time, and the subpixel peak is fitted in a
+	small window instead of filtering the whole correlation image.
+	'''
+	def __init__(self, node, tilt_axis, correlation_binning=1,lpf=None, search_levels=1):
 		self.correlation = correlator.Correlator()
 		self.peakfinder = peakfinder.PeakFinder(lpf)
 		self.node = node
 		self.tiltcorrector = leginon.tiltcorrector.VirtualStageTilter(self.node)
 		self.reset()
 		self.setCorrelationBinning(correlation_binning)
+		self.setSearchLevels(search_levels)
 		self.hanning = None
 		self.channel = None
+		self.timings = {}
 
 	def getChannel(self):
 		if self.channel is None or self.channel == 1:
@@ -42,6 +70,20 @@ class Correlator(object):
 	def setCorrelationBinning(self, correlation_binning):
 		self.correlation_binning = correlation_binning
 
+	def getSearchLevels(self):
+		return self.search_levels
+
+	def setSearchLevels(self, search_levels):
+		self.search_levels = max(1, int(search_levels))
+
+	def getTimings(self):
+		'''seconds spent in each part of the last correlate call'''
+		return dict(self.timings)
+
+	def formatTimings(self):
+		names = ('prepare', 'correlate', 'peak', 'total')
+		return ', '.join(['%s %.3f s' % (name, self.timings[name]) for name in names if name in self.timings])
+
 	def setTiltAxis(self, tilt_axis):
 		pass
 
@@ -74,7 +116,56 @@ class Correlator(object):
 		endx = offsetx + worksize
 		return array[offsety:endy,offsetx:endx]
 
+	def coarseToFinePeak(self, pc, npix=5):
+		'''
+		Subpixel peak of the correlation image pc, searched for in a
+		pyramid of pc binned by 2 at each level, coarsest first.  Only
+		a window around the peak is low pass filtered and fitted.  The
+		window is filtered with wraparound like the whole image would
+		be, so the peak is the same as a full search finds if the coarse
+		levels pick the right peak.
+		'''
+		levels = [pc]
+		for i in range(self.search_levels-1):
+			rows, cols = levels[-1].shape
+			if min(rows, cols) < 16:
+				break
+			levels.append(imagefun.bin2(levels[-1][:rows-rows%2,:cols-cols%2], 2))
+
+		coarse = levels[-1]
+		peak = numpy.unravel_index(numpy.argmax(coarse), coarse.shape)
+		## refine on each finer level within the 4x4 block around the
+		## two pixels of each axis that the coarse pixel was binned from
+		for level in levels[-2:0:-1]:
+			origin = 2*peak[0]-1, 2*peak[1]-1
+			box = wrapWindow(level, origin, (4,4))
+			boxpeak = numpy.unravel_index(numpy.argmax(box), box.shape)
+			peak = (origin[0]+boxpeak[0]) % level.shape[0], (origin[1]+boxpeak[1]) % level.shape[1]
+
+		if len(levels) > 1:
+			limit = 6
+			center = 2*peak[0]+0.5, 2*peak[1]+0.5
+		else:
+			limit = 4
+			center = peak
+		if self.peakfinder.lpf:
+			border = self.peakfinder.filter.kernel.shape[0] / 2
+		else:
+			border = 0
+		size = limit + 2 * (border + npix/2 + 1)
+		size = min(size + size % 2, min(pc.shape))
+		origin = int(center[0]) - size/2, int(center[1]) - size/2
+		window = wrapWindow(pc, origin, (size,size))
+		wincenter = center[0] - origin[0], center[1] - origin[1]
+
+		self.peakfinder.setImage(window)
+		self.peakfinder.pixelPeak(guess=wincenter, limit=(limit,limit))
+		srow, scol = self.peakfinder.subpixelPeak(npix=npix)
+		return (origin[0] + srow) % pc.shape[0], (origin[1] + scol) % pc.shape[1]
+
 	def correlate(self, imagedata, tiltcorrection=True, channel=None,wiener=False,taper=0,corrtype='phase'):
+		t0 = time.time()
+		self.timings = {}
 		image = self.getCenterSquareImage(imagedata['image'])
 		if len(image.shape) != 2 or image.shape[0] != image.shape[1]:
 			raise ValueError
@@ -92,8 +183,7 @@ class Correlator(object):
 		mean = image.mean()
 		image -= mean
 
-		if self.hanning is None or image.shape[0] != self.hanning.shape[0]:
-			self.hanning = hanning(image.shape[0])
+		self.hanning = getHanning(image.shape[0])
 		image *= self.hanning
 		newimagedata['image'] = image
 		if tiltcorrection:
@@ -103,6 +193,11 @@ class Correlator(object):
 		if taper > 0:
 			taperboundary = int((image.shape)[0]*taper*0.01)
 			imagefun.taper(image,taperboundary)
+		t1 = time.time()
+		self.timings['prepare'] = t1 - t0
+
+		## the previous image and its fft move to the reference slot,
+		## so only the fft of this image is calculated
 		self.correlation.insertImage(image)
 		self.channel = channel
 		if corrtype == 'phase':
@@ -115,14 +210,24 @@ class Correlator(object):
 				pc = self.correlation.crossCorrelate()
 			except correlator.MissingImageError:
 				return
+		t2 = time.time()
+		self.timings['correlate'] = t2 - t1
 
-		peak = self.peakfinder.subpixelPeak(newimage=pc)
+		if self.search_levels > 1:
+			peak = self.coarseToFinePeak(pc)
+		else:
+			peak = self.peakfinder.subpixelPeak(newimage=pc)
 		rows, columns = self.peak2shift(peak, pc.shape) 
 		self.raw_shift = {'x': columns, 'y': rows}
 		
 		self.shift['x'] -= self.raw_shift['x']*self.correlation_binning
 		self.shift['y'] += self.raw_shift['y']*self.correlation_binning
+		t3 = time.time()
+		self.timings['peak'] = t3 - t2
 		pc = self.swapQuadrants(pc)
+		self.timings['total'] = time.time() - t0
+		if self.node is not None:
+			self.node.logger.debug('Correlation timings: %s' % (self.formatTimings(),))
 
 		return pc
 
@@ -193,6 +298,7 @@ if __name__ == '__main__':
 		raw_correlation = correlator_.getShift(True)						# get raw correlation
 		correlation = correlator_.getShift(False)
 		print "correlation x: %f, y: %f" %(correlation['x'],correlation['y'])
+		print "timings:", correlator_.formatTimings()
 	
 	im_0 = correlator_.correlation.buffer[0]['fft']
 	im_1 = correlator_.correlation.buffer[1]['fft']
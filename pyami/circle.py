@@ -8,13 +8,30 @@
 #       see  http://leginon.org
 #
 
+import collections
 import numpy
 ma = numpy.ma
 from pyami import arraystats
 
 class CircleMaskCreator(object):
+	## masks and disk offsets kept, least recently used dropped first
+	maxmasks = 64
+	## number of pixel values gathered at once by get_circles_stats
+	chunk_pixels = 4*1024*1024
+
 	def __init__(self):
-		self.masks = {}
+		self.masks = collections.OrderedDict()
+		self.offsets = collections.OrderedDict()
+
+	def _cache_get(self, cache, key):
+		value = cache.pop(key)
+		cache[key] = value
+		return value
+
+	def _cache_put(self, cache, key, value):
+		cache[key] = value
+		while len(cache) > self.maxmasks:
+			cache.popitem(last=False)
 
 	def get(self, shape, center, minradius, maxradius):
 		'''
@@ -22,8 +39,8 @@ class CircleMaskCreator(object):
 		'''
 		## use existing circle mask
 		key = (shape, center, minradius, maxradius)
-		if self.masks.has_key(key):
-			return self.masks[key]
+		if key in self.masks:
+			return self._cache_get(self.masks, key)
 
 		## set up shift and wrapping of circle on image
 		halfshape = shape[0] / 2.0, shape[1] / 2.0
@@ -49,9 +66,23 @@ class CircleMaskCreator(object):
 			c = numpy.where((rsq>=minradsq)&(rsq<=maxradsq), 1.0, 0.0)
 			return c.astype(numpy.int8)
 		temp = numpy.fromfunction(circle, shape)
-		self.masks[key] = temp
+		self._cache_put(self.masks, key, temp)
 		return temp
 
+	def get_offsets(self, shape, radius):
+		'''
+		Integer (row, col) offsets of the disk that get_circle_stats uses
+		on a subimage of this shape, relative to the subimage origin.
+		'''
+		key = (shape, radius)
+		if key in self.offsets:
+			return self._cache_get(self.offsets, key)
+		center = shape[0]/2.0, shape[1]/2.0
+		mask = self.get(shape, center, 0, radius)
+		offsets = numpy.nonzero(mask)
+		self._cache_put(self.offsets, key, offsets)
+		return offsets
+
 	def get_circle_stats(self, image, coord, radius, save_mrc=False):
 		if save_mrc:
 			from pyami import mrc
@@ -77,3 +108,69 @@ class CircleMaskCreator(object):
 		std = arraystats.std(roi)
 		n = len(roi)
 		return {'mean':mean, 'std': std, 'n':n}
+
+	def get_circles_stats(self, image, coords, radius):
+		'''
+		Same as get_circle_stats for a list of (r,c) coords, done in one
+		pass.  Holes are grouped by subimage shape, which only takes a few
+		values for a given radius, and the pixels under each group's disk
+		template are gathered into a (holes, pixels) array to reduce.
+		Returns a list in the order of coords, None where the circle
+		is off the image.
+		'''
+		ncoords = len(coords)
+		results = [None] * ncoords
+		if not ncoords:
+			return results
+		coords = numpy.asarray(coords, numpy.float64).reshape((ncoords,2))
+		shape = image.shape
+		## same bounds as get_circle_stats, int() truncates toward zero
+		rmin = (coords[:,0]-radius).astype(numpy.int64)
+		rmax = (coords[:,0]+radius).astype(numpy.int64)
+		cmin = (coords[:,1]-radius).astype(numpy.int64)
+		cmax = (coords[:,1]+radius).astype(numpy.int64)
+		good = (rmin >= 0) & (rmax < shape[0]) & (cmin >= 0) & (cmax <= shape[1])
+		heights = rmax - rmin + 1
+		widths = numpy.minimum(cmax+1, shape[1]) - cmin
+		flat = numpy.ravel(image)
+		groups = {}
+		for i in numpy.nonzero(good)[0]:
+			key = int(heights[i]), int(widths[i])
+			groups.setdefault(key, []).append(i)
+		for subshape, indices in groups.items():
+			indices = numpy.array(indices)
+			rows, cols = self.get_offsets(subshape, radius)
+			offsets = rows * shape[1] + cols
+			n = len(offsets)
+			origins = rmin[indices] * shape[1] + cmin[indices]
+			step = max(1, self.chunk_pixels // max(n, 1))
+			for start in range(0, len(indices), step):
+				stop = start + step
+				values = numpy.take(flat, origins[start:stop,numpy.newaxis] + offsets)
+				values = values.astype(numpy.float64)
+				means = values.mean(axis=1)
+				stds = values.std(axis=1)
+				for j, i in enumerate(indices[start:stop]):
+					results[i] = {'mean': means[j], 'std': stds[j], 'n': n}
+		return results
+
+if __name__ == '__main__':
+	import time
+	image = numpy.random.random((4096,4096)).astype(numpy.float32)
+	coords = numpy.random.random((5000,2)) * 4096
+	radius = 20
+	circle = CircleMaskCreator()
+	t0 = time.time()
+	old = [circle.get_circle_stats(image, coord, radius) for coord in coords]
+	t_old = time.time() - t0
+	t0 = time.time()
+	new = circle.get_circles_stats(image, coords, radius)
+	t_new = time.time() - t0
+	for a, b in zip(old, new):
+		if a is None or b is None:
+			assert a is None and b is None
+			continue
+		assert a['n'] == b['n']
+		assert abs(a['mean'] - b['mean']) < 1e-5
+		assert abs(a['std'] - b['std']) < 1e-5
+	print '%d holes: one at a time %.3fs, batch %.3fs' % (len(coords), t_old, t_new)
@@ -9,7 +9,7 @@
 #
 
 import numpy
-import fftengine
+import pyami.fft.engine
 import imagefun
 import warnings
 
@@ -17,9 +17,10 @@ class Correlator(object):
 	'''
 	Provides correlation handling functions.
 	A buffer of two images is maintained.
+	FFTs are real-to-complex half spectra from pyami.fft.engine.
 	'''
 	def __init__(self, pad=False, shrink=False):
-		self.fftengine = fftengine.fftEngine()
+		self.fftengine = pyami.fft.engine.get_engine()
 		self.clearBuffer()
 		self.pad = pad
 		self.shrink = shrink
@@ -97,7 +98,7 @@ class Correlator(object):
 		## calculate FFTs of subject images, if not already done
 		fft0 = self.getFFT(0)
 		if fft0 is None:
-			fft0 = self.fftengine.transform(im0)
+			fft0 = self.fftengine.forward(im0)
 			self.setFFT(0, fft0)
 
 		fft1 = self.getFFT(1)
@@ -105,7 +106,7 @@ class Correlator(object):
 			if im1 is im0:
 				fft1 = fft0
 			else:
-				fft1 = self.fftengine.transform(im1)
+				fft1 = self.fftengine.forward(im1)
 			self.setFFT(1, fft1)
 
 		ccfft = numpy.multiply(numpy.conjugate(fft0), fft1)
@@ -119,12 +120,31 @@ class Correlator(object):
 			self.crossCorrelationFFT()
 			ccfft = self.results['cross correlation fft']
 
-			cc = self.fftengine.itransform(ccfft)
+			cc = self.fftengine.reverse(ccfft, self.getImage(0).shape)
 			self.results['cross correlation image'] = cc
 		else:
 			cc = self.results['cross correlation image']
 		return cc
 
+	def wienerNoise(self, ccfft):
+		'''
+		mean power of rows 0.4-0.5 of the full cross correlation fft.
+		The columns missing from the half spectrum are the mirror image
+		of rows -0.5 to -0.4.
+		'''
+		rows = ccfft.shape[0]
+		width = self.getImage(0).shape[1]
+		rstart = int(0.4 * rows)
+		rstop = int(0.5 * rows)
+		region = ccfft[rstart:rstop]
+		total = numpy.sum(region.real * region.real + region.imag * region.imag)
+		nmirror = width - ccfft.shape[1]
+		if nmirror:
+			mirrorrows = (-numpy.arange(rstart, rstop)) % rows
+			region = ccfft[mirrorrows, 1:nmirror+1]
+			total += numpy.sum(region.real * region.real + region.imag * region.imag)
+		return total / float((rstop - rstart) * width)
+
 	def phaseCorrelate(self, zero=True, wiener=False):
 		# elementwise phase-correlation =
 		# cross-correlation / magnitude(cross-correlation
@@ -133,10 +153,7 @@ class Correlator(object):
 			self.crossCorrelationFFT()
 			ccfft = self.results['cross correlation fft']
 			if wiener:
-				rstart = int(0.4 * ccfft.shape[0])
-				rstop = int(0.5 * ccfft.shape[0])
-				region = ccfft[rstart:rstop]
-				noise = 10 * numpy.mean(region.real * region.real + region.imag * region.imag)
+				noise = 10 * self.wienerNoise(ccfft)
 				d = numpy.sqrt(ccfft.real*ccfft.real+ccfft.imag*ccfft.imag+noise)
 			else:
 				d = numpy.absolute(ccfft)
@@ -150,7 +167,7 @@ class Correlator(object):
 				# use cross correlation and move on.
 				pcfft = ccfft
 			self.results['phase correlation fft'] = pcfft
-			pc = self.fftengine.itransform(pcfft)
+			pc = self.fftengine.reverse(pcfft, self.getImage(0).shape)
 			if zero:
 				pc[0, 0] = 0
 
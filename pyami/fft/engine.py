@@ -0,0 +1,426 @@
+#!/usr/bin/env python
+'''
+Plan-cached FFT engine.
+
+usage:
+	eng = pyami.fft.engine.get_engine()
+	half = eng.forward(image)       # real-to-complex half spectrum
+	image = eng.reverse(half, image.shape)
+	halfs = eng.forward(stack)      # batched over the first (stack) axis
+
+Plans are kept in a cache keyed by (direction, shape), so repeated
+transforms of same-shaped arrays (correlation, power spectra, picking)
+only pay for planning once.  With fftw3 each plan owns aligned float64 or
+complex128 buffers and uses all cpus, so the cache is bounded by the
+bytes of those buffers (plan_cache_bytes), least recently used plans
+first out.  A stack is transformed in batches of up to fftw_batch images
+by one plan of the fftw advanced (plan_many) interface, and the rest of
+the stack one image at a time.  Without fftw3, numpy/scipy do the
+transform; scipy.fft is used with multiple workers when available,
+otherwise a stack is split across threads.
+'''
+
+import sys
+import threading
+import time
+import numpy
+
+from pyami import resultcache
+import registry
+
+try:
+	import scipy.fft as scipy_fft
+	if not hasattr(scipy_fft, 'rfftn'):
+		scipy_fft = None
+except ImportError:
+	scipy_fft = None
+
+def load_fftw3():
+	'''
+	calc_fftw3 if the fftw3 calculator imported, otherwise None.
+	Checked when an Engine is created rather than at import, because
+	this module can be imported while the registry is still loading.
+	'''
+	if 'fftw3' in registry.calculators:
+		import calc_fftw3
+		return calc_fftw3
+	return None
+
+def cpu_count():
+	try:
+		import pyami.cpu
+		return pyami.cpu.count()
+	except:
+		return 1
+
+class ManyPlan(object):
+	'''
+	fftw plan for the 2-D transforms of all images of the contiguous
+	stacks inarray and outarray, made with the advanced interface
+	(fftw_plan_many_dft*).  Called like fftw3.Plan.
+	'''
+	def __init__(self, inarray, outarray, direction='forward', flags=['estimate'], nthreads=1):
+		from pyami.fft.fftw3 import lib as fftwlib
+		from pyami.fft.fftw3 import planning
+		self.lib = fftwlib.lib
+		if fftwlib.lib_threads is not None:
+			fftwlib.lib_threads.fftw_plan_with_nthreads(nthreads)
+		howmany = inarray.shape[0]
+		inshape = inarray.shape[1:]
+		outshape = outarray.shape[1:]
+		flagvalue = planning._cal_flag_value(flags)
+		idist = inshape[0] * inshape[1]
+		odist = outshape[0] * outshape[1]
+		## the embed arrays equal to the image shapes mean contiguous images
+		inembed = numpy.array(inshape, numpy.intc)
+		onembed = numpy.array(outshape, numpy.intc)
+		if numpy.iscomplexobj(inarray) and numpy.iscomplexobj(outarray):
+			n = numpy.array(inshape, numpy.intc)
+			sign = planning.fft_direction[direction]
+			self.plan = self.lib.fftw_plan_many_dft(2, n, howmany, inarray, inembed, 1, idist, outarray, onembed, 1, odist, sign, flagvalue)
+		elif numpy.iscomplexobj(outarray):
+			n = numpy.array(inshape, numpy.intc)
+			self.plan = self.lib.fftw_plan_many_dft_r2c(2, n, howmany, inarray, inembed, 1, idist, outarray, onembed, 1, odist, flagvalue)
+		else:
+			n = numpy.array(outshape, numpy.intc)
+			self.plan = self.lib.fftw_plan_many_dft_c2r(2, n, howmany, inarray, inembed, 1, idist, outarray, onembed, 1, odist, flagvalue)
+		if not self.plan:
+			raise RuntimeError('Error creating fftw plan for %d transforms of %s' % (howmany, inshape,))
+		## the plan points into these
+		self.inarray = inarray
+		self.outarray = outarray
+
+	def __call__(self):
+		self.lib.fftw_execute(self.plan)
+
+	def __del__(self):
+		if getattr(self, 'plan', None):
+			self.lib.fftw_destroy_plan(self.plan)
+
+class Plan(object):
+	'''
+	Geometry of one transform, plus the fftw plan and its buffers when
+	fftw3 is the backend.  realshape is the 2-D shape of the real image,
+	halfshape the shape of its half spectrum.  With howmany > 1 the fftw
+	plan transforms a stack of howmany images at once.  nbytes is the
+	size of its buffers.
+	'''
+	def __init__(self, direction, realshape, howmany=1):
+		self.direction = direction
+		self.realshape = tuple(realshape)
+		self.halfshape = (realshape[0], realshape[1]//2+1)
+		self.howmany = howmany
+		self.fftw = None
+		self.inbuf = None
+		self.outbuf = None
+		self.nbytes = 0
+		self.lock = threading.Lock()
+		self.calls = 0
+
+	def fftw_plan(self, flags, nthreads):
+		from pyami.fft import fftw3
+		if self.howmany > 1:
+			stack = (self.howmany,)
+		else:
+			stack = ()
+		if self.direction == 'forward':
+			self.inbuf = fftw3.create_aligned_array(stack+self.realshape, numpy.float64)
+			self.outbuf = fftw3.create_aligned_array(stack+self.halfshape, numpy.complex128)
+		elif self.direction == 'reverse':
+			self.inbuf = fftw3.create_aligned_array(stack+self.halfshape, numpy.complex128)
+			self.outbuf = fftw3.create_aligned_array(stack+self.realshape, numpy.float64)
+		else:
+			## full complex inverse
+			self.inbuf = fftw3.create_aligned_array(stack+self.realshape, numpy.complex128)
+			self.outbuf = fftw3.create_aligned_array(stack+self.realshape, numpy.complex128)
+		self.nbytes = self.inbuf.nbytes + self.outbuf.nbytes
+		fftw_direction = {'forward': 'forward'}.get(self.direction, 'backward')
+		if self.howmany > 1:
+			self.fftw = ManyPlan(self.inbuf, self.outbuf, direction=fftw_direction, flags=flags, nthreads=nthreads)
+		else:
+			self.fftw = fftw3.Plan(self.inbuf, self.outbuf, direction=fftw_direction, flags=flags, nthreads=nthreads)
+
+	def execute(self, input, output):
+		'''
+		run the fftw plan on one 2-D input, or a stack of howmany,
+		writing into output
+		'''
+		self.lock.acquire()
+		try:
+			self.inbuf[:] = input
+			self.fftw()
+			output[:] = self.outbuf
+		finally:
+			self.lock.release()
+
+class Engine(object):
+	'''
+	FFT engine with a shape keyed plan cache.
+
+	All transforms operate on the last two axes.  A 3-D input is treated
+	as a stack of 2-D images along axis 0 and transformed in one call.
+	Half spectra are the real-to-complex layout (width/2+1 columns),
+	which is what fftw3 and numpy.fft.rfft2 produce.
+	'''
+	## most stack images per fftw plan, and most bytes of its buffers
+	fftw_batch = 16
+	fftw_batch_bytes = 256*1024*1024
+	## bytes of plan buffers kept in the cache
+	plan_cache_bytes = 1024*1024*1024
+
+	def __init__(self, nthreads=None, rigor='estimate', backend=None):
+		if nthreads is None:
+			nthreads = cpu_count()
+		self.nthreads = max(1, int(nthreads))
+		self.rigor = rigor
+		calc_fftw3 = load_fftw3()
+		self.calc_fftw3 = calc_fftw3
+		if backend is None:
+			if calc_fftw3 is not None:
+				backend = 'fftw3'
+			elif scipy_fft is not None:
+				backend = 'scipy'
+			else:
+				backend = 'numpy'
+		if backend == 'fftw3' and calc_fftw3 is None:
+			raise RuntimeError('fftw3 backend requested but not available')
+		if backend == 'scipy' and scipy_fft is None:
+			raise RuntimeError('scipy.fft backend requested but not available')
+		self.backend = backend
+		self.plans = resultcache.ResultCache(self.plan_cache_bytes)
+		self.plan_lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+		if self.backend == 'fftw3':
+			self.load_wisdom()
+
+	#### plan cache
+
+	def getPlan(self, direction, realshape, howmany=1):
+		'''
+		cached plan of the transform, the input is converted to the
+		float64 or complex128 of the plan buffers, so its dtype does
+		not matter.  A plan larger than plan_cache_bytes is made for
+		this call only.
+		'''
+		key = (direction, tuple(realshape), howmany)
+		self.plan_lock.acquire()
+		try:
+			plan = self.plans.get(key)
+			if plan is not None:
+				self.hits += 1
+			else:
+				self.misses += 1
+				plan = Plan(direction, realshape, howmany)
+				if self.backend == 'fftw3':
+					kwargs = dict(self.calc_fftw3.global_plan_kwargs)
+					kwargs['flags'] = [self.rigor]
+					kwargs['nthreads'] = self.nthreads
+					plan.fftw_plan(**kwargs)
+				self.plans.put(key, plan)
+		finally:
+			self.plan_lock.release()
+		plan.calls += 1
+		return plan
+
+	def clearPlans(self):
+		self.plans.clear()
+
+	def getStats(self):
+		nbytes, nplans = self.plans.getsize()
+		return {'backend': self.backend, 'plans': nplans, 'plan bytes': nbytes, 'hits': self.hits, 'misses': self.misses, 'threads': self.nthreads}
+
+	#### wisdom
+
+	def load_wisdom(self):
+		if self.backend == 'fftw3':
+			self.calc_fftw3.load_wisdom()
+
+	def store_wisdom(self):
+		'''save fftw wisdom so that tuned (measure/patient) plans are reused'''
+		if self.backend == 'fftw3':
+			self.calc_fftw3.store_wisdom()
+
+	#### transforms
+
+	def forward(self, a):
+		'''real image or stack -> half spectrum'''
+		a = numpy.asarray(a)
+		realshape = a.shape[-2:]
+		plan = self.getPlan('forward', realshape)
+		if self.backend == 'fftw3':
+			out = numpy.empty(a.shape[:-2] + plan.halfshape, numpy.complex128)
+			self._fftw_map(plan, a, out)
+			return out
+		if self.backend == 'scipy':
+			return scipy_fft.rfftn(a, axes=(-2,-1), workers=self.nthreads)
+		return self._numpy_map(numpy.fft.rfftn, a, axes=(-2,-1))
+
+	def reverse(self, f, realshape=None):
+		'''
+		half spectrum or stack of them -> real image(s)
+		realshape is needed to recover an odd image width.
+		'''
+		f = numpy.asarray(f)
+		if realshape is None:
+			realshape = f.shape[-2], 2*(f.shape[-1]-1)
+		else:
+			realshape = tuple(realshape[-2:])
+		plan = self.getPlan('reverse', realshape)
+		if self.backend == 'fftw3':
+			out = numpy.empty(f.shape[:-2] + plan.realshape, numpy.float64)
+			self._fftw_map(plan, f, out)
+			out /= realshape[0] * realshape[1]
+			return out
+		if self.backend == 'scipy':
+			return scipy_fft.irfftn(f, s=realshape, axes=(-2,-1), workers=self.nthreads)
+		return self._numpy_map(numpy.fft.irfftn, f, s=realshape, axes=(-2,-1))
+
+	def forward_full(self, a):
+		'''real image or stack -> full complex spectrum, like fft2'''
+		a = numpy.asarray(a)
+		return self.make_full(self.forward(a), a.shape[-1])
+
+	def reverse_full(self, f):
+		'''full complex spectrum or stack of them -> real part of ifft2'''
+		f = numpy.asarray(f)
+		realshape = f.shape[-2:]
+		plan = self.getPlan('reverse_full', realshape)
+		if self.backend == 'fftw3':
+			out = numpy.empty(f.shape, numpy.complex128)
+			self._fftw_map(plan, f, out)
+			out = out.real / (realshape[0] * realshape[1])
+			return out
+		if self.backend == 'scipy':
+			return scipy_fft.ifftn(f, axes=(-2,-1), workers=self.nthreads).real
+		return self._numpy_map(numpy.fft.ifftn, f, axes=(-2,-1)).real
+
+	def power(self, a, full=True):
+		'''
+		Magnitude of the spectrum.  The absolute value is taken on the
+		half spectrum, then mirrored out to the full layout if requested.
+		'''
+		a = numpy.asarray(a)
+		pow = numpy.absolute(self.forward(a))
+		if full:
+			pow = self.make_full(pow, a.shape[-1], conjugate=False)
+		return pow
+
+	def make_full(self, half, width, conjugate=True):
+		'''
+		Expand half spectra to full spectra using Hermitian symmetry:
+		F[r, c] = conj(F[-r, -c])
+		'''
+		rows = half.shape[-2]
+		halfwidth = half.shape[-1]
+		full = numpy.empty(half.shape[:-1] + (width,), half.dtype)
+		full[...,:halfwidth] = half
+		nmirror = width - halfwidth
+		if nmirror:
+			rowindex = (-numpy.arange(rows)) % rows
+			mirror = half[...,rowindex,nmirror:0:-1]
+			if conjugate and numpy.iscomplexobj(mirror):
+				numpy.conjugate(mirror, mirror)
+			full[...,halfwidth:] = mirror
+		return full
+
+	#### backend helpers
+
+	def _fftw_map(self, plan, input, output):
+		'''
+		run a 2-D plan, or for a stack, one batch plan of the same
+		transform on as many images as fit in fftw_batch_bytes, up to
+		fftw_batch, and the 2-D plan on the rest of the stack
+		'''
+		if input.ndim == 2:
+			plan.execute(input, output)
+			return
+		nstack = input.shape[0]
+		nbatch = min(self.fftw_batch, self.fftw_batch_bytes // max(1, plan.nbytes))
+		start = 0
+		if nbatch > 1 and nstack >= nbatch:
+			## only one batch size, so one batch plan per shape
+			batchplan = self.getPlan(plan.direction, plan.realshape, nbatch)
+			while start + nbatch <= nstack:
+				batchplan.execute(input[start:start+nbatch], output[start:start+nbatch])
+				start += nbatch
+		for i in range(start, nstack):
+			plan.execute(input[i], output[i])
+
+	def _numpy_map(self, func, input, **kwargs):
+		'''
+		numpy.fft is single threaded, so a stack is split into chunks
+		that are transformed in separate threads
+		'''
+		if input.ndim == 2 or self.nthreads == 1 or input.shape[0] < 2:
+			return func(input, **kwargs)
+		chunks = numpy.array_split(numpy.arange(input.shape[0]), min(self.nthreads, input.shape[0]))
+		results = [None] * len(chunks)
+		def work(i, chunk):
+			results[i] = func(input[chunk[0]:chunk[-1]+1], **kwargs)
+		threads = []
+		for i, chunk in enumerate(chunks):
+			t = threading.Thread(target=work, args=(i, chunk))
+			t.start()
+			threads.append(t)
+		for t in threads:
+			t.join()
+		return numpy.concatenate(results)
+
+engine = None
+engine_lock = threading.Lock()
+
+def get_engine():
+	'''the shared engine used by correlator, imagefun, etc.'''
+	global engine
+	engine_lock.acquire()
+	try:
+		if engine is None:
+			engine = Engine()
+	finally:
+		engine_lock.release()
+	return engine
+
+def benchmark(sizes=(4096, 8192), repeat=5, nstack=4):
+	'''
+	Time repeated transforms of same-shaped images, compared to a plain
+	scipy.fftpack.fft2 call for each.
+	'''
+	import scipy.fftpack
+	eng = get_engine()
+	print('backend: %s, threads: %d' % (eng.backend, eng.nthreads))
+	for size in sizes:
+		a = numpy.random.random((size,size)).astype(numpy.float32)
+		t0 = time.time()
+		for i in range(repeat):
+			scipy.fftpack.fft2(a)
+		t_old = (time.time() - t0) / repeat
+		t0 = time.time()
+		for i in range(repeat):
+			f = eng.forward(a)
+		t_fwd = (time.time() - t0) / repeat
+		t0 = time.time()
+		for i in range(repeat):
+			eng.reverse(f, a.shape)
+		t_rev = (time.time() - t0) / repeat
+		print('%dx%d  fftpack.fft2 %.3fs  forward %.3fs  reverse %.3fs' % (size, size, t_old, t_fwd, t_rev))
+		del f
+		stack = numpy.random.random((nstack,size//4,size//4)).astype(numpy.float32)
+		t0 = time.time()
+		for i in range(repeat):
+			for s in stack:
+				scipy.fftpack.fft2(s)
+		t_old = (time.time() - t0) / repeat
+		t0 = time.time()
+		for i in range(repeat):
+			eng.forward(stack)
+		t_stack = (time.time() - t0) / repeat
+		print('%dx%dx%d stack  fftpack.fft2 %.3fs  batched forward %.3fs' % (nstack, size//4, size//4, t_old, t_stack))
+	print(eng.getStats())
+
+if __name__ == '__main__':
+	if len(sys.argv) > 1:
+		sizes = [int(arg) for arg in sys.argv[1:]]
+		benchmark(sizes)
+	else:
+		benchmark()
@@ -43,15 +43,23 @@ class _fftEngine(object):
 
 
 class fftEngine(_fftEngine):
-	'''subclass of fftEngine which uses FFT from scipy module'''
+	'''
+	subclass of fftEngine which uses the plan-cached pyami.fft.engine.
+	transform still returns the full fft2 layout; it is expanded from
+	the real-to-complex half spectrum.
+	'''
 	def __init__(self, *args, **kwargs):
 		_fftEngine.__init__(self)
 
+	## pyami.fft is imported when used, not at module import, because
+	## loading pyami.fft imports imagefun, which imports this module
 	def _transform(self, im):
-		fftim = real_fft2d(im)
+		import pyami.fft.engine
+		fftim = pyami.fft.engine.get_engine().forward_full(im)
 		return fftim
 
 	def _itransform(self, fftim):
-		im = inverse_real_fft2d(fftim)
+		import pyami.fft.engine
+		im = pyami.fft.engine.get_engine().reverse_full(fftim)
 		return im
 
@@ -148,6 +148,38 @@ def unixChangeMode(path,mode_str='g-w,o-rw', recursive=False):
 	p = subprocess.Popen(cmd, shell=True)
 	p.wait()
 
+def applyModeString(mode, mode_str='g-w,o-rw'):
+	'''
+	Apply a symbolic chmod string such as 'g-w,o-rw' or 'u=rw,go=r'
+	to the integer mode and return the new mode.  Lets callers chmod
+	with os.chmod instead of a shell.
+	'''
+	who_bits = {'u': 0700, 'g': 0070, 'o': 0007}
+	perm_bits = {'r': 0444, 'w': 0222, 'x': 0111}
+	for clause in mode_str.split(','):
+		for i, c in enumerate(clause):
+			if c in '+-=':
+				break
+		else:
+			raise ValueError('invalid mode string: %s' % (mode_str,))
+		who, op, perms = clause[:i], clause[i], clause[i+1:]
+		if not who or who == 'a':
+			who = 'ugo'
+		who_mask = 0
+		for w in who:
+			who_mask |= who_bits[w]
+		perm_mask = 0
+		for p in perms:
+			perm_mask |= perm_bits[p]
+		bits = who_mask & perm_mask
+		if op == '+':
+			mode |= bits
+		elif op == '-':
+			mode &= ~bits
+		else:
+			mode = (mode & ~who_mask) | bits
+	return mode
+
 def unixChangeOwnership(uid,gid,pathname, recursive=False):
 	# change ownership of desintation directory or file
 	# not recursive so it does not go through all every time.
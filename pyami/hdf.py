@@ -54,6 +54,38 @@ GROUP "/" {
 #----------------------------
 #----------------------------
 #----------------------------
+#----------------------------
+statistics_keys = ('EMAN.minimum', 'EMAN.maximum', 'EMAN.mean', 'EMAN.mean_nonzero',
+	'EMAN.sigma', 'EMAN.sigma_nonzero', 'EMAN.square_sum')
+
+#----------------------------
+def imageStatistics(a):
+	"""
+	EMAN2 statistics attributes of each image of a (numpart, nx, ny)
+	array, computed for all images together
+	"""
+	numpart = a.shape[0]
+	flat = numpy.asarray(a, dtype=numpy.float64).reshape(numpart, -1)
+	numpix = flat.shape[1]
+	total = flat.sum(axis=1)
+	square_sum = numpy.einsum('ij,ij->i', flat, flat)
+	mean = total/numpix
+	nonzero = (flat != 0).sum(axis=1)
+	nonzero_fraction = nonzero/float(numpix)
+	stats = {
+		'EMAN.minimum': flat.min(axis=1),
+		'EMAN.maximum': flat.max(axis=1),
+		'EMAN.mean': mean,
+		'EMAN.mean_nonzero': total/nonzero,
+		'EMAN.sigma': numpy.sqrt(numpy.maximum(square_sum/numpix - mean**2, 0)),
+		### standard deviation of the nonzero mask, (imagedata != 0).std()
+		'EMAN.sigma_nonzero': numpy.sqrt(nonzero_fraction*(1.0 - nonzero_fraction)),
+		'EMAN.square_sum': square_sum,
+	}
+	for key in stats:
+		stats[key] = numpy.asarray(stats[key], dtype=numpy.float32)
+	return stats
+
 #----------------------------
 class HdfFile(object):
 	#----------------------------
@@ -71,65 +103,92 @@ class HdfFile(object):
 		self.apix = apix
 
 	#----------------------------
-	def addImageToHdf(self, imagedata, partnum):
-		if self.debug is True:
-			print "addImageToHdf %d"%(partnum)
-		imagegroup = self.images.create_group(str(partnum))
+	def createAttributeTemplate(self, shape):
+		"""
+		Group, in a file kept in memory, with the EMAN2 attributes of the
+		particles of one write.  Copying it creates all the attributes
+		of a particle group at once; the particle values are then
+		written over the placeholders.
+		"""
+		self.templatefile = h5py.File(self.filename+'.template', 'w', driver='core', backing_store=False)
+		template = self.templatefile.create_group('template')
 
-		image = imagegroup.create_dataset('image', data=imagedata, shape=imagedata.shape, dtype=numpy.float32)
-		#imagegroup.attrs.create('EMAN.datatype', 7, shape=(1,), dtype=numpy.uint32)
+		#template.attrs.create('EMAN.datatype', 7, shape=(1,), dtype=numpy.uint32)
 		#FIXME not sure about this one above
 
-		imagegroup.attrs.create('EMAN.HostEndian', numpy.string_(sys.byteorder),)
-		imagegroup.attrs.create('EMAN.ImageEndian', numpy.string_(sys.byteorder),)
-		imagegroup.attrs.create('EMAN.source_path', numpy.string_(self.filename),)
-		#imagegroup.attrs.create('EMAN.ptcl_repr', 1, shape=(1,), dtype=numpy.uint32)
-		#imagegroup.attrs.create('EMAN.source_n', 1, shape=(1,), dtype=numpy.uint32)
+		template.attrs.create('EMAN.HostEndian', numpy.string_(sys.byteorder),)
+		template.attrs.create('EMAN.ImageEndian', numpy.string_(sys.byteorder),)
+		template.attrs.create('EMAN.source_path', numpy.string_(self.filename),)
+		#template.attrs.create('EMAN.ptcl_repr', 1, shape=(1,), dtype=numpy.uint32)
+		#template.attrs.create('EMAN.source_n', 1, shape=(1,), dtype=numpy.uint32)
 
 		if self.imagic is True:
 			timedata = datetime.datetime.utcnow()
 			#datetime.datetime(2016, 8, 9, 15, 38, 25, 228892)
-			imagegroup.attrs.create('EMAN.IMAGIC.year', timedata.year, shape=(1,), dtype=numpy.uint32)
-			imagegroup.attrs.create('EMAN.IMAGIC.month', timedata.month, shape=(1,), dtype=numpy.uint32)
-			imagegroup.attrs.create('EMAN.IMAGIC.mday', timedata.day, shape=(1,), dtype=numpy.uint32)
-			imagegroup.attrs.create('EMAN.IMAGIC.hour', timedata.hour, shape=(1,), dtype=numpy.uint32)
-			imagegroup.attrs.create('EMAN.IMAGIC.minute', timedata.minute, shape=(1,), dtype=numpy.uint32)
-			imagegroup.attrs.create('EMAN.IMAGIC.sec', timedata.second, shape=(1,), dtype=numpy.uint32)
-
-			imagegroup.attrs.create('EMAN.IMAGIC.imgnum', partnum, shape=(1,), dtype=numpy.uint32)
-			imagegroup.attrs.create('EMAN.IMAGIC.count', self.numpart-1, shape=(1,), dtype=numpy.uint32)
-			#imagegroup.attrs.create('EMAN.IMAGIC.error', 0, shape=(1,), dtype=numpy.uint32) #imagic error code
-			#imagegroup.attrs.create('EMAN.IMAGIC.headrec', 1, shape=(1,), dtype=numpy.uint32)
-
-		imagegroup.attrs.create('EMAN.minimum', imagedata.min(), shape=(1,), dtype=numpy.float32)
-		imagegroup.attrs.create('EMAN.maximum', imagedata.max(), shape=(1,), dtype=numpy.float32)
-		imagegroup.attrs.create('EMAN.mean', imagedata.mean(), shape=(1,), dtype=numpy.float32)
-		nonzero_mean = imagedata.sum()/(imagedata != 0).sum()
-		imagegroup.attrs.create('EMAN.mean_nonzero', nonzero_mean, shape=(1,), dtype=numpy.float32)
-		imagegroup.attrs.create('EMAN.sigma', imagedata.std(), shape=(1,), dtype=numpy.float32)
-		nonzero_sigma = (imagedata != 0).std()
-		imagegroup.attrs.create('EMAN.sigma_nonzero', nonzero_sigma, shape=(1,), dtype=numpy.float32)
-		imagegroup.attrs.create('EMAN.square_sum', (imagedata**2).sum(), shape=(1,), dtype=numpy.float32)
+			template.attrs.create('EMAN.IMAGIC.year', timedata.year, shape=(1,), dtype=numpy.uint32)
+			template.attrs.create('EMAN.IMAGIC.month', timedata.month, shape=(1,), dtype=numpy.uint32)
+			template.attrs.create('EMAN.IMAGIC.mday', timedata.day, shape=(1,), dtype=numpy.uint32)
+			template.attrs.create('EMAN.IMAGIC.hour', timedata.hour, shape=(1,), dtype=numpy.uint32)
+			template.attrs.create('EMAN.IMAGIC.minute', timedata.minute, shape=(1,), dtype=numpy.uint32)
+			template.attrs.create('EMAN.IMAGIC.sec', timedata.second, shape=(1,), dtype=numpy.uint32)
+
+			template.attrs.create('EMAN.IMAGIC.imgnum', 0, shape=(1,), dtype=numpy.uint32)
+			template.attrs.create('EMAN.IMAGIC.count', self.numpart-1, shape=(1,), dtype=numpy.uint32)
+			#template.attrs.create('EMAN.IMAGIC.error', 0, shape=(1,), dtype=numpy.uint32) #imagic error code
+			#template.attrs.create('EMAN.IMAGIC.headrec', 1, shape=(1,), dtype=numpy.uint32)
+
+		for key in statistics_keys:
+			template.attrs.create(key, 0, shape=(1,), dtype=numpy.float32)
 
 		if self.apix is not None:
-			imagegroup.attrs.create('EMAN.apix_x', self.apix, shape=(1,), dtype=numpy.float32)
-			imagegroup.attrs.create('EMAN.apix_y', self.apix, shape=(1,), dtype=numpy.float32)
-			imagegroup.attrs.create('EMAN.apix_z', self.apix, shape=(1,), dtype=numpy.float32)
-
-		#imagegroup.attrs.create('EMAN.euler_alt', 0, shape=(1,), dtype=numpy.float32)
-		#imagegroup.attrs.create('EMAN.euler_az', 0, shape=(1,), dtype=numpy.float32)
-		#imagegroup.attrs.create('EMAN.euler_phi', 0, shape=(1,), dtype=numpy.float32)
-		#imagegroup.attrs.create('EMAN.is_complex', 0, shape=(1,), dtype=numpy.uint32)
-		#imagegroup.attrs.create('EMAN.is_complex_ri', 1, shape=(1,), dtype=numpy.uint32)
-		#imagegroup.attrs.create('EMAN.is_complex_x', 0, shape=(1,), dtype=numpy.uint32)
-		#imagegroup.attrs.create('EMAN.changecount', 0, shape=(1,), dtype=numpy.uint32)
-		#imagegroup.attrs.create('EMAN.orientation_convention', numpy.string_('EMAN'),)
-
-		imagegroup.attrs.create('EMAN.nx', imagedata.shape[0], shape=(1,), dtype=numpy.uint32)
-		imagegroup.attrs.create('EMAN.ny', imagedata.shape[1], shape=(1,), dtype=numpy.uint32)
-		imagegroup.attrs.create('EMAN.nz', 1, shape=(1,), dtype=numpy.uint32)
+			template.attrs.create('EMAN.apix_x', self.apix, shape=(1,), dtype=numpy.float32)
+			template.attrs.create('EMAN.apix_y', self.apix, shape=(1,), dtype=numpy.float32)
+			template.attrs.create('EMAN.apix_z', self.apix, shape=(1,), dtype=numpy.float32)
+
+		#template.attrs.create('EMAN.euler_alt', 0, shape=(1,), dtype=numpy.float32)
+		#template.attrs.create('EMAN.euler_az', 0, shape=(1,), dtype=numpy.float32)
+		#template.attrs.create('EMAN.euler_phi', 0, shape=(1,), dtype=numpy.float32)
+		#template.attrs.create('EMAN.is_complex', 0, shape=(1,), dtype=numpy.uint32)
+		#template.attrs.create('EMAN.is_complex_ri', 1, shape=(1,), dtype=numpy.uint32)
+		#template.attrs.create('EMAN.is_complex_x', 0, shape=(1,), dtype=numpy.uint32)
+		#template.attrs.create('EMAN.changecount', 0, shape=(1,), dtype=numpy.uint32)
+		#template.attrs.create('EMAN.orientation_convention', numpy.string_('EMAN'),)
+
+		template.attrs.create('EMAN.nx', shape[0], shape=(1,), dtype=numpy.uint32)
+		template.attrs.create('EMAN.ny', shape[1], shape=(1,), dtype=numpy.uint32)
+		template.attrs.create('EMAN.nz', 1, shape=(1,), dtype=numpy.uint32)
+		return template
+
+	#----------------------------
+	def addImagesToHdf(self, a, firstpartnum):
+		"""
+		add the images of a (numpart, nx, ny) array as particles
+		firstpartnum, firstpartnum+1, ...
+		"""
+		if self.debug is True:
+			print "addImagesToHdf %d to %d"%(firstpartnum, firstpartnum+a.shape[0]-1)
+		stats = imageStatistics(a)
+		template = self.createAttributeTemplate(a.shape[1:])
+		try:
+			for i in range(a.shape[0]):
+				partnum = firstpartnum + i
+				partnumstr = str(partnum)
+				self.templatefile.copy(template, self.images, name=partnumstr)
+				imagegroup = self.images[partnumstr]
+				imagegroup.create_dataset('image', data=a[i], shape=a[i].shape, dtype=numpy.float32)
+				for key in statistics_keys:
+					h5py.h5a.open(imagegroup.id, key).write(stats[key][i:i+1])
+				if self.imagic is True:
+					imgnum = numpy.array([partnum], dtype=numpy.uint32)
+					h5py.h5a.open(imagegroup.id, 'EMAN.IMAGIC.imgnum').write(imgnum)
+		finally:
+			self.templatefile.close()
 		return
 
+	#----------------------------
+	def addImageToHdf(self, imagedata, partnum):
+		self.addImagesToHdf(imagedata[numpy.newaxis], partnum)
+
 	#----------------------------
 	def write(self, a):
 		if self.debug is True:
@@ -145,9 +204,7 @@ class HdfFile(object):
 		elif len(shape) == 3:
 			self.numpart = shape[0]
 			self.images.attrs.create('imageid_max', self.numpart-1, shape=(1,), dtype=numpy.uint32)
-			for i in range(self.numpart):
-				imagedata = a[i]
-				self.addImageToHdf(imagedata, i)
+			self.addImagesToHdf(a, 0)
 		else:
 			raise NotImplementedError('wrong dimension for hdf5 file')
 		self.dset.close()
@@ -167,9 +224,7 @@ class HdfFile(object):
 			self.numpart += 1
 			self.images.attrs.modify('imageid_max', self.numpart-1)
 		elif len(shape) == 3:
-			for i in range(self.numpart, self.numpart+shape[0]):
-				imagedata = a[i-self.numpart]
-				self.addImageToHdf(imagedata, i)
+			self.addImagesToHdf(a, self.numpart)
 			self.numpart += shape[0]
 			self.images.attrs.modify('imageid_max', self.numpart-1)
 		else:
@@ -230,6 +285,9 @@ class HdfFile(object):
 		"""
 		read a list of particles into memory
 		particles numbers start at 0
+
+		each particle is its own group in EMAN2 files, so the particles
+		are read in file order directly into the returned array
 		"""
 		if not os.path.isfile(self.filename) or self.getFileSize() < 10:
 			print "file not found"
@@ -240,22 +298,22 @@ class HdfFile(object):
 		if self.debug is True:
 			print "numpart", self.numpart
 		if particleNumbers is None:
-			particleNumbers = imageDict.keys()
+			particleNumbers = range(self.numpart)
 		if self.debug is True:
 			print "read len %d"%(len(particleNumbers))
-		images = []
-		for partnum in particleNumbers:
-			#print "----------"
-			#print partnum
-			partnumstr = str(partnum)
+		images = None
+		for i in numpy.argsort(particleNumbers, kind='mergesort'):
+			partnumstr = str(particleNumbers[i])
 			if self.debug is True:
 				sys.stderr.write(".")
 			image = imageDict[partnumstr]['image']
-			imagedata = image[:]
-			#print imagedata
-			images.append(imagedata)
+			if images is None:
+				images = numpy.empty((len(particleNumbers),)+image.shape, image.dtype)
+			image.read_direct(images[i])
 		self.dset.close()
-		return numpy.array(images)
+		if images is None:
+			return numpy.array([])
+		return images
 
 	################################################
 	# Reporter functions for this class
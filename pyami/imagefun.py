@@ -10,6 +10,7 @@ import numpy
 import quietscipy
 import scipy.ndimage
 import fftengine
+import pyami.fft.engine
 import sys
 try:
 	import numextension
@@ -97,8 +98,20 @@ def phase_spectrum(a):
 	return phase
 
 def power(a, mask_radius=1.0, thresh=3):
-	fft = ffteng.transform(a)
-	pow = numpy.absolute(fft)
+	pow = pyami.fft.engine.get_engine().power(a)
+	return power_from_abs(pow, mask_radius, thresh)
+
+def power_stack(stack, mask_radius=1.0, thresh=3):
+	'''
+	power() of each image in a 3-D stack, using one batched transform
+	'''
+	pows = pyami.fft.engine.get_engine().power(stack)
+	return [power_from_abs(pow, mask_radius, thresh) for pow in pows]
+
+def power_from_abs(pow, mask_radius=1.0, thresh=3):
+	'''
+	finish power() from the absolute value of the full fft
+	'''
 	### neil half pixel shift or powerspectra are not centered!
 	pow = scipy.ndimage.interpolation.shift(pow, (-1, -1), order=1, mode='wrap')
 	try:
@@ -564,6 +577,39 @@ def fourier_scale(a, boxsize):
 	binned = ffteng.itransform(cutfft)/float(factor**2)
 	return binned
 
+def fourier_scale_stack(stack, boxsize, blocksize=8):
+	'''
+	fourier_scale of each image in a stack (first axis).  Only the
+	frequencies kept by fourier_scale are gathered from the half
+	spectrum, and blocks of images are transformed together.
+	'''
+	stack = numpy.asarray(stack)
+	initboxsize = max(stack.shape[1:])
+	if initboxsize == boxsize:
+		return stack
+	if boxsize % 2 or boxsize > min(stack.shape[1:]):
+		return numpy.array([fourier_scale(a, boxsize) for a in stack])
+	eng = pyami.fft.engine.get_engine()
+	rows, cols = stack.shape[1:]
+	halfcols = cols//2+1
+	## frequencies of fourier_scale's cut spectrum, in fft order, as
+	## indices into the flattened half spectrum.  Negative columns are
+	## the conjugate of the mirrored position.
+	freq = numpy.fft.fftfreq(boxsize, 1.0/boxsize).astype(numpy.int)
+	rowfreq = freq[:,numpy.newaxis]
+	colfreq = freq[numpy.newaxis,:]
+	negative = numpy.repeat(colfreq < 0, boxsize, axis=0)
+	index = numpy.where(negative, (-rowfreq % rows)*halfcols - colfreq, (rowfreq % rows)*halfcols + colfreq)
+	factor = initboxsize/float(boxsize)
+	binned = numpy.empty((stack.shape[0], boxsize, boxsize))
+	for i in range(0, stack.shape[0], blocksize):
+		half = eng.forward(stack[i:i+blocksize])
+		cutfft = half.reshape(half.shape[0], -1).take(index, axis=1)
+		numpy.conjugate(cutfft, out=cutfft, where=negative)
+		binned[i:i+blocksize] = eng.reverse_full(cutfft)
+	binned /= float(factor**2)
+	return binned
+
 def bin3(a, factor):
 	'''
 	This is based on: http://scipy.org/Cookbook/Rebinning
@@ -631,6 +677,16 @@ def shrink(image):
 		image = image[offset[0]:offset[0]+newshape[0], offset[0]:offset[1]+newshape[1]]
 	return bin(image, b)
 
+def wrap_indices(n, coords):
+	'''
+	Integer pixel coordinates along an axis of length n, which may be
+	outside of it, mapped into the axis the way scipy.ndimage 'wrap'
+	mode does it, and so the way crop_at does it.
+	'''
+	coords = numpy.asarray(coords, numpy.float64)
+	mapped = scipy.ndimage.map_coordinates(numpy.arange(n, dtype=numpy.float64), [coords.ravel()], order=1, mode='wrap')
+	return numpy.rint(mapped).astype(numpy.intp).reshape(coords.shape)
+
 def crop_at(im, center, shape, mode='wrap', cval=None):
 	'''
 	Crops an image such that the resulting image has im[center] at the center
@@ -643,6 +699,12 @@ def crop_at(im, center, shape, mode='wrap', cval=None):
 		center = im.shape[0]/2.0 - 0.5, im.shape[1]/2.0 - 0.5
 	croppedcenter = shape[0]/2.0 - 0.5, shape[1]/2.0 - 0.5
 	shift = croppedcenter[0]-center[0], croppedcenter[1]-center[1]
+	if mode == 'wrap' and shift[0] == int(shift[0]) and shift[1] == int(shift[1]):
+		## a whole pixel shift only picks pixels, so pick them by index
+		## rather than shifting the whole image
+		rows = wrap_indices(im.shape[0], numpy.arange(shape[0]) - shift[0])
+		cols = wrap_indices(im.shape[1], numpy.arange(shape[1]) - shift[1])
+		return im[rows[:,numpy.newaxis], cols]
 	if mode == 'constant':
 		shifted = scipy.ndimage.shift(im, shift, mode=mode, cval=cval, order=1)
 	else:
@@ -3,7 +3,7 @@
 from pyami import numpil
 Image = numpil.Image2
 import numpy
-import arraystats
+import preview
 
 def write(a, filename, min=None, max=None, quality=80, newsize=None, stdval=5):
 	'''
@@ -20,18 +20,24 @@ is to use the following calculation:
 Optional argument 'quality' is used for jpeg quality, a number between
 1 and 100.   The default is 80.
 
-Optional argument 'newsize' is used for scaling the image.
+Optional argument 'newsize' is used for scaling the image.  The array
+is binned to about that size before it is scaled to 8 bit.
+
+The mean and stdev are estimated from a subsample (see pyami.preview),
+and the file is encoded in the background if preview.enabled is True.
+Then use preview.flush() when the file must be on disk.
 	'''
-	
+	if newsize is not None:
+		newsize = tuple(newsize)
+		a = preview.binToSize(a, newsize)
+
 	## auto determination of range for scaling to 8 bit.
-	if min is None:
-		mean = arraystats.mean(a)
-		std = arraystats.std(a)
-		min = mean - stdval * std
-	if max is None:
-		mean = arraystats.mean(a)
-		std = arraystats.std(a)
-		max = mean + stdval * std
+	if min is None or max is None:
+		mean, std = preview.sampleStats(a)
+		if min is None:
+			min = mean - stdval * std
+		if max is None:
+			max = mean + stdval * std
 
 	if min != max:
 		## scale to 8 bit
@@ -39,8 +45,8 @@ Optional argument 'newsize' is used for scaling the image.
 		scale = 255.0 / (max - min)
 	else:
 		# scale to 8 bit if outside
-		if mean > 255.0 or mean < 0:
-			scale = 255.0 / mean
+		if min > 255.0 or min < 0:
+			scale = 255.0 / min
 		else:
 			# avoid scaling
 			scale = 1
@@ -51,11 +57,9 @@ Optional argument 'newsize' is used for scaling the image.
 	imsize = a.shape[1], a.shape[0]
 	nstr = a.tostring()
 	image = Image.fromstring('L', imsize, nstr, 'raw', 'L', 0, 1)
-	image.convert('L').save(filename, "JPEG", quality=quality)
-	if newsize is None:
-		image.convert('L').save(filename, "JPEG", quality=quality)
-	else:
-		image.convert('L').resize(newsize).save(filename, "JPEG", quality=quality)
+	if newsize is not None and newsize != imsize:
+		image = image.resize(newsize)
+	preview.save(image, filename, "JPEG", quality=quality)
 
 def test():
 	size = 256
@@ -18,6 +18,7 @@ MRC I/O functions:
 			filename - the MRC filename
 '''
 
+import math
 import numpy
 import sys
 import arraystats
@@ -540,6 +541,31 @@ def readDataFromFile(fobj, headerdict, zslice=None):
 	a.shape = shape
 	return a
 
+def readSlicesFromFile(fobj, headerdict, first, count, out=None):
+	'''
+	Read count consecutive z slices, starting at slice first, from the
+	file object fobj with a single read.  The (count, ny, nx) result
+	is read directly into out if given.
+	'''
+	shape = (count,) + tuple(headerdict['shape'][-2:])
+	if headerdict['mode'] == 101:
+		## 4 bit format is unpacked by readDataFromFile
+		slices = [readDataFromFile(fobj, headerdict, zslice) for zslice in range(first, first+count)]
+		if out is None:
+			return numpy.array(slices)
+		out[:] = slices
+		return out
+	bytes_per_pixel = headerdict['dtype'].itemsize
+	framesize = bytes_per_pixel * headerdict['nx'] * headerdict['ny']
+	header_bytes = 1024 + headerdict['nsymbt']
+	if out is None:
+		out = numpy.empty(shape, headerdict['dtype'])
+	fobj.seek(header_bytes + first * framesize)
+	nread = fobj.readinto(out)
+	if nread != out.nbytes:
+		raise IOError('MRC file too short for slices %d to %d' % (first, first+count-1))
+	return out
+
 def write(a, f, header=None, calc_stats=True, mz=None):
 	'''
 Write ndarray to a file
@@ -847,6 +873,52 @@ def readHeaderFromFile(filename):
 	h = parseHeader(h)
 	return h
 
+def fileStats(filename, blockbytes=64*1024*1024):
+	'''
+	min, max, mean and std of the data in an MRC file, calculated in
+	blocks of rows from a memory map, so the file is never in memory
+	as a whole.  Blocks are combined as in Chan et al. for the std.
+	'''
+	a = mmap(filename)
+	rows = a.reshape((-1, a.shape[-1]))
+	blockrows = max(1, blockbytes // max(1, rows.shape[1] * rows.itemsize))
+	n = 0
+	mean = 0.0
+	m2 = 0.0
+	amin = amax = None
+	for start in range(0, rows.shape[0], blockrows):
+		block = numpy.asarray(rows[start:start+blockrows], dtype=numpy.float64)
+		nb = block.size
+		meanb = block.mean()
+		m2b = ((block - meanb)**2).sum()
+		delta = meanb - mean
+		total = n + nb
+		mean += delta * nb / total
+		m2 += m2b + delta * delta * n * nb / total
+		n = total
+		bmin = block.min()
+		bmax = block.max()
+		if amin is None or bmin < amin:
+			amin = bmin
+		if amax is None or bmax > amax:
+			amax = bmax
+	del a, rows
+	return {'min': amin, 'max': amax, 'mean': mean, 'std': math.sqrt(m2 / n)}
+
+def updateFileStats(filename):
+	'''
+	set amin, amax, amean and rms in the header of an MRC file from
+	its data, as write() would
+	'''
+	stats = fileStats(filename)
+	update_file_header(filename, {
+		'amin': stats['min'],
+		'amax': stats['max'],
+		'amean': stats['mean'],
+		'rms': stats['std'],
+	})
+	return stats
+
 def sumStack(filename,dtype=numpy.float32):
 	h = readHeaderFromFile(filename)
 	nslices = h['nz']
@@ -9,8 +9,10 @@ import numextension
 import mrc
 import imagefun
 import peakfinder
+import rotcor
 
-debug = True
+## set debug = True to print the search and write the correlation images
+debug = False
 
 def pad(im, shape):
 	im2 = numpy.zeros(shape, im.dtype)
@@ -65,21 +67,146 @@ def findShift(image, reference, scale, angle):
 
 	return shift
 
-def findRotationScale(image, reference, anglestart, angleend, angleinc, scalestart, scaleend, scaleinc):
+def searchRotationScale(image, reference, anglestart, angleend, angleinc, scalestart, scaleend, scaleinc):
+	'''
+	brute force search of every angle, then every scale
+	'''
 	## scale image to initial guess
 	scaleguess = (float(scalestart) + scaleend) / 2
-	print 'SCALEGUESS', scaleguess
+	if debug:
+		print 'SCALEGUESS', scaleguess
 	image2 = scipy.ndimage.zoom(image, scaleguess)
 
 	result = findBestRotation(image2, reference, anglestart, angleend, angleinc)
 	angle = result[0]
-	print 'BEST ANGLE', angle
+	if debug:
+		print 'BEST ANGLE', angle
 	image2 = scipy.ndimage.rotate(image, angle)
 
 	result = findBestScale(image2, reference, scalestart, scaleend, scaleinc)
 	scale = result[0]
-	print 'BEST SCALE', scale
+	if debug:
+		print 'BEST SCALE', scale
+
+	return angle, scale
+
+windows = {}
+def getWindow(shape):
+	if shape not in windows:
+		windows[shape] = numpy.outer(numpy.hanning(shape[0]), numpy.hanning(shape[1]))
+	return windows[shape]
+
+def centerSquare(im, n):
+	r0 = im.shape[0]/2 - n/2
+	c0 = im.shape[1]/2 - n/2
+	return im[r0:r0+n, c0:c0+n]
+
+def logPolarSpectrum(image, output_shape, rmin, rmax):
+	'''
+	Log-polar resampled magnitude spectrum of a square image.  It does
+	not depend on the image shift, and rotation and scale of the image
+	become shifts along its columns and rows.
+	'''
+	image = (image - image.mean()) * getWindow(image.shape)
+	mag = fftpack.fftshift(numpy.abs(fftpack.fft2(image)))
+	## compress the range so that the low frequencies do not dominate
+	mag = numpy.log1p(mag)
+	center = image.shape[0]/2, image.shape[1]/2
+	return rotcor.logpolar_transform(mag, output_shape, center, rmin, rmax)
+
+def parabolicOffset(before, middle, after):
+	curve = before - 2 * middle + after
+	if curve >= 0:
+		return 0.0
+	return max(-1.0, min(1.0, 0.5 * (before - after) / curve))
+
+def wrappedPeak(cor, rows, cols):
+	'''
+	subpixel peak of cor, a wrapped correlation, searching only the
+	(possibly negative) row and column offsets given
+	'''
+	window = cor[numpy.ix_(rows % cor.shape[0], cols % cor.shape[1])]
+	r, c = numpy.unravel_index(numpy.argmax(window), window.shape)
+	peak = rows[r], cols[c]
+	middle = window[r, c]
+	subpeak = []
+	for axis in (0, 1):
+		index = list(peak)
+		index[axis] = peak[axis] - 1
+		before = cor[index[0] % cor.shape[0], index[1] % cor.shape[1]]
+		index[axis] = peak[axis] + 1
+		after = cor[index[0] % cor.shape[0], index[1] % cor.shape[1]]
+		subpeak.append(peak[axis] + parabolicOffset(before, middle, after))
+	return subpeak
+
+def estimateRotationScale(image, reference, anglestart, angleend, scalestart, scaleend):
+	'''
+	Fourier-Mellin estimate of the rotation and scale of image relative
+	to reference, from one correlation of log-polar magnitude spectra.
+	Only angles and scales in the given ranges are considered.
+	'''
+	n = min(image.shape + reference.shape)
+	rmin = 2.0
+	rmax = n / 2.0 - 1
+	output_shape = n / 2, n
+	dlogr = numpy.log(rmax / rmin) / output_shape[0]
+	dt = 180.0 / output_shape[1]
+
+	lp1 = logPolarSpectrum(centerSquare(reference, n), output_shape, rmin, rmax)
+	lp2 = logPolarSpectrum(centerSquare(image, n), output_shape, rmin, rmax)
+	pc = correlator.phase_correlate(lp1, lp2, zero=False)
+	mrc_write(pc, 'logpolar-cor.mrc')
+
+	## scaling image by scale shrinks it, so its spectrum grows
+	rowstart = int(numpy.floor(-numpy.log(scaleend) / dlogr)) - 1
+	rowend = int(numpy.ceil(-numpy.log(scalestart) / dlogr)) + 1
+	colstart = int(numpy.floor(float(anglestart) / dt)) - 1
+	colend = int(numpy.ceil(float(angleend) / dt)) + 1
+	rows = numpy.arange(rowstart, rowend + 1)
+	cols = numpy.arange(colstart, colend + 1)
+	peak = wrappedPeak(pc, rows, cols)
+	scale = numpy.exp(-peak[0] * dlogr)
+	angle = peak[1] * dt
+	if debug:
+		print 'LOG-POLAR ANGLE', angle, 'SCALE', scale
+	return angle, scale, dt, dlogr
+
+def transformCorrelation(image, reference, angle, scale):
+	newimage = scipy.ndimage.zoom(image, scale)
+	newimage = scipy.ndimage.rotate(newimage, angle, reshape=False)
+	newimage = pad(newimage, reference.shape)
+	cor = correlator.phase_correlate(reference, newimage, zero=False)
+	return peakfinder.findSubpixelPeak(cor, lpf=1.2)
 
+def findRotationScale(image, reference, anglestart, angleend, angleinc, scalestart, scaleend, scaleinc):
+	'''
+	Fourier-Mellin estimate of rotation and scale, refined with a
+	correlation of the transformed image on either side of each.
+	Falls back to the brute force search if the estimate does not
+	correlate or is outside the given ranges.
+	'''
+	angle, scale, dt, dlogr = estimateRotationScale(image, reference, anglestart, angleend, scalestart, scaleend)
+
+	results = transformCorrelation(image, reference, angle, scale)
+	if debug:
+		print 'ESTIMATE', angle, scale, results['snr']
+	if results['snr'] <= 6.0 or not (anglestart <= angle <= angleend and scalestart <= scale <= scaleend):
+		if debug:
+			print 'FOURIER-MELLIN FAILED, SEARCHING'
+		return searchRotationScale(image, reference, anglestart, angleend, angleinc, scalestart, scaleend, scaleinc)
+
+	## one step of the log-polar grid in each direction
+	middle = results['subpixel peak value']
+	before = transformCorrelation(image, reference, angle - dt, scale)['subpixel peak value']
+	after = transformCorrelation(image, reference, angle + dt, scale)['subpixel peak value']
+	angle += dt * parabolicOffset(before, middle, after)
+	middle = transformCorrelation(image, reference, angle, scale)['subpixel peak value']
+	before = transformCorrelation(image, reference, angle, scale * numpy.exp(-dlogr))['subpixel peak value']
+	after = transformCorrelation(image, reference, angle, scale * numpy.exp(dlogr))['subpixel peak value']
+	scale *= numpy.exp(dlogr * parabolicOffset(before, middle, after))
+	if debug:
+		print 'BEST ANGLE', angle
+		print 'BEST SCALE', scale
 	return angle, scale
 
 def findRotationScaleShift(image, reference, anglestart, angleend, angleinc, scalestart, scaleend, scaleinc, prebin):
@@ -14,12 +14,126 @@ import imagefun
 import numpy
 import quietscipy
 import scipy.ndimage as nd_image
-from scipy.linalg import lstsq as linear_least_squares
-import warnings
 
 class FindPeakError(Exception):
 	pass
 
+## design matrix of the quadratic fit and its pseudo-inverse by window shape
+quad_fits = {}
+
+def quadFitMatrices(shape):
+	'''
+	Design matrix of the 2d quadratic (row**2, row, col**2, col, 1) over
+	a window of the given shape and its pseudo-inverse.  They depend only
+	on the shape, so they are made once per shape.
+	'''
+	shape = tuple(shape)
+	if shape not in quad_fits:
+		rows, cols = numpy.indices(shape)
+		rows = rows.ravel().astype(numpy.float64)
+		cols = cols.ravel().astype(numpy.float64)
+		dm = numpy.column_stack((rows**2, rows, cols**2, cols, numpy.ones(rows.shape)))
+		quad_fits[shape] = dm, numpy.linalg.pinv(dm)
+	return quad_fits[shape]
+
+def quadFitPeaks(windows):
+	'''
+	Fit a 2d quadratic to each window of a stack (n, rows, cols) in one
+	matrix product.  Returns a dict of arrays with one item per window:
+	row, col and value of the quadratic peak, minsum (residual sum of
+	squares) and coeffs.  A window that has no peak in a row or column
+	gets nan there.
+	'''
+	windows = numpy.asarray(windows, numpy.float64)
+	dm, pinv = quadFitMatrices(windows.shape[1:])
+	v = windows.reshape((windows.shape[0], -1))
+	coeffs = numpy.dot(v, pinv.T)
+	minsum = ((numpy.dot(coeffs, dm.T) - v)**2).sum(axis=1)
+	with numpy.errstate(divide='ignore', invalid='ignore'):
+		row0 = -coeffs[:,1] / 2.0 / coeffs[:,0]
+		col0 = -coeffs[:,3] / 2.0 / coeffs[:,2]
+		value = coeffs[:,0] * row0**2 + coeffs[:,1] * row0 + coeffs[:,2] * col0**2 + coeffs[:,3] * col0 + coeffs[:,4]
+	return {'row': row0, 'col': col0, 'value': value, 'minsum': minsum, 'coeffs': coeffs}
+
+def gaussFitPeaks(windows):
+	'''
+	Fit a 2d gaussian (without rotation) to each window of a stack by
+	fitting the quadratic to the log of the window.  A window that is
+	not all positive is first raised to just above zero.  Same results
+	as quadFitPeaks, but value is the gaussian peak value and minsum is
+	in log units.
+	'''
+	windows = numpy.asarray(windows, numpy.float64)
+	flat = windows.reshape((windows.shape[0], -1))
+	low = flat.min(axis=1)
+	floor = 1e-3 * (flat.max(axis=1) - low)
+	floor = numpy.where(floor > 0, floor, 1.0)
+	background = numpy.where(low > 0, 0.0, low - floor)
+	logs = numpy.log(windows - background[:,numpy.newaxis,numpy.newaxis])
+	fit = quadFitPeaks(logs)
+	fit['value'] = numpy.exp(fit['value']) + background
+	return fit
+
+def centroidPeaks(windows):
+	'''
+	Center of mass of each window of a stack above its minimum.  value
+	is the maximum of the window, and minsum and coeffs are None.
+	'''
+	windows = numpy.asarray(windows, numpy.float64)
+	flat = windows.reshape((windows.shape[0], -1))
+	weights = flat - flat.min(axis=1)[:,numpy.newaxis]
+	total = weights.sum(axis=1)
+	rows, cols = numpy.indices(windows.shape[1:])
+	with numpy.errstate(divide='ignore', invalid='ignore'):
+		row0 = numpy.dot(weights, rows.ravel()) / total
+		col0 = numpy.dot(weights, cols.ravel()) / total
+	return {'row': row0, 'col': col0, 'value': flat.max(axis=1), 'minsum': None, 'coeffs': None}
+
+## subpixel peak fits by name, for subpixelPeak and refinePeaks
+peak_fits = {
+	'quadratic': quadFitPeaks,
+	'gaussian': gaussFitPeaks,
+	'centroid': centroidPeaks,
+}
+
+def peakWindows(image, peaks, npix):
+	'''
+	npix by npix windows of image centered on each (row, col) pixel peak,
+	wrapped at the edges the same as imagefun.crop_at.
+	'''
+	peaks = numpy.asarray(peaks, numpy.intp).reshape((-1,2))
+	offsets = numpy.arange(npix) - npix/2
+	rows = imagefun.wrap_indices(image.shape[0], peaks[:,0,numpy.newaxis] + offsets)
+	cols = imagefun.wrap_indices(image.shape[1], peaks[:,1,numpy.newaxis] + offsets)
+	return image[rows[:,:,numpy.newaxis], cols[:,numpy.newaxis,:]]
+
+def windowPeaks(peaks, fit, npix):
+	'''
+	Subpixel peaks from the fits of peakWindows.  A fit outside of its
+	window falls back to the pixel peak on that axis and is marked
+	failed.
+	'''
+	peaks = numpy.asarray(peaks, numpy.float64).reshape((-1,2))
+	subpeaks = peaks.copy()
+	failed = numpy.zeros(len(peaks), numpy.bool_)
+	for axis, key in enumerate(('row', 'col')):
+		offset = fit[key]
+		with numpy.errstate(invalid='ignore'):
+			bad = numpy.isnan(offset) | (offset < 0) | (offset > npix)
+		subpeaks[~bad,axis] += offset[~bad] - npix/2
+		failed |= bad
+	return subpeaks, failed
+
+def refinePeaks(image, peaks, npix=5, fit='quadratic'):
+	'''
+	Subpixel refinement of many (row, col) pixel peaks of one image in
+	a single batch, the same as subpixelPeak does for one peak.  Returns
+	an (n,2) array of subpixel peaks and an array that is True where the
+	fit failed and the pixel peak was used.
+	'''
+	windows = peakWindows(image, peaks, npix)
+	return windowPeaks(peaks, peak_fits[fit](windows), npix)
+
 class PeakFinder(object):
 	def __init__(self, lpf=1.5):
 		self.initResults()
@@ -108,59 +222,45 @@ class PeakFinder(object):
 			#print self.results['noise'],self.results['mean'],self.results['signal'],self.results['snr']
 
 		return self.results['pixel peak']
-	"""
-	def gaussFitPeak(self, a):
-		sol = gaussfit.gaussfit(a)
-		return {'row': sol[0][3], 'col': sol[0][4], 'minsum': sol[2], 'coeffs': sol[0], 'value':None }
-	"""
-
 	def quadFitPeak(self, a):
 		'''
 		fit 2d quadratic to a numpy array which should
 		contain a peak.
 		Returns the peak coordinates, and the peak value
 		'''
-		rows,cols = a.shape
-
-		## create design matrix and vector
-		dm = numpy.zeros(rows * cols * 5, numpy.float32)
-		dm.shape = (rows * cols, 5)
-		v = numpy.zeros((rows * cols,), numpy.float32)
-
-		i = 0
-		for row in range(rows):
-			for col in range(cols):
-				dm[i] = (row**2, row, col**2, col, 1)
-				v[i] = a[row,col]
-				i += 1
-
-		try:
-			## find root
-			## fit quadratic
-			fit = linear_least_squares(dm, v)
-			coeffs = fit[0]
-			minsum = fit[1]
-			with warnings.catch_warnings():
-				# turn RuntimeWarning of bad coefficient to error to catch
-				warnings.simplefilter("error")
-
-				row0 = -coeffs[1] / 2.0 / coeffs[0]
-				col0 = -coeffs[3] / 2.0 / coeffs[2]
-		except ZeroDivisionError:
-			raise FindPeakError('peak least squares fit has zero coefficient')
-		except ValueError:
-			raise FindPeakError('peak least squares fit has bad coefficient')
-		except RuntimeWarning:
-			raise FindPeakError('peak least squares fit has bad coefficient')
+		return self.fitPeak(a, 'quadratic')
 
-		## find peak value
-		peak = coeffs[0] * row0**2 + coeffs[1] * row0 + coeffs[2] * col0**2 + coeffs[3] * col0 + coeffs[4]
+	def gaussFitPeak(self, a):
+		'''
+		fit 2d gaussian to a numpy array which should contain a peak
+		'''
+		return self.fitPeak(a, 'gaussian')
 
-		return {'row': row0, 'col': col0, 'value': peak, 'minsum': minsum, 'coeffs': coeffs}
+	def centroidPeak(self, a):
+		'''
+		center of mass of a numpy array which should contain a peak
+		'''
+		return self.fitPeak(a, 'centroid')
 
-	def subpixelPeak(self, newimage=None, npix=5, guess=None, limit=None):
+	def fitPeak(self, a, fit='quadratic'):
+		a = numpy.asarray(a)
+		if not numpy.isfinite(a).all():
+			raise FindPeakError('peak least squares fit has bad coefficient')
+		result = peak_fits[fit](a[numpy.newaxis])
+		row0 = result['row'][0]
+		col0 = result['col'][0]
+		if not (numpy.isfinite(row0) and numpy.isfinite(col0)):
+			raise FindPeakError('peak fit has zero coefficient')
+		peak = {'row': row0, 'col': col0, 'value': result['value'][0], 'minsum': None, 'coeffs': None}
+		if result['minsum'] is not None:
+			peak['minsum'] = result['minsum'][0]
+			peak['coeffs'] = result['coeffs'][0]
+		return peak
+
+	def subpixelPeak(self, newimage=None, npix=5, guess=None, limit=None, fit='quadratic'):
 		'''
 		see pixelPeak doc string for info about guess and limit
+		fit is 'quadratic' (default), 'gaussian' or 'centroid'
 		'''
 		if newimage is not None:
 			self.setImage(newimage)
@@ -175,8 +275,7 @@ class PeakFinder(object):
 		roi = imagefun.crop_at(self.image, (peakrow,peakcol), (npix,npix))
 
 		## fit a quadratic to it and find the subpixel peak
-		roipeak = self.quadFitPeak(roi)
-		#roipeak = self.gaussFitPeak(roi)
+		roipeak = self.fitPeak(roi, fit)
 		subfailed = False
 		if roipeak['row'] < 0 or roipeak['row'] > npix or numpy.isnan(roipeak['row']):
 			srow = float(peakrow)
@@ -199,14 +298,16 @@ class PeakFinder(object):
 		self.results['coeffs'] = roipeak['coeffs']
 		self.results['subfailed'] = subfailed
 
-		#NEIL's SNR calculation
-		self.results['noise']  = nd_image.standard_deviation(self.image)
-		self.results['mean']   = nd_image.mean(self.image)
-		self.results['signal'] = self.results['pixel peak value'] - self.results['mean']
-		if self.results['noise'] == self.results['noise'] and self.results['noise'] != 0.0:
-			self.results['snr'] = self.results['signal'] / self.results['noise']
-		else:
-			self.results['snr'] = self.results['pixel peak value']
+		#NEIL's SNR calculation, already done on the whole image by
+		#pixelPeak unless it searched a limited box
+		if None not in (guess, limit):
+			self.results['noise']  = nd_image.standard_deviation(self.image)
+			self.results['mean']   = nd_image.mean(self.image)
+			self.results['signal'] = self.results['pixel peak value'] - self.results['mean']
+			if self.results['noise'] == self.results['noise'] and self.results['noise'] != 0.0:
+				self.results['snr'] = self.results['signal'] / self.results['noise']
+			else:
+				self.results['snr'] = self.results['pixel peak value']
 
 		return subpixelpeak
 	
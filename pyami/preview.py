@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+'''
+Shared helpers for JPEG/PNG preview images.
+
+A preview is only cosmetic output, so the calling loop should spend as
+little time on it as possible:
+	- binToSize() block averages to about the output size first, so
+	  the scaling to 8 bit runs on the small array
+	- sampleStats() estimates mean and stdev for the contrast limits
+	  from a strided subsample instead of every pixel
+	- save() writes the PIL image to a temporary name that is then
+	  renamed.  With enabled = True, as AppionLoop sets it, that is
+	  done by background threads, and save() waits while maxqueued
+	  images are queued
+	- isUpToDate() lets converters skip a preview that is newer than
+	  its source file
+
+flush() is a barrier: it waits for every queued preview and raises the
+first error, so a program that needs its previews should call it before
+it finishes.  At exit, queued previews are still written and failures
+are reported, but not raised.  wait() waits for a pending write of one
+file, for readers of a preview written by the same process.
+'''
+
+import atexit
+import math
+import os
+import Queue
+import sys
+import threading
+import numpy
+
+## set enabled = True to encode previews in the background, see flush()
+enabled = False
+nthreads = 2
+## most images queued for the background threads
+maxqueued = 8
+## number of pixels used to estimate the contrast limits
+maxsamples = 512*512
+
+def sampleStride(shape, nsamples=None):
+	'''stride in each axis that leaves at most about nsamples pixels'''
+	if nsamples is None:
+		nsamples = maxsamples
+	size = 1
+	for n in shape:
+		size *= n
+	if size <= nsamples:
+		return 1
+	return int(math.ceil(math.sqrt(float(size) / nsamples)))
+
+def sampleStats(a, nsamples=None):
+	'''
+	Estimate mean and stdev of a 2-D array from every n-th pixel of
+	every n-th row.
+	'''
+	a = numpy.asarray(a)
+	step = sampleStride(a.shape, nsamples)
+	sample = a[::step,::step]
+	mean = sample.mean(dtype=numpy.float64)
+	std = sample.std(dtype=numpy.float64)
+	return float(mean), float(std)
+
+def binToSize(a, newsize):
+	'''
+	Block average a 2-D array by the largest integer factor that keeps
+	it at least newsize = (width, height), the PIL order.  Rows and
+	columns that do not fill a whole block are dropped.
+	'''
+	a = numpy.asarray(a)
+	width, height = newsize
+	factor = min(a.shape[0] // height, a.shape[1] // width)
+	if factor < 2:
+		return a
+	rows = a.shape[0] // factor
+	cols = a.shape[1] // factor
+	a = a[:rows*factor,:cols*factor].reshape(rows, factor, cols, factor)
+	binned = a.sum(axis=(1,3), dtype=numpy.float64)
+	binned /= factor * factor
+	return binned
+
+def isUpToDate(filename, sourcename):
+	'''
+	True if preview filename exists and is at least as new as the
+	source file it was made from.
+	'''
+	try:
+		mtime = os.path.getmtime(filename)
+	except OSError:
+		return False
+	try:
+		return mtime >= os.path.getmtime(sourcename)
+	except OSError:
+		return True
+
+class PreviewWriter(object):
+	def __init__(self, nthreads=2, maxqueued=maxqueued):
+		## put blocks while the queue is full
+		self.queue = Queue.Queue(maxqueued)
+		self.cond = threading.Condition()
+		## filename -> number of queued writes of that file
+		self.pending = {}
+		self.errors = []
+		self.count = 0
+		self.threads = []
+		for i in range(nthreads):
+			t = threading.Thread(target=self.loop, name='pyami preview writer %d' % (i,))
+			t.setDaemon(True)
+			t.start()
+			self.threads.append(t)
+
+	def submit(self, image, filename, format, kwargs):
+		'''queue PIL image to be saved as filename'''
+		self.cond.acquire()
+		try:
+			self.pending[filename] = self.pending.get(filename, 0) + 1
+			self.count += 1
+		finally:
+			self.cond.release()
+		self.queue.put((image, filename, format, kwargs))
+
+	def loop(self):
+		while True:
+			item = self.queue.get()
+			if item is None:
+				break
+			image, filename, format, kwargs = item
+			error = None
+			try:
+				write(image, filename, format, **kwargs)
+			except Exception, e:
+				error = e
+				sys.stderr.write('pyami: failed to write preview %s: %s\n' % (filename, e))
+			self.cond.acquire()
+			try:
+				if error is not None:
+					self.errors.append((filename, error))
+				self.pending[filename] -= 1
+				if not self.pending[filename]:
+					del self.pending[filename]
+				self.count -= 1
+				self.cond.notifyAll()
+			finally:
+				self.cond.release()
+
+	def wait(self, filename):
+		'''wait for any queued write of filename to finish'''
+		self.cond.acquire()
+		try:
+			while filename in self.pending:
+				self.cond.wait()
+		finally:
+			self.cond.release()
+
+	def flush(self):
+		'''
+		Wait for all queued previews to be written.  Raises IOError for
+		the first one that failed since the last flush.
+		'''
+		self.cond.acquire()
+		try:
+			while self.count:
+				self.cond.wait()
+			errors = self.errors
+			self.errors = []
+		finally:
+			self.cond.release()
+		if errors:
+			filename, error = errors[0]
+			raise IOError('%d preview(s) failed to write, first %s: %s' % (len(errors), filename, error))
+
+	def getQueueSize(self):
+		return self.count
+
+	def stop(self):
+		'''finish queued writes and end the threads'''
+		for t in self.threads:
+			self.queue.put(None)
+		for t in self.threads:
+			t.join()
+		self.threads = []
+
+def write(image, filename, format, **kwargs):
+	'''
+	save PIL image to a temporary name next to filename, then rename
+	'''
+	dirname, basename = os.path.split(filename)
+	tmpid = '%d.%d' % (os.getpid(), threading.current_thread().ident)
+	tmpname = os.path.join(dirname, '.%s.%s.tmp' % (basename, tmpid))
+	try:
+		image.save(tmpname, format, **kwargs)
+		os.rename(tmpname, filename)
+	except:
+		if os.path.exists(tmpname):
+			os.remove(tmpname)
+		raise
+
+writer = None
+writer_lock = threading.Lock()
+
+def getWriter():
+	global writer
+	writer_lock.acquire()
+	try:
+		if writer is None:
+			writer = PreviewWriter(nthreads)
+	finally:
+		writer_lock.release()
+	return writer
+
+def save(image, filename, format, **kwargs):
+	'''
+	Save PIL image in the background if enabled, otherwise right now.
+	The caller must not change image afterwards.
+	'''
+	## absolute, so a later chdir of the caller does not move the file
+	filename = os.path.abspath(filename)
+	if enabled:
+		getWriter().submit(image, filename, format, kwargs)
+	else:
+		image.save(filename, format, **kwargs)
+
+def wait(filename):
+	'''wait for a pending write of filename'''
+	if writer is not None:
+		writer.wait(os.path.abspath(filename))
+
+def flush():
+	'''barrier for callers that need the previews on disk'''
+	if writer is not None:
+		writer.flush()
+
+def shutdown():
+	'''
+	run at exit: finish queued writes, end the threads and report any
+	failed write, without raising, as the exit status can not change
+	'''
+	global writer
+	writer_lock.acquire()
+	try:
+		w, writer = writer, None
+	finally:
+		writer_lock.release()
+	if w is not None:
+		w.stop()
+		try:
+			w.flush()
+		except IOError, e:
+			sys.stderr.write('pyami: %s\n' % (e,))
+
+atexit.register(shutdown)
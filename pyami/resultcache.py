@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
-import weakref
+import collections
+import threading
 import numpy
 import sys
 
@@ -9,11 +10,13 @@ class CachedResult(object):
 		self.key = key
 		self.result = result
 		if isinstance(result, numpy.ndarray):
-			self.size = result.size * result.itemsize
+			self.size = result.nbytes
 			self.result.setflags(write=False)
+		elif hasattr(result, 'nbytes'):
+			## objects holding arrays, such as fft plans
+			self.size = result.nbytes
 		else:
 			self.size = sys.getsizeof(result)
-		self.refcount = 0
 
 	def __str__(self):
 		return 'CachedResult(%s:%s)' % (self.key, type(self.result))
@@ -22,74 +25,118 @@ class CachedResult(object):
 		return 'CachedResult(%s:%s)' % (self.key, type(self.result))
 
 class ResultCache(object):
+	'''
+	Least recently used cache, bounded by the total size in bytes of the
+	cached results (nbytes for arrays) rather than by number of entries.
+	Entries are kept in an OrderedDict with the most recently used last,
+	so get and put are constant time.  Access is thread safe.
+	'''
 	def __init__(self, size_max):
-		self.weakdict = weakref.WeakValueDictionary()
-		self.strong_list = []
+		self.lock = threading.RLock()
+		self.entries = collections.OrderedDict()
 		self.strong_size_max = size_max
 		self.strong_size = 0
+		self.hits = 0
+		self.misses = 0
 
 	def getsize(self):
-		return self.strong_size, len(self.strong_list)
+		return self.strong_size, len(self.entries)
 
 	def getkeys(self):
-		return self.weakdict.keys()
+		self.lock.acquire()
+		try:
+			return list(self.entries.keys())
+		finally:
+			self.lock.release()
+
+	def getstats(self):
+		self.lock.acquire()
+		try:
+			return {'hits': self.hits, 'misses': self.misses, 'size': self.strong_size, 'entries': len(self.entries), 'size_max': self.strong_size_max}
+		finally:
+			self.lock.release()
 
 	def put(self, key, result):
-		if key in self.weakdict:
-			cached = self.weakdict[key]
-		else:
+		self.lock.acquire()
+		try:
+			old = self.entries.pop(key, None)
+			if old is not None:
+				self.strong_size -= old.size
 			cached = CachedResult(key, result)
-			self.weakdict[key] = cached
+			if cached.size > self.strong_size_max:
+				## would evict everything else and still not fit
+				return
+			self.entries[key] = cached
 			self.strong_size += cached.size
 			self.clean_strong()
-		self.insert_strong(cached)
+		finally:
+			self.lock.release()
 
 	def get(self, key):
+		self.lock.acquire()
 		try:
-			cached = self.weakdict[key]
-		except:
-			return None
-		## this bumps it to the head of the strong list
-		self.insert_strong(cached)
-		return cached.result
-
-	def insert_strong(self, cached):
-		self.strong_list.insert(0, cached)
-		cached.refcount += 1
+			try:
+				## pop and reinsert bumps it to most recently used
+				cached = self.entries.pop(key)
+			except KeyError:
+				self.misses += 1
+				return None
+			self.entries[key] = cached
+			self.hits += 1
+			return cached.result
+		finally:
+			self.lock.release()
+
+	def remove(self, key):
+		self.lock.acquire()
+		try:
+			cached = self.entries.pop(key, None)
+			if cached is not None:
+				self.strong_size -= cached.size
+		finally:
+			self.lock.release()
+
+	def clear(self):
+		self.lock.acquire()
+		try:
+			self.entries.clear()
+			self.strong_size = 0
+		finally:
+			self.lock.release()
 
 	def remove_strong(self):
-		cached = self.strong_list.pop()
-		cached.refcount -= 1
-		if cached.refcount == 0:
-			self.strong_size -= cached.size
+		'''remove the least recently used entry'''
+		key, cached = self.entries.popitem(last=False)
+		self.strong_size -= cached.size
 
 	def clean_strong(self):
-		while self.strong_size > self.strong_size_max:
+		while self.strong_size > self.strong_size_max and self.entries:
 			self.remove_strong()
 
 def test():
 	import numpy
 	cache = ResultCache(100)
-	print 'KEYS', cache.weakdict.keys()
+	print 'KEYS', cache.getkeys()
 
 	for f in ('a', 'b', 'c', 'd', 'e', 'f', 'g', 'f', 'e', 'a'):
 		a = numpy.arange(20, dtype=numpy.uint8)
 		print 'PUT', f
 		cache.put(f, a)
-		print 'KEYS', [x.key for x in cache.strong_list]
+		print 'KEYS', cache.getkeys()
 	print ''
 
 	for f in ('d', 'd', 'b'):
 		print 'GET', f, cache.get(f)
-		print 'KEYS', [x.key for x in cache.strong_list]
+		print 'KEYS', cache.getkeys()
 	print ''
 
 	for f in ('b', 'b',):
 		a = numpy.arange(20, dtype=numpy.uint8)
 		print 'PUT', f
 		cache.put(f, a)
-		print 'KEYS', [x.key for x in cache.strong_list]
+		print 'KEYS', cache.getkeys()
 	print ''
+	print 'STATS', cache.getstats()
 
 
 if __name__ == '__main__':
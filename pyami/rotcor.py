@@ -29,6 +29,32 @@ def makeMapping(output_shape, center, dr, dt):
 	return mapping
 mappings = {}
 
+def makeLogPolarMapping(output_shape, center, rmin, rmax):
+	'''
+	Coordinates for map_coordinates of a log-polar transform.  Output
+	rows are log radius from rmin to rmax, columns are angle from 0 to pi.
+	'''
+	key = ('logpolar', output_shape, center, rmin, rmax)
+	if key in mappings:
+		return mappings[key]
+	dlogr = numpy.log(float(rmax)/rmin) / output_shape[0]
+	dt = numpy.pi / output_shape[1]
+	output_rs = rmin * numpy.exp(dlogr * numpy.arange(output_shape[0]))
+	output_ts = dt * numpy.arange(output_shape[1])
+	mapping = numpy.zeros((2,)+output_shape)
+	mapping[0] = center[0] + output_rs[:,numpy.newaxis] * numpy.cos(output_ts)
+	mapping[1] = center[1] + output_rs[:,numpy.newaxis] * numpy.sin(output_ts)
+	mappings[key] = mapping
+	return mapping
+
+def logpolar_transform(image, output_shape, center, rmin, rmax):
+	'''
+	resample image on a log-polar grid around center, so scaling and
+	rotation about center become shifts along rows and columns
+	'''
+	mapping = makeLogPolarMapping(output_shape, center, rmin, rmax)
+	return scipy.ndimage.map_coordinates(image, mapping, order=1, mode='constant', cval=0)
+
 def dummy(output, mappingarray):
 	return tuple(mappingarray.__getitem__(output))
 
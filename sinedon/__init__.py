@@ -18,11 +18,17 @@ sinedon.setConfig(modulename, host=hostname, db=dbname, user=username, ...)
 
 getConnection(modulename)
   Call this function to get a connection to the named database
+
+sinedon.flushImages()
+  With imagewriter.enabled = True, image files of inserted Data are
+  written in the background.  Call this to wait until they are all on
+  disk; it raises IOError if any failed.
 '''
 
 from data import Data
 from dbconfig import getConfig, setConfig
 from connections import getConnection
+from imagewriter import flush as flushImages
 # warning level
 import warnings
 warnings.filterwarnings('ignore', module='sinedon')
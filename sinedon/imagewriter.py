@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+'''
+Background writer for image files that belong to inserted Data objects.
+
+With enabled = True, sqldict.saveMRC hands a copy of the array to the
+writer and returns right away, so the row insert does not wait for tens
+of MB to reach (often NFS) disk.  It is off by default: the row of a
+failed background write is already committed, so a program that turns
+it on must call flush() before it relies on the files, as AppionLoop
+does before it marks an image done.  Each file is written to a temporary
+name in the destination directory, fsynced, then renamed, so a file with
+the final name is always complete.  Writes of one file name go to the
+same thread, so they finish in order.  submit() blocks while more than
+maxbytes of arrays are queued.
+
+An MRC file that already exists elsewhere, such as a frame alignment
+sum, is ingested with ingest() instead: it is hard linked to the final
+name, or copied in the background if that is on another filesystem.
+The source is opened before ingest() returns, so the caller may delete
+it right away.
+
+flush() is a barrier: it waits for every queued write and raises the
+first error.  At exit, queued writes are still finished and failures
+are reported, but not raised.  read() waits for a pending write of that
+file before reading it, so a query right after an insert still finds
+the image.
+'''
+
+import atexit
+import errno
+import os
+import Queue
+import sys
+import shutil
+import threading
+import numpy
+import pyami.mrc
+
+## set enabled = True to write in the background, see flush()
+enabled = False
+nthreads = 2
+## bytes of queued arrays before submit waits for the writer
+maxbytes = 1024*1024*1024
+
+class ImageWriter(object):
+	def __init__(self, nthreads=2, maxbytes=maxbytes):
+		## one queue per thread, see submit
+		self.queues = []
+		self.cond = threading.Condition()
+		## fullname -> number of queued writes of that file
+		self.pending = {}
+		self.maxbytes = maxbytes
+		self.nbytes = 0
+		self.errors = []
+		self.count = 0
+		self.threads = []
+		for i in range(nthreads):
+			q = Queue.Queue()
+			t = threading.Thread(target=self.loop, args=(q,), name='sinedon image writer %d' % (i,))
+			t.setDaemon(True)
+			t.start()
+			self.queues.append(q)
+			self.threads.append(t)
+
+	def submit(self, a, fullname):
+		'''
+		queue a copy of array a to be written as MRC file fullname, or a
+		copied to fullname if it is an open MRC file, which is then closed
+		'''
+		if isinstance(a, file):
+			nbytes = 0
+		else:
+			a = numpy.array(a)
+			nbytes = a.nbytes
+		self.cond.acquire()
+		try:
+			## one array larger than maxbytes still goes when the queue is empty
+			while self.nbytes and self.nbytes + nbytes > self.maxbytes:
+				self.cond.wait()
+			self.nbytes += nbytes
+			self.pending[fullname] = self.pending.get(fullname, 0) + 1
+			self.count += 1
+		finally:
+			self.cond.release()
+		## the same thread for the same file, so a later write of it
+		## can not finish before an earlier one
+		q = self.queues[hash(fullname) % len(self.queues)]
+		q.put((a, fullname, nbytes))
+
+	def loop(self, q):
+		while True:
+			item = q.get()
+			if item is None:
+				break
+			a, fullname, nbytes = item
+			error = None
+			try:
+				if isinstance(a, file):
+					try:
+						copyFile(a, fullname)
+					finally:
+						a.close()
+				else:
+					write(a, fullname)
+			except Exception, e:
+				error = e
+				sys.stderr.write('sinedon: failed to write %s: %s\n' % (fullname, e))
+			del a
+			self.cond.acquire()
+			try:
+				if error is not None:
+					self.errors.append((fullname, error))
+				self.nbytes -= nbytes
+				self.pending[fullname] -= 1
+				if not self.pending[fullname]:
+					del self.pending[fullname]
+				self.count -= 1
+				self.cond.notifyAll()
+			finally:
+				self.cond.release()
+
+	def wait(self, fullname):
+		'''wait for any queued write of fullname to finish'''
+		self.cond.acquire()
+		try:
+			while fullname in self.pending:
+				self.cond.wait()
+		finally:
+			self.cond.release()
+
+	def flush(self):
+		'''
+		Wait for all queued writes to finish.  Raises IOError for the
+		first write that failed since the last flush.
+		'''
+		self.cond.acquire()
+		try:
+			while self.count:
+				self.cond.wait()
+			errors = self.errors
+			self.errors = []
+		finally:
+			self.cond.release()
+		if errors:
+			fullname, error = errors[0]
+			raise IOError('%d image file(s) failed to write, first %s: %s' % (len(errors), fullname, error))
+
+	def getQueueSize(self):
+		return self.count
+
+	def stop(self):
+		'''finish queued writes and end the threads'''
+		for q in self.queues:
+			q.put(None)
+		for t in self.threads:
+			t.join()
+		self.threads = []
+
+def write(a, fullname):
+	'''
+	write MRC to a temporary name next to fullname, fsync, then rename
+	'''
+	tmpname = tempName(fullname)
+	try:
+		f = open(tmpname, 'wb')
+		try:
+			pyami.mrc.write(a, f)
+			f.flush()
+			os.fsync(f.fileno())
+		finally:
+			f.close()
+		os.rename(tmpname, fullname)
+	except:
+		if os.path.exists(tmpname):
+			os.remove(tmpname)
+		raise
+
+def tempName(fullname):
+	dirname, basename = os.path.split(fullname)
+	tmpid = '%d.%d' % (os.getpid(), threading.current_thread().ident)
+	return os.path.join(dirname, '.%s.%s.tmp' % (basename, tmpid))
+
+def copy(sourcename, fullname):
+	'''
+	copy file to a temporary name next to fullname, fsync, then rename
+	'''
+	source = open(sourcename, 'rb')
+	try:
+		copyFile(source, fullname)
+	finally:
+		source.close()
+
+def copyFile(source, fullname):
+	'''
+	copy open file source to a temporary name next to fullname, fsync,
+	then rename
+	'''
+	tmpname = tempName(fullname)
+	try:
+		f = open(tmpname, 'wb')
+		try:
+			shutil.copyfileobj(source, f, 16*1024*1024)
+			f.flush()
+			os.fsync(f.fileno())
+		finally:
+			f.close()
+		os.rename(tmpname, fullname)
+	except:
+		if os.path.exists(tmpname):
+			os.remove(tmpname)
+		raise
+
+def link(sourcename, fullname):
+	'''
+	hard link file as fullname, replacing an existing fullname
+	'''
+	tmpname = tempName(fullname)
+	os.link(sourcename, tmpname)
+	try:
+		os.rename(tmpname, fullname)
+	except:
+		os.remove(tmpname)
+		raise
+	## rename does nothing if fullname is already a link to sourcename
+	if os.path.lexists(tmpname):
+		os.remove(tmpname)
+
+writer = None
+writer_lock = threading.Lock()
+
+def getWriter():
+	global writer
+	writer_lock.acquire()
+	try:
+		if writer is None:
+			writer = ImageWriter(nthreads)
+	finally:
+		writer_lock.release()
+	return writer
+
+def save(a, fullname):
+	'''write in the background if enabled, otherwise right now'''
+	if enabled:
+		getWriter().submit(a, fullname)
+	else:
+		pyami.mrc.write(a, fullname)
+
+def ingest(sourcename, fullname):
+	'''
+	Make the finished MRC file sourcename available as fullname without
+	reading it: a hard link if possible, otherwise a copy, in the
+	background if enabled.  sourcename is left in place, but may be
+	removed as soon as this returns.
+	'''
+	if os.path.abspath(sourcename) == os.path.abspath(fullname):
+		return
+	try:
+		link(sourcename, fullname)
+		return
+	except OSError, e:
+		## other filesystem, or one without hard links
+		if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP, errno.EACCES):
+			raise
+	if enabled:
+		## open now, so the copy still reads the file if it is removed
+		getWriter().submit(open(sourcename, 'rb'), fullname)
+	else:
+		copy(sourcename, fullname)
+
+def flush():
+	'''barrier for callers that need the image files on disk'''
+	if writer is not None:
+		writer.flush()
+
+def read(fullname):
+	'''pyami.mrc.read that first waits for a pending write of the file'''
+	if writer is not None:
+		writer.wait(fullname)
+	return pyami.mrc.read(fullname)
+
+def shutdown():
+	'''
+	run at exit: finish queued writes, end the threads and report any
+	failed write, without raising, as the exit status can not change
+	'''
+	global writer
+	writer_lock.acquire()
+	try:
+		w, writer = writer, None
+	finally:
+		writer_lock.release()
+	if w is not None:
+		w.stop()
+		try:
+			w.flush()
+		except IOError, e:
+			sys.stderr.write('sinedon: %s\n' % (e,))
+
+atexit.register(shutdown)
@@ -165,6 +165,7 @@ import sinedon
 import pyami.mrc
 import os
 import dbconfig
+import imagewriter
 import cPickle
 import time
 from pyami import weakattr
@@ -1414,7 +1415,7 @@ def datatype(in_dict, join=None, parentclass=None):
 			if value is None:
 				content[a[1]] = None
 			else:
-				content[a[1]] = newdict.FileReference(value, pyami.mrc.read)
+				content[a[1]] = newdict.FileReference(value, imagewriter.read)
 		elif a0 == 'REF':
 			fieldname = a[-1]
 			tablename = a[-2]
@@ -1510,12 +1511,23 @@ def saveMRC(object, name, path, filename, thumb=False):
 	d={}
 	k = keyMRC(name)
 	fullname = dbconfig.mapPath(os.path.join(path,filename))
-	if object is None or isinstance(object, newdict.FileReference):
-		## either there is no image data, or it is already saved
+	if object is None:
+		## there is no image data
 		pass
+	elif isinstance(object, newdict.FileReference):
+		## already saved.  A file made outside of path for this
+		## reference is ingested without reading it, see
+		## imagewriter.ingest().  Any other reference is left alone.
+		if getattr(object, 'ingest', False) and object.path is not None:
+			sourcename = os.path.join(object.path, object.filename)
+			imagewriter.ingest(sourcename, fullname)
+			object.filename = filename
+			object.setPath(os.path.dirname(fullname))
+			object.ingest = False
 	else:
 		#print 'saving MRC', fullname
-		pyami.mrc.write(object, fullname)
+		## written in the background if imagewriter.enabled, see flush()
+		imagewriter.save(object, fullname)
 
 	d[k] = filename
 	return d
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+'''
+Check imagewriter.ingest when the hard link fails as it does across
+filesystems (EXDEV): the background copy must still complete if the
+source is removed right after ingest returns, as apDDAlignStackMaker
+does with the aligned sums in loopCleanUp.  Also check that repeated
+writes of one file finish in order, and that linking over an existing
+link to the same file leaves no temp link behind.
+'''
+import errno
+import os
+import shutil
+import tempfile
+import threading
+import numpy
+import pyami.mrc
+import imagewriter
+
+def crossDeviceLink(sourcename, fullname):
+	raise OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+
+def testIngestCopy(dirname):
+	a = numpy.arange(64*64, dtype=numpy.float32).reshape((64,64))
+	sourcename = os.path.join(dirname, 'source.mrc')
+	fullname = os.path.join(dirname, 'ingested.mrc')
+	pyami.mrc.write(a, sourcename)
+
+	## hold the copy until the source is gone
+	started = threading.Event()
+	release = threading.Event()
+	tempName = imagewriter.tempName
+	def heldTempName(fullname):
+		started.set()
+		release.wait()
+		return tempName(fullname)
+
+	link = imagewriter.link
+	enabled = imagewriter.enabled
+	imagewriter.link = crossDeviceLink
+	imagewriter.tempName = heldTempName
+	imagewriter.enabled = True
+	try:
+		imagewriter.ingest(sourcename, fullname)
+		started.wait()
+		os.remove(sourcename)
+		release.set()
+		imagewriter.flush()
+	finally:
+		imagewriter.link = link
+		imagewriter.tempName = tempName
+		imagewriter.enabled = enabled
+	assert (pyami.mrc.read(fullname) == a).all()
+	print 'background copy after source removal: OK'
+
+	## same without the background writer
+	pyami.mrc.write(a, sourcename)
+	enabled = imagewriter.enabled
+	imagewriter.enabled = False
+	imagewriter.link = crossDeviceLink
+	try:
+		imagewriter.ingest(sourcename, fullname+'2')
+	finally:
+		imagewriter.link = link
+		imagewriter.enabled = enabled
+	os.remove(sourcename)
+	assert (pyami.mrc.read(fullname+'2') == a).all()
+	print 'synchronous copy: OK'
+
+def testWriteOrder(dirname):
+	'''
+	later writes of the same file end up on disk, with submit waiting
+	for the writer whenever three arrays are queued
+	'''
+	dirname = os.path.join(dirname, 'order')
+	os.mkdir(dirname)
+	fullname = os.path.join(dirname, 'order.mrc')
+	a = numpy.zeros((256,256), numpy.float32)
+	w = imagewriter.ImageWriter(nthreads=4, maxbytes=3*a.nbytes)
+	for i in range(40):
+		a[:] = i
+		w.submit(a, fullname)
+	w.flush()
+	w.stop()
+	assert (pyami.mrc.read(fullname) == 39).all()
+	assert os.listdir(dirname) == ['order.mrc']
+	print 'write order: OK'
+
+def testLinkSame(dirname):
+	'''
+	linking a file over an existing link to it leaves no temp link
+	'''
+	dirname = os.path.join(dirname, 'same')
+	os.mkdir(dirname)
+	sourcename = os.path.join(dirname, 'source.mrc')
+	fullname = os.path.join(dirname, 'linked.mrc')
+	pyami.mrc.write(numpy.zeros((8,8), numpy.float32), sourcename)
+	imagewriter.link(sourcename, fullname)
+	imagewriter.link(sourcename, fullname)
+	assert sorted(os.listdir(dirname)) == ['linked.mrc', 'source.mrc']
+	print 'link over same file: OK'
+
+def test():
+	dirname = tempfile.mkdtemp()
+	try:
+		testIngestCopy(dirname)
+		testWriteOrder(dirname)
+		testLinkSame(dirname)
+	finally:
+		shutil.rmtree(dirname)
+
+if __name__ == '__main__':
+	test()